@@ -3,6 +3,13 @@ import chromedriver_autoinstaller
 import time
 from selenium.webdriver.common.by import By
 import sqlite3
+import os
+import sys
+
+# Piyasa özetleri ve fırsat puanları (backendv3/app/market.py), kopya ilan tespiti (backendv3/app/dedup.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "backendv3", "app"))
+import market
+import dedup
 
 # Veri tabanı dosyasını oluştur veya bağlan
 db_name = "araba_verileri.db"
@@ -34,6 +41,9 @@ db_name = "araba_verileri.db"
 
 #print(f"{db_name} veri tabanında 'araba_ilanlari' tablosu oluşturuldu.")
 
+# Bu taramanın kopya oranı, taramadan önceki son ilan id'sinden sonrakiler üzerinden raporlanır
+tarama_baslangic_id = dedup.last_listing_id(db_name)
+
 chromedriver_autoinstaller.install()
 driver = webdriver.Chrome()
 otomobiller=["hyundai","honda", "mercedes-benz", "opel", "renault", "toyota", "volkswagen"]
@@ -98,6 +108,21 @@ try:
 
                     print(f"Kayıt eklendi: {link}")
 
+                    # Yeni ilan aynı marka/seri/yıl grubundaki ilanlarla karşılaştırılır; kopyaysa
+                    # duplicate_of ile asıl ilana bağlanır ve aramalarda gösterilmez
+                    try:
+                        sonuc = dedup.refresh(db_name)
+                        if sonuc["duplicates"]:
+                            print(f"Kopya ilan: {link}")
+                    except Exception as e:
+                        print(f"Kopya kontrolü yapılamadı: {e}")
+
+                    # Yalnızca yeni ilanın serisinin piyasa özeti ve fırsat puanları yeniden hesaplanır
+                    try:
+                        market.refresh(db_name)
+                    except Exception as e:
+                        print(f"Piyasa özeti güncellenemedi: {e}")
+
                     driver.back()
                     time.sleep(2)
 
@@ -111,3 +136,5 @@ except Exception as e:
 
 finally:
     driver.quit()
+    rapor = dedup.crawl_report(tarama_baslangic_id, db_name)
+    print(f"Tarama özeti: {rapor['listings']} yeni ilan, {rapor['duplicates']} kopya (oran: {rapor['dedup_ratio']})")
@@ -0,0 +1,168 @@
+# app/admission.py
+
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, Iterator
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# --- Limits (overridable through the environment) ---
+# The limits are for the whole deployment. Semaphores are per process, so each of the
+# WEB_CONCURRENCY workers (set by gunicorn.conf.py) enforces its share.
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+def _per_worker(limit: int) -> int:
+    return max(1, limit // WORKERS)
+
+LLM_MAX_CONCURRENCY = _per_worker(int(os.getenv("LLM_MAX_CONCURRENCY", "8")))
+LLM_STAGE_CONCURRENCY = {
+    "parse": _per_worker(int(os.getenv("LLM_PARSE_CONCURRENCY", "4"))),
+    "sql": _per_worker(int(os.getenv("LLM_SQL_CONCURRENCY", "4"))),
+    "summary": _per_worker(int(os.getenv("LLM_SUMMARY_CONCURRENCY", "4"))),
+}
+LLM_MAX_QUEUE = _per_worker(int(os.getenv("LLM_MAX_QUEUE", "32")))     # Waiting callers before we shed load
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+WAIT_SAMPLE_SIZE = 1000                                                 # Recent waits kept for percentiles
+
+class AdmissionRejected(Exception):
+    """Raised when an LLM call cannot be admitted. Maps to a 429/503 response with Retry-After."""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class _StageStats:
+    def __init__(self):
+        self.in_use = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.waits = deque(maxlen=WAIT_SAMPLE_SIZE)
+
+class AdmissionController:
+    """
+    Bounds concurrent LLM calls with a global and a per-stage semaphore.
+    Callers wait in a bounded queue; when the queue is full they are rejected
+    immediately (429), and when they cannot get a slot before the deadline they
+    are rejected with 503. Both carry a Retry-After estimate.
+    """
+
+    def __init__(self, global_limit: int, stage_limits: Dict[str, int], max_queue: int, queue_timeout: float):
+        self.global_limit = global_limit
+        self.stage_limits = dict(stage_limits)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._global = threading.BoundedSemaphore(global_limit)
+        self._stages = {stage: threading.BoundedSemaphore(limit) for stage, limit in stage_limits.items()}
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._stats = {stage: _StageStats() for stage in stage_limits}
+
+    def _retry_after(self, stage: str) -> int:
+        """Rough time until a slot frees up: queued work divided by capacity, times mean service time."""
+        stats = self._stats[stage]
+        mean_service = stats.total_service / stats.admitted if stats.admitted else 1.0
+        return max(1, math.ceil(mean_service * (self._waiting + 1) / self.global_limit))
+
+    @contextmanager
+    def slot(self, stage: str) -> Iterator[None]:
+        """Holds a stage slot and a global slot for the duration of the block."""
+        if stage not in self._stages:
+            raise KeyError(f"Unknown LLM stage '{stage}'")
+        stats = self._stats[stage]
+
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                stats.rejected_queue_full += 1
+                retry_after = self._retry_after(stage)
+                logger.warning(f"[{stage}] LLM queue full ({self._waiting} waiting); rejecting.")
+                raise AdmissionRejected("Sunucu şu anda çok yoğun. Lütfen biraz sonra tekrar deneyin.", 429, retry_after)
+            self._waiting += 1
+            stats.waiting += 1
+
+        started = time.monotonic()
+        deadline = started + self.queue_timeout
+        acquired_stage = acquired_global = False
+        try:
+            acquired_stage = self._stages[stage].acquire(timeout=self.queue_timeout)
+            if acquired_stage:
+                acquired_global = self._global.acquire(timeout=max(0.0, deadline - time.monotonic()))
+        finally:
+            waited = time.monotonic() - started
+            with self._lock:
+                self._waiting -= 1
+                stats.waiting -= 1
+                stats.waits.append(waited)
+                stats.total_wait += waited
+                stats.max_wait = max(stats.max_wait, waited)
+                if acquired_stage and acquired_global:
+                    stats.admitted += 1
+                    stats.in_use += 1
+                else:
+                    stats.rejected_timeout += 1
+
+        if not (acquired_stage and acquired_global):
+            if acquired_stage:
+                self._stages[stage].release()
+            logger.warning(f"[{stage}] No LLM slot within {self.queue_timeout}s; rejecting.")
+            with self._lock:
+                retry_after = self._retry_after(stage)
+            raise AdmissionRejected("Yapay zeka servisi şu anda yoğun. Lütfen biraz sonra tekrar deneyin.", 503, retry_after)
+
+        service_started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._global.release()
+            self._stages[stage].release()
+            with self._lock:
+                stats.in_use -= 1
+                stats.total_service += time.monotonic() - service_started
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {}
+            for stage, stats in self._stats.items():
+                waits = sorted(stats.waits)
+                stages[stage] = {
+                    "limit": self.stage_limits[stage],
+                    "in_use": stats.in_use,
+                    "queue_depth": stats.waiting,
+                    "admitted": stats.admitted,
+                    "rejected_queue_full": stats.rejected_queue_full,
+                    "rejected_timeout": stats.rejected_timeout,
+                    "wait_seconds_total": round(stats.total_wait, 4),
+                    "wait_seconds_avg": round(sum(waits) / len(waits), 4) if waits else 0.0,
+                    "wait_seconds_p95": round(waits[int(0.95 * (len(waits) - 1))], 4) if waits else 0.0,
+                    "wait_seconds_max": round(stats.max_wait, 4),
+                    "service_seconds_avg": round(stats.total_service / stats.admitted, 4) if stats.admitted else 0.0,
+                }
+            return {
+                "workers": WORKERS,
+                "global_limit": self.global_limit,
+                "global_in_use": sum(s.in_use for s in self._stats.values()),
+                "queue_depth": self._waiting,
+                "max_queue": self.max_queue,
+                "queue_timeout_seconds": self.queue_timeout,
+                "stages": stages,
+            }
+
+controller = AdmissionController(LLM_MAX_CONCURRENCY, LLM_STAGE_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT_SECONDS)
+
+def llm_slot(stage: str):
+    """Context manager guarding a single LLM call for the given stage ('parse', 'sql', 'summary')."""
+    return controller.slot(stage)
+
+def stats() -> Dict[str, Any]:
+    return controller.stats()
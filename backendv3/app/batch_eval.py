@@ -0,0 +1,161 @@
+# app/batch_eval.py
+"""
+Batch evaluation of offline query sets (POST /chat/batch and the CLI below).
+
+A batch is a list of {"session_id", "user_query"} items. Identical queries (after
+singleflight.normalize_query) are parsed once, and the unique queries are parsed in
+chunks of `max_concurrency` through the parser chain's `batch`, so Gemini sees
+concurrent calls instead of one after another. The rest of each turn then runs through
+process_chat_turn with the pre-parsed query: items of the same session in input order
+(each turn builds on the previous one), different sessions concurrently.
+
+Items without a session_id are one-turn sessions of their own. A session_id with stored
+history starts from that session's state; turns are only written back with persist=True.
+Results come back in input order with per-item stage timings.
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import database
+import parser
+import singleflight
+import usage_ledger
+from engine import process_chat_turn
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+def _parse_unique(queries: List[str], max_concurrency: int) -> Dict[str, Tuple[Dict[str, Any], float]]:
+    """Parsed query and the wall time of its parse chunk, keyed by normalised query text."""
+    unique: Dict[str, str] = {}
+    for query in queries:
+        unique.setdefault(singleflight.normalize_query(query), query)
+    keys = list(unique)
+    parsed: Dict[str, Tuple[Dict[str, Any], float]] = {}
+    for start in range(0, len(keys), max_concurrency):
+        chunk = keys[start:start + max_concurrency]
+        started = time.perf_counter()
+        results = parser.parse_user_queries([unique[key] for key in chunk], max_concurrency)
+        elapsed = round(time.perf_counter() - started, 6)
+        for key, result in zip(chunk, results):
+            parsed[key] = (result, elapsed)
+    return parsed
+
+def _run_session(session_id: str, stored: bool, items: List[Tuple[int, str]],
+                 parsed: Dict[str, Tuple[Dict[str, Any], float]], persist: bool) -> List[Tuple[int, Dict[str, Any]]]:
+    """Runs one session's turns in order; a failed turn leaves the state as it was."""
+    history = database.get_history_for_session(session_id) if stored else []
+    state = database.get_session_state(session_id) if history else {}
+    completed: List[Tuple[str, Dict[str, Any]]] = []
+    outcomes = []
+    for index, user_query in items:
+        parsed_query, parse_seconds = parsed[singleflight.normalize_query(user_query)]
+        turn = len(history) + 1
+        started = time.perf_counter()
+        item: Dict[str, Any] = {"index": index, "session_id": session_id, "turn": turn, "user_query": user_query}
+        try:
+            processed = usage_ledger.run_in_turn(
+                session_id, turn, process_chat_turn, user_query, state, history,
+                session_id=session_id, parsed=parsed_query,
+            )
+        except Exception as e:
+            logger.warning(f"Batch item {index} ({session_id}) failed: {e}")
+            item.update({"error": str(e), "timings": {"parse": parse_seconds,
+                                                      "total": round(time.perf_counter() - started, 6)}})
+            outcomes.append((index, item))
+            continue
+        state = processed["updated_session_state"]
+        history = history + [{"session_id": session_id, "turn": turn, "user_query": user_query}]
+        completed.append((user_query, state))
+        timings = {**processed["timings"], "parse": parse_seconds}
+        timings["total"] = round(time.perf_counter() - started + parse_seconds, 6)
+        item.update({
+            "response": processed["comment"],
+            "results": processed["results"],
+            "active_filters": state.get("filters", {}),
+            "inferred_assumptions": state.get("inferred", {}).get("assumptions", []),
+            "routing": processed.get("routing", []),
+            "timings": timings,
+        })
+        outcomes.append((index, item))
+    if persist and completed:
+        database.add_turns_to_history(session_id, completed)
+    return outcomes
+
+def run_batch(items: List[Dict[str, Any]], max_concurrency: int = BATCH_CONCURRENCY,
+              persist: bool = False) -> Dict[str, Any]:
+    """Runs every item and returns their outcomes in input order, plus batch totals."""
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch holds at most {BATCH_MAX_ITEMS} items, got {len(items)}.")
+    max_concurrency = max(1, max_concurrency)
+    started = time.perf_counter()
+
+    queries = [str(item.get("user_query") or "") for item in items]
+    parsed = _parse_unique(queries, max_concurrency)
+    parse_seconds = round(time.perf_counter() - started, 3)
+
+    sessions: Dict[str, List[Tuple[int, str]]] = {}
+    stored: Dict[str, bool] = {}
+    for index, (item, query) in enumerate(zip(items, queries)):
+        session_id = item.get("session_id")
+        key = session_id or f"batch-{uuid.uuid4()}"
+        sessions.setdefault(key, []).append((index, query))
+        stored[key] = bool(session_id)
+
+    outcomes: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch") as pool:
+        futures = [pool.submit(_run_session, key, stored[key], turns, parsed, persist)
+                   for key, turns in sessions.items()]
+        for future in futures:
+            for index, item in future.result():
+                outcomes[index] = item
+
+    report = {
+        "items": outcomes,
+        "count": len(items),
+        "unique_queries": len(parsed),
+        "sessions": len(sessions),
+        "errors": sum(1 for item in outcomes if item and "error" in item),
+        "max_concurrency": max_concurrency,
+        "parse_seconds": parse_seconds,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    logger.info(
+        f"Batch of {report['count']} items ({report['unique_queries']} unique queries, {report['sessions']} sessions) "
+        f"finished in {report['seconds']}s with {report['errors']} errors."
+    )
+    return report
+
+def _read_items(path: str) -> List[Dict[str, Any]]:
+    """Items from a JSON list or JSON lines; plain strings are one-turn queries."""
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    stripped = text.lstrip()
+    records = json.loads(text) if stripped.startswith("[") else [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [{"user_query": record} if isinstance(record, str) else record for record in records]
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description="Run an offline query set through the assistant.")
+    arg_parser.add_argument("items", help="JSON list or JSON lines of {session_id, user_query} items.")
+    arg_parser.add_argument("--output", help="Write the report here instead of stdout.")
+    arg_parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    arg_parser.add_argument("--persist", action="store_true", help="Store the turns in user_history.db.")
+    args = arg_parser.parse_args()
+    database.init_db()
+    result = json.dumps(run_batch(_read_items(args.items), args.concurrency, args.persist), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(result)
+    else:
+        print(result)
@@ -1,4 +1,5 @@
 from typing import List, Dict, Set
+from functools import lru_cache
 import sqlite3
 import re
 
@@ -145,9 +146,11 @@ FUZZY_BRAND_MAP = {
     "daewoo": "Daewoo",
 }
 
+@lru_cache(maxsize=1)
 def get_database_brands() -> Set[str]:
     """
     Get all unique brand names from the database.
+    The result is cached for the lifetime of the process.
     """
     try:
         # Use absolute path to database file
@@ -0,0 +1,194 @@
+# app/candidate_cache.py
+"""
+Per-session cache of the previous turn's candidate set, for incremental refinement.
+
+After each search turn the positions of every listing matching the session state are
+kept (as int32 inventory positions). When the next turn only narrows the state
+("otomatik olsun", "boyasız olsun"), its results are computed by filtering that set in
+memory instead of searching the whole inventory again. Any widening, a diversity
+search or a new inventory snapshot falls back to a full search.
+
+Storage is bounded by CANDIDATE_CACHE_MAX_BYTES across all sessions (least recently
+used sessions are evicted first). Each set is also written through to shared_cache, so
+the next turn of a session finds it when it lands on another server worker; inventory
+versions are per process, so those sets are matched on the snapshot fingerprint.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import inventory
+import shared_cache
+from query_builder import fetch_rows_by_ids
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CANDIDATE_CACHE_MAX_BYTES = int(os.getenv("CANDIDATE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CANDIDATE_CACHE_SHARED_TTL_SECONDS = int(os.getenv("CANDIDATE_CACHE_SHARED_TTL_SECONDS", "1800"))
+RESULT_LIMIT = 5
+
+UPPER_BOUNDS = ("fiyat_max", "age_max", "km_max")
+LOWER_BOUNDS = ("fiyat_min", "age_min", "km_min")
+LIST_FILTERS = ("yakit", "marka", "kasa_tipi", "model")
+REQUIRED_VALUES = ("vites", "boya_durumu", "parca_durumu")
+LIST_EXCLUSIONS = ("exclude_brands", "exclude_fuel_types", "exclude_colors")
+
+@dataclass
+class CandidateSet:
+    state: Dict[str, Any]           # filters + exclusions the candidates were computed for
+    positions: np.ndarray           # int32 inventory positions, ascending
+    inventory_version: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.positions.nbytes
+
+def _view(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {"filters": dict(state.get("filters", {}) or {}), "exclusions": dict(state.get("exclusions", {}) or {})}
+
+def _empty(value: Any) -> bool:
+    return value in (None, [], "", False)
+
+def is_refinement(old: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    """True when every listing matching `new` also matches `old` (the new state only narrows)."""
+    old_f, new_f = old["filters"], new["filters"]
+    old_x, new_x = old["exclusions"], new["exclusions"]
+
+    for key in UPPER_BOUNDS:
+        if old_f.get(key) is not None and (new_f.get(key) is None or new_f[key] > old_f[key]):
+            return False
+    for key in LOWER_BOUNDS:
+        if old_f.get(key) is not None and (new_f.get(key) is None or new_f[key] < old_f[key]):
+            return False
+    for key in LIST_FILTERS:
+        if not _empty(old_f.get(key)) and (_empty(new_f.get(key)) or not set(new_f[key]) <= set(old_f[key])):
+            return False
+    for key in REQUIRED_VALUES:
+        if not _empty(old_f.get(key)) and new_f.get(key) != old_f[key]:
+            return False
+    for key in LIST_EXCLUSIONS:
+        if not set(old_x.get(key) or []) <= set(new_x.get(key) or []):
+            return False
+    if old_x.get("sports_car_excluded") and not new_x.get("sports_car_excluded"):
+        return False
+    return True
+
+class CandidateCache:
+    def __init__(self, max_bytes: int = CANDIDATE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._sets: "OrderedDict[str, CandidateSet]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.refined = 0
+        self.full_searches = 0
+        self.widened = 0
+        self.evictions = 0
+        self.shared_hits = 0
+
+    def _put(self, session_id: str, candidates: CandidateSet):
+        with self._lock:
+            previous = self._sets.pop(session_id, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            if candidates.nbytes > self.max_bytes:
+                return
+            self._sets[session_id] = candidates
+            self._bytes += candidates.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._sets.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def _get(self, session_id: str, snapshot: inventory.Inventory) -> Optional[CandidateSet]:
+        with self._lock:
+            candidates = self._sets.get(session_id)
+            if candidates is not None:
+                self._sets.move_to_end(session_id)
+                return candidates
+        # The previous turn may have been served by another worker.
+        shared = shared_cache.get("candidates", session_id)
+        if shared is None:
+            return None
+        state, positions, fingerprint = shared
+        if fingerprint != snapshot.fingerprint:
+            return None
+        with self._lock:
+            self.shared_hits += 1
+        return CandidateSet(state, positions, snapshot.version)
+
+    def _share(self, session_id: str, candidates: CandidateSet, snapshot: inventory.Inventory):
+        shared_cache.put("candidates", session_id, (candidates.state, candidates.positions, snapshot.fingerprint),
+                         ttl_seconds=CANDIDATE_CACHE_SHARED_TTL_SECONDS)
+
+    def refine(self, session_id: Optional[str], state: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """Results for `state` filtered from the session's previous candidates, or None to run a full search."""
+        inferred = state.get("inferred", {})
+        # Diverse and best-value searches are not ordered newest first.
+        if not session_id or inferred.get("seek_diversity") or inferred.get("sort_by_value"):
+            return None
+        snapshot = inventory.get_inventory()
+        previous = self._get(session_id, snapshot)
+        new_view = _view(state)
+        if previous is None or previous.inventory_version != snapshot.version:
+            return None
+        if not is_refinement(previous.state, new_view):
+            with self._lock:
+                self.widened += 1
+            return None
+
+        subset = snapshot.subset(previous.positions)
+        positions = previous.positions[subset.mask_for(new_view)]
+        candidates = CandidateSet(new_view, positions, snapshot.version)
+        self._put(session_id, candidates)
+        self._share(session_id, candidates, snapshot)
+        with self._lock:
+            self.refined += 1
+        logger.info(f"Refined {len(previous.positions)} cached candidates to {len(positions)} for session {session_id}.")
+        # Same order as the compiled search: newest listings first.
+        return fetch_rows_by_ids(snapshot.ids[positions[::-1][:RESULT_LIMIT]].tolist())
+
+    def remember(self, session_id: Optional[str], state: Dict[str, Any]):
+        """Stores the full candidate set of a turn that ran a full search."""
+        if not session_id:
+            return
+        with self._lock:
+            self.full_searches += 1
+        if state.get("inferred", {}).get("seek_diversity"):
+            return
+        snapshot = inventory.get_inventory()
+        view = _view(state)
+        positions = np.flatnonzero(snapshot.mask_for(view)).astype(np.int32)
+        candidates = CandidateSet(view, positions, snapshot.version)
+        self._put(session_id, candidates)
+        self._share(session_id, candidates, snapshot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sets),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "refined_turns": self.refined,
+                "full_searches": self.full_searches,
+                "widened_fallbacks": self.widened,
+                "evictions": self.evictions,
+                "shared_hits": self.shared_hits,
+            }
+
+candidate_cache = CandidateCache()
+
+def refine(session_id: Optional[str], state: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    return candidate_cache.refine(session_id, state)
+
+def remember(session_id: Optional[str], state: Dict[str, Any]):
+    candidate_cache.remember(session_id, state)
+
+def stats() -> Dict[str, Any]:
+    return candidate_cache.stats()
@@ -0,0 +1,184 @@
+# app/chat_socket.py
+"""
+/ws/chat: a chat channel that keeps the session pinned to the connection.
+
+The session's merged state and its most recent turns are loaded once when the socket
+opens and updated in memory after every turn, so follow-up messages skip the history
+lookup and state rebuild that every POST /chat pays. Completed turns are buffered and
+written to user_history.db every WS_FLUSH_EVERY_TURNS turns and when the socket closes.
+
+Messages are JSON objects with a "type":
+  client -> {"type": "chat", "user_query": "..."}   starts a turn, cancelling the one in flight;
+                                                     an optional "fields" list projects result rows
+            {"type": "cancel"}                       cancels the turn in flight
+  server -> {"type": "session", "session_id", "turns", "active_filters"}
+            {"type": "parsed" | "results" | "summary_token", "turn", ...}   stage events
+            {"type": "done", "turn", "session_id", "response", "results", "active_filters", "inferred_assumptions"}
+            {"type": "cancelled" | "error", "turn", ...}
+A cancelled turn stops at its next stage boundary and never changes the session state.
+Result rows in "results" and "done" carry only the fields of listing_schema.Listing, or the
+requested subset, like every HTTP endpoint.
+"""
+
+import os
+import uuid
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+
+import database
+import listing_schema
+import prefetch
+import usage_ledger
+from admission import AdmissionRejected
+from engine import process_chat_turn, SearchExecutionError, TurnCancelled
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+WS_PINNED_TURNS = int(os.getenv("WS_PINNED_TURNS", "20"))
+WS_FLUSH_EVERY_TURNS = max(1, int(os.getenv("WS_FLUSH_EVERY_TURNS", "5")))
+
+class PinnedSession:
+    """A session's state and recent turns, held for the lifetime of one connection."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        history = database.get_history_for_session(session_id)
+        self.stored_turns = len(history)
+        self.state: Dict[str, Any] = database.get_session_state(session_id) if history else {}
+        self.history: List[Dict[str, Any]] = history[-WS_PINNED_TURNS:]
+        self.pending: List[Tuple[str, Dict[str, Any]]] = []
+
+    @property
+    def turn_count(self) -> int:
+        return self.stored_turns + len(self.pending)
+
+    def commit_turn(self, user_query: str, state: Dict[str, Any]):
+        self.pending.append((user_query, state))
+        self.state = state
+        self.history = (self.history + [
+            {"session_id": self.session_id, "turn": self.turn_count, "user_query": user_query}
+        ])[-WS_PINNED_TURNS:]
+
+    def flush(self):
+        """Writes the buffered turns to the history store."""
+        if not self.pending:
+            return
+        # Other requests may have stored turns of this session since the socket opened; the
+        # history store diffs against its own stored state and numbers the turns after them.
+        self.stored_turns = database.add_turns_to_history(self.session_id, self.pending)
+        self.pending = []
+
+async def _send_loop(websocket: WebSocket, outbox: asyncio.Queue):
+    while True:
+        message = await outbox.get()
+        try:
+            await websocket.send_json(message)
+        except Exception:
+            return  # The client is gone; the receive loop handles the disconnect.
+
+async def _run_turn(session: PinnedSession, user_query: str, projection: Tuple[str, ...],
+                    cancel: threading.Event, loop: asyncio.AbstractEventLoop, outbox: asyncio.Queue):
+    turn = session.turn_count + 1
+
+    def on_event(kind: str, payload: Dict[str, Any]):
+        # Called from the worker thread; events of a cancelled turn are dropped.
+        if not cancel.is_set():
+            if "results" in payload:
+                payload = {**payload, "results": listing_schema.project(payload["results"], projection)}
+            loop.call_soon_threadsafe(outbox.put_nowait, {"type": kind, "turn": turn, **payload})
+
+    try:
+        processed = await run_in_threadpool(
+            usage_ledger.run_in_turn, session.session_id, turn, process_chat_turn,
+            user_query, session.state, session.history,
+            session_id=session.session_id, on_event=on_event, cancel=cancel,
+        )
+    except TurnCancelled:
+        processed = None
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected websocket turn for session {session.session_id}: {e}")
+        await outbox.put({"type": "error", "turn": turn, "status_code": e.status_code,
+                          "detail": str(e), "retry_after": e.retry_after})
+        return
+    except SearchExecutionError as e:
+        logger.error(f"SearchExecutionError in session {session.session_id}: {e}")
+        await outbox.put({"type": "error", "turn": turn, "status_code": 500, "detail": str(e)})
+        return
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in websocket session {session.session_id}: {e}", exc_info=True)
+        await outbox.put({"type": "error", "turn": turn, "status_code": 500,
+                          "detail": "An unexpected internal error occurred."})
+        return
+
+    # A turn cancelled after its last stage boundary is discarded here.
+    if processed is None or cancel.is_set():
+        logger.info(f"Cancelled turn {turn} of session {session.session_id}.")
+        await outbox.put({"type": "cancelled", "turn": turn})
+        return
+
+    state = processed["updated_session_state"]
+    session.commit_turn(user_query, state)
+    await outbox.put({
+        "type": "done",
+        "turn": turn,
+        "session_id": session.session_id,
+        "response": processed["comment"],
+        "results": listing_schema.project(processed["results"], projection),
+        "active_filters": state.get("filters", {}),
+        "inferred_assumptions": state.get("inferred", {}).get("assumptions", []),
+    })
+    prefetch.schedule(session.session_id, state)
+    if len(session.pending) >= WS_FLUSH_EVERY_TURNS:
+        await run_in_threadpool(session.flush)
+
+async def serve(websocket: WebSocket, session_id: Optional[str] = None):
+    """Runs one /ws/chat connection until the client disconnects."""
+    await websocket.accept()
+    session = await run_in_threadpool(PinnedSession, session_id or str(uuid.uuid4()))
+    logger.info(f"Websocket opened for session {session.session_id} ({session.stored_turns} stored turns).")
+
+    loop = asyncio.get_running_loop()
+    outbox: asyncio.Queue = asyncio.Queue()
+    sender = asyncio.create_task(_send_loop(websocket, outbox))
+    running: Optional[Tuple[asyncio.Task, threading.Event]] = None
+    await outbox.put({"type": "session", "session_id": session.session_id, "turns": session.turn_count,
+                      "active_filters": session.state.get("filters", {})})
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError):
+                # Not JSON, or a binary frame: answer instead of tearing the socket down.
+                await outbox.put({"type": "error", "status_code": 400, "detail": "Messages must be JSON text frames."})
+                continue
+            kind = message.get("type", "chat") if isinstance(message, dict) else None
+            if kind not in ("chat", "cancel"):
+                await outbox.put({"type": "error", "status_code": 400, "detail": "type must be 'chat' or 'cancel'."})
+                continue
+            if running is not None and not running[0].done():
+                running[1].set()
+            if kind == "chat":
+                user_query = str(message.get("user_query") or "").strip()
+                if not user_query:
+                    await outbox.put({"type": "error", "status_code": 400, "detail": "user_query is required."})
+                    continue
+                try:
+                    projection = listing_schema.parse_fields(message.get("fields"))
+                except ValueError as e:
+                    await outbox.put({"type": "error", "status_code": 400, "detail": str(e)})
+                    continue
+                cancel = threading.Event()
+                running = (asyncio.create_task(_run_turn(session, user_query, projection, cancel, loop, outbox)), cancel)
+    except WebSocketDisconnect:
+        logger.info(f"Websocket closed for session {session.session_id}.")
+    finally:
+        if running is not None:
+            running[1].set()
+        sender.cancel()
+        await run_in_threadpool(session.flush)
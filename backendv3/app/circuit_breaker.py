@@ -0,0 +1,203 @@
+# app/circuit_breaker.py
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Every breaker starts forced open: all stages take their local path (benchmarks, offline runs).
+LLM_OFFLINE = os.getenv("LLM_OFFLINE", "0") == "1"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Per-stage circuit breaker for LLM calls.
+
+    Tracks the outcome of the last `window` calls. A call counts as bad when it raises
+    or takes longer than `slow_call_seconds`. Once at least `min_calls` outcomes are
+    recorded and the bad ratio reaches `failure_rate_threshold`, the breaker opens and
+    every call goes straight to the local fallback.
+
+    While open, a background thread runs `probe` every `cooldown_seconds` (backing off
+    up to `max_cooldown_seconds`) and closes the breaker on the first successful probe.
+    Without a probe, the breaker goes half-open after the cooldown and lets one real
+    call through to decide.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate_threshold: float = 0.5,
+                 slow_call_seconds: float = 15.0, cooldown_seconds: float = 15.0, max_cooldown_seconds: float = 120.0,
+                 probe: Optional[Callable[[], Any]] = None, ignored_exceptions: Tuple[Type[BaseException], ...] = ()):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.probe = probe
+        self.ignored_exceptions = ignored_exceptions
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)   # True = good call, False = failed or slow
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._half_open_in_flight = False
+        self._forced_open = False
+        self._prober: Optional[threading.Thread] = None
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.fallbacks = 0
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def force_open(self, forced: bool = True):
+        """Pins the breaker to its fallback (e.g. offline replays) until called with forced=False."""
+        with self._lock:
+            self._forced_open = forced
+        logger.info(f"[{self.name}] Circuit {'forced open' if forced else 'released'}.")
+
+    def call(self, fn: Callable[[], Any], fallback: Callable[[], Any]) -> Any:
+        """Runs fn() unless the breaker is open, in which case fallback() answers locally."""
+        if not self._allow_request():
+            with self._lock:
+                self.fallbacks += 1
+            logger.info(f"[{self.name}] Circuit open, serving local fallback.")
+            return fallback()
+
+        started = time.monotonic()
+        try:
+            result = fn()
+        except self.ignored_exceptions:
+            self._release_half_open()
+            raise
+        except Exception as e:
+            self._record(False, failed=True)
+            logger.warning(f"[{self.name}] Call failed ({e}); serving local fallback.")
+            with self._lock:
+                self.fallbacks += 1
+            return fallback()
+
+        elapsed = time.monotonic() - started
+        self._record(elapsed <= self.slow_call_seconds, failed=False)
+        return result
+
+    def _allow_request(self) -> bool:
+        with self._lock:
+            if self._forced_open:
+                return False
+            if self._state == CLOSED:
+                return True
+            if self.probe is None and not self._half_open_in_flight \
+                    and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+                # No background probe configured: let a single real call test the provider.
+                self._state = HALF_OPEN
+                self._half_open_in_flight = True
+                return True
+            return False
+
+    def _release_half_open(self):
+        with self._lock:
+            self._half_open_in_flight = False
+
+    def _record(self, good: bool, failed: bool):
+        with self._lock:
+            self.calls += 1
+            if failed:
+                self.failures += 1
+            elif not good:
+                self.slow_calls += 1
+
+            if self._state == HALF_OPEN:
+                self._half_open_in_flight = False
+                if good:
+                    self._close_locked()
+                else:
+                    self._state = OPEN
+                    self._opened_at = time.monotonic()
+                return
+
+            self._outcomes.append(good)
+            if self._state == CLOSED and len(self._outcomes) >= self.min_calls:
+                bad_ratio = self._outcomes.count(False) / len(self._outcomes)
+                if bad_ratio >= self.failure_rate_threshold:
+                    self._open_locked(bad_ratio)
+
+    def _open_locked(self, bad_ratio: float):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self.trips += 1
+        logger.error(f"[{self.name}] Circuit opened ({bad_ratio:.0%} failed or slow calls).")
+        if self.probe is not None and (self._prober is None or not self._prober.is_alive()):
+            self._prober = threading.Thread(target=self._probe_loop, name=f"{self.name}-probe", daemon=True)
+            self._prober.start()
+
+    def _close_locked(self):
+        self._state = CLOSED
+        self._outcomes.clear()
+        logger.info(f"[{self.name}] Circuit closed, provider recovered.")
+
+    def _probe_loop(self):
+        delay = self.cooldown_seconds
+        while True:
+            time.sleep(delay)
+            started = time.monotonic()
+            try:
+                self.probe()
+                healthy = time.monotonic() - started <= self.slow_call_seconds
+            except Exception as e:
+                logger.info(f"[{self.name}] Recovery probe failed: {e}")
+                healthy = False
+            if healthy:
+                with self._lock:
+                    self._close_locked()
+                return
+            delay = min(delay * 2, self.max_cooldown_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._state,
+                "forced_open": self._forced_open,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "fallbacks": self.fallbacks,
+                "trips": self.trips,
+                "window_bad_ratio": round(self._outcomes.count(False) / len(self._outcomes), 3) if self._outcomes else 0.0,
+            }
+
+# --- Registry ---
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name: str, **config) -> CircuitBreaker:
+    """Returns the named breaker, creating it with the given config on first use."""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **config)
+            if LLM_OFFLINE:
+                _breakers[name].force_open()
+        return _breakers[name]
+
+def force_open_all(forced: bool = True):
+    """Forces every registered breaker onto its local fallback (or releases them)."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    for breaker in breakers:
+        breaker.force_open(forced)
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.stats() for breaker in breakers}
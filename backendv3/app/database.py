@@ -4,7 +4,9 @@ import sqlite3
 import json
 import logging
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+
+from state_delta import diff_state, apply_delta
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -12,9 +14,14 @@ logger = logging.getLogger(__name__)
 # Database file path - use absolute path to avoid issues
 DB_PATH = os.path.join(os.path.dirname(__file__), "user_history.db")
 
+# Every Nth turn of a session stores the full state; the turns in between store a delta
+# against the previous turn, so reading a session replays at most N - 1 deltas.
+STATE_SNAPSHOT_EVERY = max(1, int(os.getenv("STATE_SNAPSHOT_EVERY", "10")))
+
 def get_db_connection():
     """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_PATH)
+    # Several worker processes write here; wait for the lock instead of failing.
+    conn = sqlite3.connect(DB_PATH, timeout=10)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -25,6 +32,8 @@ def init_db():
     """
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        # WAL lets the workers of a multi-process server read while another one writes.
+        cursor.execute("PRAGMA journal_mode = WAL")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS conversation_history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -35,40 +44,84 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        columns = {row["name"] for row in cursor.execute("PRAGMA table_info(conversation_history)")}
+        if "state_kind" not in columns:
+            # Rows written before delta storage hold full states.
+            cursor.execute("ALTER TABLE conversation_history ADD COLUMN state_kind TEXT NOT NULL DEFAULT 'snapshot'")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_history_session_turn ON conversation_history (session_id, turn)")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT,
+                turn INTEGER,
+                stage TEXT NOT NULL,
+                model TEXT,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                latency_ms INTEGER NOT NULL DEFAULT 0,
+                retries INTEGER NOT NULL DEFAULT 0,
+                error INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_created_at ON llm_usage (created_at)")
         conn.commit()
-        logger.info("Database initialized and 'conversation_history' table is ready.")
+        logger.info("Database initialized and 'conversation_history' / 'llm_usage' tables are ready.")
 
-def add_turn_to_history(session_id: str, user_query: str, filters_state: Dict[str, Any]):
+def add_turn_to_history(session_id: str, user_query: str, filters_state: Dict[str, Any]) -> int:
     """
     Adds a new turn to a session's conversation history.
+    Only the delta against the session's stored state is kept, except on every
+    STATE_SNAPSHOT_EVERY-th turn (and a session's first turn), which stores the full state.
+    Returns the turn number the turn was stored under.
+    """
+    return add_turns_to_history(session_id, [(user_query, filters_state)])
+
+def add_turns_to_history(session_id: str, turns: List[Tuple[str, Dict[str, Any]]]) -> int:
+    """
+    Adds several consecutive (user_query, state) turns in one transaction, each stored
+    like add_turn_to_history does. Returns the turn number of the last one.
+
+    The first delta base is the state rebuilt from the stored rows inside the write
+    transaction, not the state the caller started from, so turns written in between by
+    another request or connection for the same session cannot corrupt the rebuilt state.
     """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Get the next turn number
-        cursor.execute("SELECT COALESCE(MAX(turn), 0) + 1 FROM conversation_history WHERE session_id = ?", (session_id,))
-        next_turn = cursor.fetchone()[0]
+        # Take the write lock before reading the stored tail so writers of a session serialise.
+        cursor.execute("BEGIN IMMEDIATE")
+        tail = _stored_tail(conn, session_id)
+        states = replay_states((row["state_kind"], row["filters_json"]) for row in tail)
+        previous_state = states[-1] if states else None
+        next_turn = tail[-1]["turn"] + 1 if tail else 1
 
-        # Convert the filters dictionary to a JSON string for storage
-        filters_json = json.dumps(filters_state)
-        
-        cursor.execute("""
-            INSERT INTO conversation_history (session_id, turn, user_query, filters_json)
-            VALUES (?, ?, ?, ?)
-        """, (session_id, next_turn, user_query, filters_json))
+        for user_query, filters_state in turns:
+            if previous_state is not None and (next_turn - 1) % STATE_SNAPSHOT_EVERY != 0:
+                state_kind, payload = "delta", diff_state(previous_state, filters_state)
+            else:
+                state_kind, payload = "snapshot", filters_state
+            filters_json = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+            
+            cursor.execute("""
+                INSERT INTO conversation_history (session_id, turn, user_query, filters_json, state_kind)
+                VALUES (?, ?, ?, ?, ?)
+            """, (session_id, next_turn, user_query, filters_json, state_kind))
+            logger.info(f"Saved turn {next_turn} for session {session_id} ({state_kind}, {len(filters_json)} bytes).")
+            previous_state, next_turn = filters_state, next_turn + 1
         
         conn.commit()
-        logger.info(f"Saved turn {next_turn} for session {session_id}.")
+        return next_turn - 1
 
 def get_history_for_session(session_id: str) -> List[Dict[str, Any]]:
     """
     Retrieves the entire conversation history for a given session,
-    ordered by the turn number.
+    ordered by the turn number. States are not included; see get_session_state.
     """
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT session_id, turn, user_query, filters_json, created_at
+            SELECT session_id, turn, user_query, created_at
             FROM conversation_history
             WHERE session_id = ?
             ORDER BY turn ASC
@@ -78,4 +131,105 @@ def get_history_for_session(session_id: str) -> List[Dict[str, Any]]:
         # Convert sqlite3.Row objects to standard dictionaries
         history = [dict(row) for row in rows]
         logger.info(f"Retrieved {len(history)} turns for session {session_id}.")
-        return history
\ No newline at end of file
+        return history
+
+def replay_states(rows) -> List[Dict[str, Any]]:
+    """
+    Rebuilds the state after each turn from (state_kind, filters_json) rows in turn order.
+    The first row must be a snapshot; consecutive states share the sections a delta left unchanged.
+    """
+    states, state = [], {}
+    for state_kind, filters_json in rows:
+        payload = json.loads(filters_json)
+        state = payload if state_kind == "snapshot" else apply_delta(state, payload)
+        states.append(state)
+    return states
+
+def _stored_tail(conn: sqlite3.Connection, session_id: str) -> List[sqlite3.Row]:
+    """A session's rows from its latest snapshot on, in turn order: enough to rebuild its state."""
+    return conn.execute("""
+        SELECT turn, state_kind, filters_json
+        FROM conversation_history
+        WHERE session_id = ?
+          AND turn >= (SELECT COALESCE(MAX(turn), 0) FROM conversation_history
+                       WHERE session_id = ? AND state_kind = 'snapshot')
+        ORDER BY turn ASC
+    """, (session_id, session_id)).fetchall()
+
+def get_session_state(session_id: str) -> Dict[str, Any]:
+    """
+    The session state after its latest turn: the latest snapshot plus the deltas after it,
+    or an empty state for a new session.
+    """
+    with get_db_connection() as conn:
+        rows = _stored_tail(conn, session_id)
+    states = replay_states((row["state_kind"], row["filters_json"]) for row in rows)
+    return states[-1] if states else {}
+
+def get_session_states(session_id: str) -> List[Dict[str, Any]]:
+    """
+    The state after every turn of a session, in turn order (for exports and analysis).
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute("""
+            SELECT state_kind, filters_json FROM conversation_history
+            WHERE session_id = ? ORDER BY turn ASC
+        """, (session_id,)).fetchall()
+    return replay_states(rows)
+
+# --- LLM Usage Ledger ---
+
+# Columns that /usage may group by, mapped to their SQL expressions.
+USAGE_GROUP_COLUMNS = {
+    "stage": "stage",
+    "model": "model",
+    "hour": "strftime('%Y-%m-%d %H:00', created_at)",
+    "session_id": "session_id",
+}
+
+def add_llm_usage(record: Dict[str, Any]):
+    """
+    Stores the token usage of a single LLM call.
+    """
+    with get_db_connection() as conn:
+        conn.execute("""
+            INSERT INTO llm_usage (session_id, turn, stage, model, prompt_tokens, completion_tokens,
+                                   latency_ms, retries, error, cost_usd)
+            VALUES (:session_id, :turn, :stage, :model, :prompt_tokens, :completion_tokens,
+                    :latency_ms, :retries, :error, :cost_usd)
+        """, record)
+        conn.commit()
+
+def aggregate_llm_usage(group_by: List[str], since_hours: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Aggregates the usage ledger by any combination of stage, model, hour and session_id.
+    """
+    unknown = [g for g in group_by if g not in USAGE_GROUP_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unsupported group_by column(s): {', '.join(unknown)}")
+
+    select_groups = ", ".join(f"{USAGE_GROUP_COLUMNS[g]} AS {g}" for g in group_by)
+    where, params = "", []
+    if since_hours is not None:
+        where = "WHERE created_at >= datetime('now', ?)"
+        params.append(f"-{int(since_hours)} hours")
+
+    query = f"""
+        SELECT {select_groups + ',' if select_groups else ''}
+               COUNT(*) AS calls,
+               SUM(prompt_tokens) AS prompt_tokens,
+               SUM(completion_tokens) AS completion_tokens,
+               SUM(prompt_tokens + completion_tokens) AS total_tokens,
+               MAX(prompt_tokens) AS max_prompt_tokens,
+               ROUND(SUM(cost_usd), 6) AS cost_usd,
+               ROUND(AVG(latency_ms)) AS avg_latency_ms,
+               MAX(latency_ms) AS max_latency_ms,
+               SUM(retries) AS retries,
+               SUM(error) AS errors
+        FROM llm_usage
+        {where}
+        {'GROUP BY ' + ', '.join(group_by) if group_by else ''}
+        ORDER BY {', '.join(group_by) if group_by else 'calls'}
+    """
+    with get_db_connection() as conn:
+        return [dict(row) for row in conn.execute(query, params).fetchall()]
@@ -0,0 +1,291 @@
+# app/dedup.py
+"""
+Duplicate and relisted-listing detection.
+
+Sellers relist the same car under a new link, and the crawler also meets the same link
+again on later pages; every copy used to be a separate row. Listings are blocked by
+(marka, seri, yil) and, within a block, compared pairwise with vectorised similarities:
+mileage, price, colour and the model text (hashed character trigrams, cosine). Pairs of
+the same colour and trim scoring at least DEDUP_THRESHOLD, or sharing a link, are
+clustered (union-find) and each cluster keeps one canonical listing, the most recent one
+(highest id, the live link).
+Every other member gets `duplicate_of = <canonical id>`; canonical rows keep NULL.
+
+Searches (compiled SQL, inventory masks, similar listings, market rollups) only serve
+canonical rows. `refresh()` re-clusters only the blocks of listings added since the last
+run (id watermark in `dedup_meta`) and is called by the crawler after each insert and by
+warm-up; `rebuild()` re-clusters everything. Each refresh reports the dedup ratio of the
+listings it added, and `crawl_report()` the ratio of a whole crawl.
+
+Market rollups count canonical rows only, so whenever a run changes the assignments of
+existing rows, the market rollups and deal scores of the affected series are recomputed
+(market.recompute_series); market.refresh() alone only covers listings above its watermark.
+"""
+
+import os
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import market
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "araba_verileri.db")
+TABLE_NAME = "araba_ilanlari"
+
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+# Mileage and price differences at which those similarities reach 0.
+KM_SCALE = float(os.getenv("DEDUP_KM_SCALE", "5000"))
+PRICE_SCALE = float(os.getenv("DEDUP_PRICE_SCALE", "0.15"))     # Fraction of the higher price
+# Weights of the similarities in the pair score (sum to 1).
+WEIGHTS = {"km": 0.35, "price": 0.25, "color": 0.15, "model": 0.25}
+# Trims below this model-text similarity ("320i M Plus" / "320i Techno Plus") are different cars.
+MIN_MODEL_SIMILARITY = float(os.getenv("DEDUP_MIN_MODEL_SIMILARITY", "0.85"))
+TRIGRAM_DIM = 256
+
+_lock = threading.Lock()
+_stats: Dict[str, Any] = {"last_refresh": None, "refreshes": 0, "blocks_clustered": 0}
+
+# --- Schema ---
+
+def ensure_schema(conn: sqlite3.Connection) -> bool:
+    """Adds the indexed duplicate_of column and the watermark table; True if anything was added."""
+    changed = False
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+    if "duplicate_of" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN duplicate_of INTEGER")
+        changed = True
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_duplicate_of ON {TABLE_NAME}("duplicate_of")')
+    conn.execute("CREATE TABLE IF NOT EXISTS dedup_meta (key TEXT PRIMARY KEY, value INTEGER)")
+    return changed
+
+# --- Vectorised similarity ---
+
+def _km_number(value: Any) -> float:
+    """'69.000 km' -> 69000 (see query_builder.KM_EXPR); NaN when unreadable."""
+    try:
+        if isinstance(value, str):
+            return float(value.replace(".", "").replace(" km", "").strip())
+        return float(value) if value is not None else np.nan
+    except ValueError:
+        return np.nan
+
+def _trigram_vectors(texts: List[str]) -> np.ndarray:
+    """L2-normalised hashed character-trigram counts, one row per text."""
+    vectors = np.zeros((len(texts), TRIGRAM_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        padded = f"  {' '.join((text or '').lower().split())} "
+        for i in range(len(padded) - 2):
+            vectors[row, zlib.crc32(padded[i:i + 3].encode("utf-8")) % TRIGRAM_DIM] += 1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+def pair_scores(km: np.ndarray, price: np.ndarray, color: np.ndarray, model: List[str]) -> np.ndarray:
+    """n x n weighted similarity of the listings of one block (NaN km / price count as dissimilar)."""
+    with np.errstate(invalid="ignore"):
+        km_sim = np.clip(1 - np.abs(km[:, None] - km[None, :]) / KM_SCALE, 0, 1)
+        higher = np.maximum(price[:, None], price[None, :])
+        price_sim = np.clip(1 - np.abs(price[:, None] - price[None, :]) / (PRICE_SCALE * higher), 0, 1)
+    known = color != ""
+    color_sim = np.where(known[:, None] & known[None, :], (color[:, None] == color[None, :]).astype(float), 0.5)
+    vectors = _trigram_vectors(model)
+    model_sim = vectors @ vectors.T
+    score = (WEIGHTS["km"] * np.nan_to_num(km_sim) + WEIGHTS["price"] * np.nan_to_num(price_sim)
+             + WEIGHTS["color"] * color_sim + WEIGHTS["model"] * model_sim)
+    # Different known colours or trims are never the same car.
+    return np.where((color_sim == 0) | (model_sim < MIN_MODEL_SIMILARITY), 0.0, score)
+
+def cluster_block(rows: List[Tuple]) -> Dict[int, Optional[int]]:
+    """duplicate_of for every listing of one block: (id, link, km, fiyat, renk, model) rows."""
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    links = np.array([row[1] or "" for row in rows], dtype=object)
+    km = np.array([_km_number(row[2]) for row in rows], dtype=float)
+    price = np.array([row[3] if row[3] is not None else np.nan for row in rows], dtype=float)
+    color = np.array([(row[4] or "").strip().lower() for row in rows], dtype=object)
+    same = (pair_scores(km, price, color, [row[5] or "" for row in rows]) >= DEDUP_THRESHOLD)
+    same |= (links[:, None] == links[None, :]) & (links[:, None] != "")
+
+    parent = list(range(len(rows)))
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(*np.nonzero(np.triu(same, k=1))):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            # The root is the member with the highest id: the canonical listing.
+            parent[min(root_i, root_j, key=lambda k: ids[k])] = max(root_i, root_j, key=lambda k: ids[k])
+    return {int(ids[i]): (None if find(i) == i else int(ids[find(i)])) for i in range(len(rows))}
+
+# --- Persistence ---
+
+def _recompute(conn: sqlite3.Connection, blocks: Optional[List[Tuple[str, str, int]]]
+               ) -> Tuple[int, Dict[int, Optional[int]], List[Tuple[str, str]]]:
+    """
+    Re-clusters the given (marka, seri, yil) blocks (all when None); returns the block count,
+    the assignments and the (marka, seri) series whose assignments changed.
+    """
+    sql = f'SELECT "marka", "seri", "yil", "id", "link", "km", "fiyat", "renk", "model" FROM {TABLE_NAME}'
+    params: List[Any] = []
+    if blocks is not None:
+        sql += """ WHERE ("marka", "seri", "yil") IN (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')
+            FROM json_each(?))"""
+        params.append(json.dumps(blocks, ensure_ascii=False))
+    grouped: Dict[Tuple, List[Tuple]] = {}
+    series_of: Dict[int, Tuple[str, str]] = {}
+    for row in conn.execute(sql, params):
+        grouped.setdefault(row[:3], []).append(row[3:])
+        series_of[row[3]] = (row[0], row[1])
+
+    assignments: Dict[int, Optional[int]] = {}
+    for rows in grouped.values():
+        assignments.update(cluster_block(rows))
+    current = dict(conn.execute(
+        f'SELECT "id", "duplicate_of" FROM {TABLE_NAME} WHERE "id" IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(assignments)),),
+    ).fetchall())
+    changed = [(target, listing_id) for listing_id, target in assignments.items() if current.get(listing_id) != target]
+    conn.executemany(f'UPDATE {TABLE_NAME} SET "duplicate_of" = ? WHERE "id" = ?', changed)
+    changed_series = sorted({series_of[listing_id] for _, listing_id in changed
+                             if series_of[listing_id][0] is not None and series_of[listing_id][1] is not None})
+    return len(grouped), assignments, changed_series
+
+def _watermark(conn: sqlite3.Connection) -> Optional[int]:
+    row = conn.execute("SELECT value FROM dedup_meta WHERE key = 'last_listing_id'").fetchone()
+    return row[0] if row else None
+
+def _set_watermark(conn: sqlite3.Connection):
+    conn.execute(
+        f"INSERT OR REPLACE INTO dedup_meta (key, value) SELECT 'last_listing_id', COALESCE(MAX(\"id\"), 0) FROM {TABLE_NAME}"
+    )
+
+def _connect(db_path: Optional[str]) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path or DB_PATH, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+def _update_market(changed_series: List[Tuple[str, str]], db_path: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Recomputes the market rollups of series whose listings were relinked; failures are logged."""
+    if not changed_series:
+        return None
+    try:
+        return market.recompute_series(changed_series, db_path)
+    except Exception as e:
+        logger.warning(f"Market rollups of {len(changed_series)} relinked series not recomputed: {e}")
+        return None
+
+def _finish(kind: str, block_count: int, new_ids: List[int], assignments: Dict[int, Optional[int]],
+            started: float, changed_series: List[Tuple[str, str]] = (),
+            market_report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    duplicates = sum(1 for listing_id in new_ids if assignments.get(listing_id) is not None)
+    report = {
+        "kind": kind,
+        "blocks_clustered": block_count,
+        "listings": len(new_ids),
+        "duplicates": duplicates,
+        "dedup_ratio": round(duplicates / len(new_ids), 4) if new_ids else None,
+        "series_relinked": len(changed_series),
+        "market": market_report,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    with _lock:
+        _stats["last_refresh"] = report
+        _stats["refreshes"] += 1
+        _stats["blocks_clustered"] += block_count
+    logger.info(f"Dedup {kind}: {duplicates} of {len(new_ids)} listings are duplicates "
+                f"({block_count} blocks in {report['seconds']}s).")
+    return report
+
+def rebuild(db_path: Optional[str] = None) -> Dict[str, Any]:
+    """Re-clusters every block."""
+    started = time.perf_counter()
+    with closing(_connect(db_path)) as conn:
+        ensure_schema(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            block_count, assignments, changed_series = _recompute(conn, None)
+            _set_watermark(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    market_report = _update_market(changed_series, db_path)
+    return _finish("rebuild", block_count, list(assignments), assignments, started, changed_series, market_report)
+
+def refresh(db_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Re-clusters only the blocks of listings added since the last refresh; the report covers
+    those listings. The first call on a database without the column is a full rebuild.
+    """
+    started = time.perf_counter()
+    with closing(_connect(db_path)) as conn:
+        ensure_schema(conn)
+        watermark = _watermark(conn)
+        if watermark is None:
+            return rebuild(db_path)
+        new_rows = conn.execute(f'SELECT "id", "marka", "seri", "yil" FROM {TABLE_NAME} WHERE "id" > ?',
+                                (watermark,)).fetchall()
+        # Nothing new: skip the write, which would also invalidate every process's inventory snapshot.
+        if not new_rows:
+            return _finish("refresh", 0, [], {}, started)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            blocks = sorted({tuple(row[1:]) for row in new_rows})
+            block_count, assignments, changed_series = _recompute(conn, blocks)
+            _set_watermark(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    market_report = _update_market(changed_series, db_path)
+    return _finish("refresh", block_count, [row[0] for row in new_rows], assignments, started,
+                   changed_series, market_report)
+
+def last_listing_id(db_path: Optional[str] = None) -> int:
+    """Highest listing id; a crawl passes it to crawl_report() at the end."""
+    with closing(_connect(db_path)) as conn:
+        return conn.execute(f'SELECT COALESCE(MAX("id"), 0) FROM {TABLE_NAME}').fetchone()[0]
+
+def crawl_report(since_id: int, db_path: Optional[str] = None) -> Dict[str, Any]:
+    """Dedup ratio of the listings added after `since_id`, e.g. by one crawl."""
+    with closing(_connect(db_path)) as conn:
+        listings, duplicates = conn.execute(
+            f'SELECT COUNT(*), COUNT("duplicate_of") FROM {TABLE_NAME} WHERE "id" > ?', (since_id,)
+        ).fetchone()
+    return {"listings": listings, "duplicates": duplicates,
+            "dedup_ratio": round(duplicates / listings, 4) if listings else None}
+
+# --- Reporting ---
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        report = dict(_stats)
+    try:
+        with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)) as conn:
+            total, duplicates = conn.execute(f'SELECT COUNT(*), COUNT("duplicate_of") FROM {TABLE_NAME}').fetchone()
+        report.update({"listings": total, "duplicates": duplicates,
+                       "dedup_ratio": round(duplicates / total, 4) if total else None})
+    except sqlite3.Error:
+        report.update({"listings": None, "duplicates": None, "dedup_ratio": None})
+    return report
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description="Cluster duplicate and relisted listings.")
+    arg_parser.add_argument("--full", action="store_true", help="Re-cluster every block instead of only new listings.")
+    arg_parser.add_argument("--db", help="Path to the listings database.")
+    args = arg_parser.parse_args()
+    result = rebuild(args.db) if args.full else refresh(args.db)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
@@ -1,13 +1,29 @@
 # app/engine.py
 
+import time
 import logging
-from typing import List, Dict, Any
-from copy import deepcopy
+import sqlite3
+import threading
+from contextvars import ContextVar
+from typing import List, Dict, Any, Optional, Callable
 
 from parser import parse_user_query
 import langchain_agent
+import singleflight
+import circuit_breaker
+import query_builder
+import plan_cache
+import usage_ledger
+import inventory
+import relaxation
+import text_index
+import candidate_cache
+import prefetch
+import model_router
+import market
+import listing_schema
+from admission import llm_slot, AdmissionRejected
 from brand_mapping import map_region_to_brands, map_brands_list
-from langchain_core.prompts import ChatPromptTemplate
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -17,53 +33,243 @@ class SearchExecutionError(Exception):
     """Custom exception for errors during the search process."""
     pass
 
+class TurnCancelled(Exception):
+    """Raised between stages when the caller cancelled the turn (e.g. the user typed again)."""
+    pass
+
+# Receives summary text chunks as they are generated, for the turn running in this context.
+_summary_token_sink: ContextVar[Optional[Callable[[str], None]]] = ContextVar("summary_token_sink", default=None)
+
+# --- Request Coalescing ---
+# Identical concurrent requests (e.g. the same opening query from a campaign burst)
+# share one in-flight LLM call per stage instead of each issuing their own.
+_parse_flight = singleflight.get_group("parse")
+_search_flight = singleflight.get_group("search")
+_summary_flight = singleflight.get_group("summary")
+
+def parse_query_coalesced(user_query: str) -> Dict[str, Any]:
+    """parse_user_query behind single-flight, keyed by the normalised query text."""
+    key = singleflight.normalize_query(user_query)
+    parsed, _ = _parse_flight.do(key, lambda: parse_user_query(user_query))
+    # Shared by every coalesced caller: merge_filters and promote_model_entities never modify it.
+    return parsed
+
+def run_search_coalesced(task: str, constraints: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The SQL agent search behind single-flight, keyed by task and constraints."""
+    key = singleflight.canonical_key(task, constraints)
+    results, _ = _search_flight.do(key, lambda: run_search(task, constraints))
+    return list(results)
+
+def summarize_coalesced(kind: str, key_parts: tuple, fn) -> str:
+    """Summary / chit-chat generation behind single-flight, keyed by everything that goes into the prompt."""
+    comment, _ = _summary_flight.do(singleflight.canonical_key(kind, *key_parts), fn)
+    return comment
+
+# --- Circuit Breakers ---
+# Each Gemini-dependent stage degrades to a local path while the provider is failing or slow:
+# parsing -> rule-based parser (see parser.py), SQL generation -> compiled SQL, summaries -> templates.
+def _probe_llm(stage: str):
+    with llm_slot(stage):
+        langchain_agent.get_llm().invoke("ping")
+
+_sql_breaker = circuit_breaker.get_breaker(
+    "sql", slow_call_seconds=20.0, probe=lambda: _probe_llm("sql"), ignored_exceptions=(AdmissionRejected,)
+)
+_summary_breaker = circuit_breaker.get_breaker(
+    "summary", slow_call_seconds=10.0, probe=lambda: _probe_llm("summary"), ignored_exceptions=(AdmissionRejected,)
+)
+
+def promote_model_entities(parsed: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Uses model mentions the parser only reported as raw entities as a model filter, if the index knows them.
+    Returns a new dict when a filter is added; `parsed` itself is not modified.
+    """
+    filters = parsed.get("filters") or {}
+    models = (parsed.get("raw_entities") or {}).get("models") or []
+    if filters.get("model") or not models:
+        return parsed
+    index = text_index.get_index()
+    known = [term for term in models if index.mask_for_terms([term]).any()]
+    if not known:
+        return parsed
+    return {**parsed, "filters": {**filters, "model": known}}
+
+def _canonical_rows(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drops relisted copies (see dedup.py) from agent SQL that left out the duplicate_of filter."""
+    return [row for row in rows if row.get("duplicate_of") is None]
+
+def run_search(task: str, constraints: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Runs a cached SQL plan for this constraint shape if there is one; otherwise the SQL agent
+    (recording its SQL as a new plan), or the compiled SQL query while the agent's circuit is open.
+    Model / trim searches are answered from the model index through the compiled query, and
+    so are best-value searches, which sort on the precomputed deal_score (see market.py).
+    The agent's model is picked by model_router, which may also skip it for the compiled query.
+    """
+    seek_diversity = constraints.get("inferred", {}).get("seek_diversity", False)
+    if constraints.get("inferred", {}).get("sort_by_value"):
+        return query_builder.run_compiled_search(constraints, seek_diversity=seek_diversity, order_by_value=True)
+    if constraints.get("filters", {}).get("model"):
+        return query_builder.run_compiled_search(constraints, seek_diversity=seek_diversity)
+    cached_rows = plan_cache.execute(constraints, seek_diversity)
+    if cached_rows is not None:
+        return _canonical_rows(cached_rows)
+
+    route = model_router.route_sql(constraints)
+    if route is not None and route.tier == "skip":
+        return query_builder.run_compiled_search(constraints, seek_diversity=seek_diversity)
+
+    def agent_search() -> List[Dict[str, Any]]:
+        outcome = langchain_agent.run_sql_agent(task, constraints)
+        if outcome.sql:
+            plan_cache.record(outcome.sql, constraints, seek_diversity)
+        return _canonical_rows(outcome.rows)
+
+    with model_router.routed(route):
+        return _sql_breaker.call(
+            agent_search,
+            lambda: query_builder.run_compiled_search(constraints, seek_diversity=seek_diversity),
+        )
+
+def relax_empty_search(state: Dict[str, Any]):
+    """
+    For a search with no results, applies the cheapest relaxation that has matches and runs it
+    with the compiled query. Returns (relaxed_state, rows, plan) or None if nothing helps.
+    """
+    plan = relaxation.plan_relaxation(inventory.get_inventory(), state)
+    if plan is None:
+        return None
+    relaxed_state = plan.apply(state)
+    inferred = relaxed_state.get("inferred", {})
+    rows = query_builder.run_compiled_search(
+        relaxed_state, seek_diversity=inferred.get("seek_diversity", False),
+        order_by_value=inferred.get("sort_by_value", False),
+    )
+    return (relaxed_state, rows, plan) if rows else None
+
+def _format_tl(value: Any) -> str:
+    return f"{int(value):,}".replace(",", ".") + " TL"
+
+def _describe_filters(filters: Dict[str, Any]) -> str:
+    return ", ".join(f"{key}: {value}" for key, value in (filters or {}).items() if value not in (None, []))
+
+def template_summary_comment(db_rows: List[Dict]) -> str:
+    """Deterministic summary used when the summary LLM is unavailable."""
+    prices = [row["fiyat"] for row in db_rows if row.get("fiyat")]
+    years = [row["yil"] for row in db_rows if isinstance(row.get("yil"), int)]
+    parts = [f"Kriterlerinize uyan {len(db_rows)} araç buldum."]
+    if prices:
+        parts.append(f"Fiyatlar {_format_tl(min(prices))} ile {_format_tl(max(prices))} arasında.")
+        cheapest = min((row for row in db_rows if row.get("fiyat")), key=lambda row: row["fiyat"])
+        parts.append(
+            f"En uygun fiyatlısı {cheapest.get('yil')} model {cheapest.get('marka')} {cheapest.get('seri')} "
+            f"({_format_tl(cheapest['fiyat'])})."
+        )
+    if years:
+        parts.append(f"Model yılları {min(years)} ile {max(years)} arasında değişiyor.")
+    deals = [row for row in db_rows if (row.get("deal_score") or 0) >= market.GOOD_DEAL_THRESHOLD]
+    if deals:
+        best = max(deals, key=lambda row: row["deal_score"])
+        parts.append(
+            f"{best.get('yil')} model {best.get('marka')} {best.get('seri')}, benzer ilanların medyan fiyatının "
+            f"%{round(best['deal_score'] * 100)} altında."
+        )
+    parts.append("Aramayı daraltmak isterseniz vites, yakıt tipi veya kilometre tercihinizi yazabilirsiniz.")
+    return " ".join(parts)
+
+def template_conversation() -> str:
+    return ("Size ikinci el araç aramanızda yardımcı olabilirim. Bütçenizi, tercih ettiğiniz markayı "
+            "veya vites ve yakıt tipini yazarsanız uygun ilanları hemen bulayım.")
+
+def template_didnt_find(final_filters: Any) -> str:
+    described = _describe_filters(final_filters) if isinstance(final_filters, dict) else str(final_filters)
+    return (f"Bu kriterlere uyan bir araç bulamadım ({described}). Bütçeyi biraz artırmayı veya yıl, "
+            "kilometre gibi bazı filtreleri gevşetmeyi deneyebilirsiniz.")
+
+def _invoke_summary_chain(prompt, inputs: Dict[str, Any], fallback) -> str:
+    if model_router.skipped("summary"):
+        return fallback()
+    model = model_router.model_for("summary")
+
+    def call() -> str:
+        # Built inside the guarded call so an open breaker never constructs the LLM client.
+        chain = prompt | langchain_agent.get_llm(model)
+        config = {"callbacks": usage_ledger.callbacks_for("summary")}
+        sink = _summary_token_sink.get()
+        with llm_slot("summary"):
+            started = time.perf_counter()
+            if sink is None:
+                comment = chain.invoke(inputs, config=config).content
+            else:
+                parts = []
+                for chunk in chain.stream(inputs, config=config):
+                    parts.append(chunk.content)
+                    sink(chunk.content)
+                comment = "".join(parts)
+            model_router.observe("summary", model or langchain_agent.LLM_MODEL, time.perf_counter() - started)
+            return comment
+
+    return _summary_breaker.call(call, fallback)
+
 def merge_filters(old_data: Dict[str, Any], new_data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Merges newly parsed query data with existing session data.
     Handles context changes and diversity requests.
+    Neither input is modified: the merged state gets its own section dicts and assumptions
+    list and shares every unchanged value with the inputs instead of deep-copying them.
     """
     if not old_data:
-        return new_data
-
-    merged = deepcopy(old_data)
+        merged = dict(new_data)
+        for section in ("filters", "exclusions", "inferred"):
+            if section in merged:
+                merged[section] = dict(merged[section])
+        if "assumptions" in merged.get("inferred", {}):
+            merged["inferred"]["assumptions"] = list(merged["inferred"]["assumptions"])
+        return merged
+
+    merged = dict(old_data)
+    filters = merged["filters"] = dict(old_data["filters"])
+    exclusions = merged["exclusions"] = dict(old_data["exclusions"])
+    inferred = merged["inferred"] = dict(old_data["inferred"])
+    assumptions = inferred["assumptions"] = list(old_data["inferred"]["assumptions"])
+    new_inferred = new_data.get("inferred", {})
+    new_assumptions = list(new_inferred.get("assumptions", []))
     
     # Check if user wants to reset filters or seek diversity
-    reset_filters = new_data.get("inferred", {}).get("reset_filters", False)
-    seek_diversity = new_data.get("inferred", {}).get("seek_diversity", False)
+    reset_filters = new_inferred.get("reset_filters", False)
+    seek_diversity = new_inferred.get("seek_diversity", False)
     
     if reset_filters:
         # Clear brand filters for variety
-        if "marka" in merged.get("filters", {}):
-            merged["filters"]["marka"] = []
-            new_data.setdefault("inferred", {}).setdefault("assumptions", []).append(
-                "Marka filtreleri çeşitlilik için temizlendi."
-            )
+        if "marka" in filters:
+            filters["marka"] = []
+            new_assumptions.append("Marka filtreleri çeşitlilik için temizlendi.")
     
     if seek_diversity:
         # Ensure brand filters are cleared for diversity
-        if "marka" in merged.get("filters", {}) and merged["filters"]["marka"]:
-            merged["filters"]["marka"] = []
-            new_data.setdefault("inferred", {}).setdefault("assumptions", []).append(
-                "Çeşitlilik için marka filtreleri kaldırıldı."
-            )
+        if filters.get("marka"):
+            filters["marka"] = []
+            new_assumptions.append("Çeşitlilik için marka filtreleri kaldırıldı.")
     
     # Merge filters: new data takes precedence
     for key, value in new_data.get("filters", {}).items():
         if value is not None and value != []:
-            merged["filters"][key] = value
+            filters[key] = value
 
     # Merge exclusions
     for key, value in new_data.get("exclusions", {}).items():
         if value is not None and value != []:
-            merged["exclusions"][key] = value
+            exclusions[key] = value
 
     # Combine assumptions
-    new_assumptions = new_data.get("inferred", {}).get("assumptions", [])
-    merged["inferred"]["assumptions"].extend(a for a in new_assumptions if a not in merged["inferred"]["assumptions"])
+    assumptions.extend(a for a in new_assumptions if a not in assumptions)
 
-    # Copy over the new inferred flags
-    merged["inferred"]["reset_filters"] = new_data.get("inferred", {}).get("reset_filters", False)
-    merged["inferred"]["seek_diversity"] = new_data.get("inferred", {}).get("seek_diversity", False)
+    # Copy over the new inferred flags; a best-value ordering stays until the filters are reset
+    inferred["reset_filters"] = reset_filters
+    inferred["seek_diversity"] = seek_diversity
+    inferred["sort_by_value"] = new_inferred.get("sort_by_value", False) or (
+        old_data["inferred"].get("sort_by_value", False) and not reset_filters
+    )
 
     merged["confidence"] = new_data["confidence"]
     return merged
@@ -73,18 +279,10 @@ def generate_summary_comment(user_query: str, db_rows: List[Dict], conversation_
     Uses an LLM to generate a friendly, insightful summary of the search results.
     """
 
-    # Prepare a concise view of the results for the LLM, using new schema
-    summary_view = [
-        {
-            "marka": row.get("marka"),
-            "seri": row.get("seri"),
-            "model": row.get("model"),
-            "yil": row.get("yil"),
-            "km": row.get("km"),
-            "fiyat": row.get("fiyat")
-        }
-        for row in db_rows
-    ]
+    # A compact table of the columns the summary needs, instead of every column of every row
+    results_table = listing_schema.to_table(db_rows)
+
+    from langchain_core.prompts import ChatPromptTemplate
 
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a friendly and helpful car sales assistant. Your goal is to summarize findings and guide the user. Be concise and speak in Turkish."),
@@ -93,20 +291,23 @@ def generate_summary_comment(user_query: str, db_rows: List[Dict], conversation_
 
         Kullanıcının son isteği şuydu: "{query}"
 
-        Buna dayanarak bulduğumuz ilk 5 eşleşen araba şunlar:
+        Buna dayanarak bulduğumuz ilk 5 eşleşen araba şunlar (ilk satır sütun adları, değerler "|" ile ayrılmış):
         {results}
 
+        Aynı seri, model yılı ve kilometre aralığındaki ilanlardan önceden hesaplanmış piyasa verileri:
+        {market}
+        Fiyat yorumlarını (ucuz, pahalı, fırsat) yalnızca bu piyasa verilerine dayandır; veri yoksa fiyat hakkında yorum yapma.
+
         Lütfen bu sonuçların kısa ve bilgilendirici bir özetini yap. İlginç kalıpları (örneğin, yaş, fiyat aralığı) belirt ve kullanıcının aramasını daha da daraltmasına yardımcı olacak mantıklı bir sonraki adım veya soru öner. Örneğin, vites, yakıt türü veya ilgili görünüyorsa belirli bir özellik hakkında soru sorabilirsin.
         """),
     ])
     
-    chain = prompt | langchain_agent.llm
-    try:
-        response = chain.invoke({"query": user_query, "results": str(db_rows), "conversation_history": str(conversation_history)})
-        return response.content
-    except Exception as e:
-        logger.error(f"Failed to generate summary comment: {e}")
-        return "İsteğinize göre sonuçlar burada."
+    return _invoke_summary_chain(
+        prompt,
+        {"query": user_query, "results": results_table, "conversation_history": str(conversation_history),
+         "market": str(market.context_for(db_rows) or "Piyasa verisi yok.")},
+        fallback=lambda: template_summary_comment(db_rows),
+    )
     
 def generate_conversation(user_query: str, conversation_history: List[Dict[str, Any]]) -> str:
     """
@@ -115,6 +316,8 @@ def generate_conversation(user_query: str, conversation_history: List[Dict[str,
 
     user_query_history = [q["user_query"] for q in conversation_history]
 
+    from langchain_core.prompts import ChatPromptTemplate
+
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a friendly and helpful car sales assistant. Your goal is to summarize findings and guide the user. Be concise and speak in Turkish."),
         ("human", """
@@ -126,13 +329,11 @@ def generate_conversation(user_query: str, conversation_history: List[Dict[str,
         """),
     ])
     
-    chain = prompt | langchain_agent.llm
-    try:
-        response = chain.invoke({"query": user_query, "user_query_history": user_query_history})
-        return response.content
-    except Exception as e:
-        logger.error(f"Failed to generate summary comment: {e}")
-        return "Buna cevap veremeyeceğim."
+    return _invoke_summary_chain(
+        prompt,
+        {"query": user_query, "user_query_history": user_query_history},
+        fallback=template_conversation,
+    )
     
 def generate_conversation_didnt_find(user_query: str, conversation_history: List[Dict[str, Any]], final_filters: str) -> str:
     """
@@ -141,6 +342,8 @@ def generate_conversation_didnt_find(user_query: str, conversation_history: List
 
     user_query_history = [q["user_query"] for q in conversation_history]
 
+    from langchain_core.prompts import ChatPromptTemplate
+
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a friendly and helpful car sales assistant. Your goal is to summarize findings and guide the user. Be concise and speak in Turkish."),
         ("human", """
@@ -154,32 +357,70 @@ def generate_conversation_didnt_find(user_query: str, conversation_history: List
         """),
     ])
     
-    chain = prompt | langchain_agent.llm
-    try:
-        response = chain.invoke({"query": user_query, "user_query_history": user_query_history, "final_filters": final_filters})
-        return response.content
-    except Exception as e:
-        logger.error(f"Failed to generate summary comment: {e}")
-        return "Buna cevap veremeyeceğim."
-
-
-def process_chat_turn(user_query: str, session_state: Dict[str, Any], conversation_history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return _invoke_summary_chain(
+        prompt,
+        {"query": user_query, "user_query_history": user_query_history, "final_filters": final_filters},
+        fallback=lambda: template_didnt_find(final_filters),
+    )
+
+
+def process_chat_turn(user_query: str, session_state: Dict[str, Any], conversation_history: List[Dict[str, Any]],
+                      session_id: Optional[str] = None,
+                      on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                      cancel: Optional[threading.Event] = None,
+                      parsed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Orchestrates a single turn of a conversation, from parsing to result summarization.
+    The returned "timings" hold the wall time of each stage in seconds and "routing" the model
+    chosen for each LLM stage (see model_router.py). With a session_id, a state the prefetch
+    predicted is answered from the result cache (see prefetch.py), and turns that only narrow
+    the previous filters from that turn's candidates.
+    on_event(kind, payload) is called with "parsed", "results" and streamed "summary_token"
+    events; once `cancel` is set the turn raises TurnCancelled at the next stage boundary.
+    A `parsed` query (e.g. from a batch parse, see batch_eval.py) replaces the parse stage.
     """
     logger.info(f"Starting new turn for query: '{user_query}'")
-
-    newly_parsed_data = parse_user_query(user_query)
+    timings: Dict[str, float] = {}
+    stage_started = time.perf_counter()
+
+    def end_stage(name: str):
+        nonlocal stage_started
+        now = time.perf_counter()
+        timings[name] = round(now - stage_started, 6)
+        stage_started = now
+        if cancel is not None and cancel.is_set():
+            raise TurnCancelled(f"Turn cancelled after the {name} stage.")
+
+    def emit(kind: str, payload: Dict[str, Any]):
+        if on_event is not None:
+            on_event(kind, payload)
+
+    # Set on every turn so a sink never outlives the turn that installed it in this context.
+    _summary_token_sink.set((lambda text: emit("summary_token", {"text": text})) if on_event is not None else None)
+    routing = model_router.start_turn()
+
+    if parsed is None:
+        with model_router.routed(model_router.route_parse(user_query)):
+            parsed = parse_query_coalesced(user_query)
+    newly_parsed_data = promote_model_entities(parsed)
+    end_stage("parse")
     merged_data = merge_filters(session_state, newly_parsed_data)
     logger.info(f"Merged filters: {merged_data.get('filters')}")
     logger.info(f"Merged filters confidence: {merged_data['confidence']}")
 
     if merged_data['confidence'] < 0.3:
-        comment = generate_conversation(user_query, conversation_history)
+        with model_router.routed(model_router.route_summary(merged_data, session_state, has_results=False)):
+            comment = summarize_coalesced(
+                "conversation", (user_query, [q["user_query"] for q in conversation_history]),
+                lambda: generate_conversation(user_query, conversation_history)
+            )
+        end_stage("summary")
         return {
             "comment": comment,
             "results": [],
-            "updated_session_state": session_state
+            "updated_session_state": session_state,
+            "timings": timings,
+            "routing": routing
         }
     
     # Handle region-to-brand mapping, using the 'marka' filter
@@ -206,6 +447,13 @@ def process_chat_turn(user_query: str, session_state: Dict[str, Any], conversati
                 merged_data['inferred']['assumptions'].append(inferred_msg)
             logger.info(f"Normalized brands from {original_brands} to {normalized_brands}")
 
+    end_stage("merge")
+    emit("parsed", {
+        "filters": merged_data.get("filters", {}),
+        "exclusions": merged_data.get("exclusions", {}),
+        "inferred_assumptions": merged_data.get("inferred", {}).get("assumptions", []),
+    })
+
     # Prepare SQL query task description with diversity instructions if needed
     seek_diversity = merged_data.get('inferred', {}).get('seek_diversity', False)
     
@@ -223,19 +471,58 @@ def process_chat_turn(user_query: str, session_state: Dict[str, Any], conversati
         )
 
     try:
-        results = langchain_agent.run_sql_query_from_text(task=sql_agent_task_description, constraints=merged_data)
-        logger.info(f"Agent returned {len(results)} results.")
-    except ValueError as e:
+        # Predicted by the prefetch after the previous turn (next page, refinement, diversity variant)?
+        results = prefetch.lookup_results(merged_data) if session_id else None
+        if results is not None:
+            candidate_cache.remember(session_id, merged_data)
+        else:
+            results = candidate_cache.refine(session_id, merged_data)
+        if results is None:
+            results = run_search_coalesced(sql_agent_task_description, merged_data)
+            logger.info(f"Agent returned {len(results)} results.")
+            candidate_cache.remember(session_id, merged_data)
+    except (ValueError, sqlite3.Error) as e:
         raise SearchExecutionError(f"Could not complete search. Reason: {e}") from e
+    end_stage("search")
+
+    # Nothing matched: loosen the cheapest filter and answer in this turn instead of asking the user to.
+    # The agent also returns [] for unparseable output or a wrong query, so relax only when the
+    # unrelaxed state really has no matches; otherwise answer it with the compiled query.
+    summary_query = user_query
+    if not results and inventory.get_inventory().count(merged_data) > 0:
+        logger.info("Agent returned no rows for a state with matches; using the compiled search.")
+        inferred = merged_data.get("inferred", {})
+        results = query_builder.run_compiled_search(
+            merged_data, seek_diversity=inferred.get("seek_diversity", False),
+            order_by_value=inferred.get("sort_by_value", False),
+        )
+    if not results:
+        relaxed = relax_empty_search(merged_data)
+        if relaxed is not None:
+            merged_data, results, plan = relaxed
+            candidate_cache.remember(session_id, merged_data)
+            summary_query = f"{user_query} (Not: {' '.join(plan.assumptions)})"
+        end_stage("relax")
+    emit("results", {"results": results, "filters": merged_data.get("filters", {}), "relaxed": summary_query != user_query})
 
     top_5_for_summary = results[:5]
-    if not top_5_for_summary:
-        comment = generate_conversation_didnt_find(user_query, conversation_history, merged_data.get('filters'))
-    else: 
-        comment = generate_summary_comment(user_query, top_5_for_summary, conversation_history)
+    with model_router.routed(model_router.route_summary(merged_data, session_state, has_results=bool(top_5_for_summary))):
+        if not top_5_for_summary:
+            comment = summarize_coalesced(
+                "didnt_find", (user_query, [q["user_query"] for q in conversation_history], merged_data.get('filters')),
+                lambda: generate_conversation_didnt_find(user_query, conversation_history, merged_data.get('filters'))
+            )
+        else: 
+            comment = summarize_coalesced(
+                "summary", (summary_query, top_5_for_summary, str(conversation_history)),
+                lambda: generate_summary_comment(summary_query, top_5_for_summary, conversation_history)
+            )
+    end_stage("summary")
 
     return {
         "comment": comment,
         "results": results,
-        "updated_session_state": merged_data
+        "updated_session_state": merged_data,
+        "timings": timings,
+        "routing": routing
     }
\ No newline at end of file
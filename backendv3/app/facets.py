@@ -0,0 +1,89 @@
+# app/facets.py
+"""
+Facet counts for a session's filter state, computed from inventory masks (no SQL, no LLM).
+
+Value facets (marka, yakit, vites, kasa_tipi) are disjunctive: each is counted with every
+filter applied except its own, so the frontend can offer alternatives to the current
+choice (e.g. other brands under the same budget). Year and price buckets are counted
+under the full filter state.
+"""
+
+import logging
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from inventory import Inventory
+from query_builder import VITES_VALUES, YAKIT_VALUES
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Stored value -> filter value, so every facet value can be sent back as a filter as-is.
+VITES_CANONICAL = {stored: canonical for canonical, values in VITES_VALUES.items() for stored in values}
+YAKIT_CANONICAL = {stored: canonical for canonical, values in YAKIT_VALUES.items() for stored in values}
+
+# Body types the crawler stores correctly; other kasa_tipi values are shifted columns.
+BODY_TYPES = ["Sedan", "Hatchback/5", "Hatchback/3", "Station wagon", "MPV", "Coupe", "Cabrio", "Roadster"]
+
+# (label, lower bound inclusive, upper bound exclusive)
+YEAR_BUCKETS: List[Tuple[str, float, float]] = [
+    ("2005 öncesi", -np.inf, 2005),
+    ("2005-2009", 2005, 2010),
+    ("2010-2014", 2010, 2015),
+    ("2015-2019", 2015, 2020),
+    ("2020 ve sonrası", 2020, np.inf),
+]
+PRICE_BUCKETS: List[Tuple[str, float, float]] = [
+    ("500 bin altı", -np.inf, 500_000),
+    ("500 bin - 1 milyon", 500_000, 1_000_000),
+    ("1 - 2 milyon", 1_000_000, 2_000_000),
+    ("2 - 5 milyon", 2_000_000, 5_000_000),
+    ("5 milyon üstü", 5_000_000, np.inf),
+]
+
+# facet name -> (column, filter keys ignored for the facet's own counts, stored -> filter value)
+VALUE_FACETS = {
+    "marka": ("marka", ("marka",), None),
+    "yakit": ("yakit", ("yakit",), YAKIT_CANONICAL),
+    "vites": ("vites", ("vites",), VITES_CANONICAL),
+    "kasa_tipi": ("kasa_tipi", ("kasa_tipi",), None),
+}
+
+def _value_counts(values: np.ndarray, canonical: Dict[str, str] = None) -> List[Dict[str, Any]]:
+    stored, counts = np.unique(values[values != None].astype(str), return_counts=True)  # noqa: E711
+    totals: Dict[str, int] = {}
+    for value, count in zip(stored, counts):
+        key = canonical.get(value, value) if canonical else value
+        if not key or key == "-":
+            continue
+        totals[key] = totals.get(key, 0) + int(count)
+    return [{"value": value, "count": count} for value, count in sorted(totals.items(), key=lambda kv: -kv[1])]
+
+def _bucket_counts(values: np.ndarray, buckets: List[Tuple[str, float, float]]) -> List[Dict[str, Any]]:
+    return [
+        {"label": label, "min": None if np.isinf(low) else int(low), "max": None if np.isinf(high) else int(high),
+         "count": int(np.count_nonzero((values >= low) & (values < high)))}
+        for label, low, high in buckets
+    ]
+
+def compute_facets(inventory: Inventory, constraints: Dict[str, Any]) -> Dict[str, Any]:
+    """Counts per facet value for the given session state."""
+    full_mask = inventory.mask_for(constraints)
+    facets: Dict[str, Any] = {}
+    for name, (column, own_filters, canonical) in VALUE_FACETS.items():
+        mask = inventory.mask_for(constraints, skip=own_filters) if _has_any(constraints, own_filters) else full_mask
+        facets[name] = _value_counts(inventory.text[column][mask], canonical)
+    facets["kasa_tipi"] = [entry for entry in facets["kasa_tipi"] if entry["value"] in BODY_TYPES]
+
+    # Text years (shifted rows) compare as +inf; they belong to no bucket.
+    years = inventory.yil[full_mask]
+    facets["yil"] = _bucket_counts(years[np.isfinite(years)], YEAR_BUCKETS)
+    prices = inventory.fiyat[full_mask]
+    facets["fiyat"] = _bucket_counts(prices[~np.isnan(prices)], PRICE_BUCKETS)
+
+    return {"total": int(full_mask.sum()), "inventory_version": inventory.version, "facets": facets}
+
+def _has_any(constraints: Dict[str, Any], keys: tuple) -> bool:
+    filters = constraints.get("filters", {}) or {}
+    return any(filters.get(key) not in (None, [], "") for key in keys)
@@ -0,0 +1,294 @@
+# app/fallback_parser.py
+"""
+Deterministic, rule-based query parser used when the Gemini parser is unavailable.
+It covers the common Turkish/English phrasings handled by the LLM prompt in parser.py
+(prices, mileage, age, brands, fuel, transmission, body type, paint/parts and diversity
+requests) and returns the same ParsedUserQuery shape.
+"""
+
+import re
+import logging
+from datetime import datetime
+from typing import List, Dict, Any, Optional, Tuple
+
+from brand_mapping import FUZZY_BRAND_MAP
+from parser import (
+    ParsedUserQuery, Filters, Exclusions, Inferred, RawEntities,
+    LOW_MILEAGE_THRESHOLD_KM, MEDIUM_MILEAGE_THRESHOLD_KM, HIGH_MILEAGE_THRESHOLD_KM,
+    VERY_YOUNG_CAR_THRESHOLD_YEARS, YOUNG_CAR_THRESHOLD_YEARS, MODERN_CAR_THRESHOLD_YEARS,
+    FAMILY_CAR_SEGMENTS, CITY_CAR_SEGMENTS, SPORTS_CAR_SEGMENTS, COMPACT_SEGMENTS,
+    LUXURY_SEGMENTS, PRACTICAL_SEGMENTS, ECONOMICAL_SEGMENTS, SPACIOUS_SEGMENTS,
+)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+CURRENT_YEAR = datetime.now().year
+
+# Words that turn the preceding term into an exclusion ("dizel olmasın", "bmw hariç").
+NEGATION_WORDS = ("olmasın", "olmasin", "hariç", "haric", "istemiyorum", "değil", "degil", "no", "not")
+LOWER_BOUND_WORDS = ("üstü", "ustu", "üstünde", "ustunde", "üzeri", "uzeri", "en az", "minimum", "min", "over", "above", "fazla")
+
+FUEL_KEYWORDS = {
+    "benzinli": "Benzin", "benzin": "Benzin", "gasoline": "Benzin", "petrol": "Benzin",
+    "dizel": "Dizel", "diesel": "Dizel", "mazot": "Dizel",
+    "hibrit": "Hibrit", "hybrid": "Hibrit",
+    "elektrikli": "Elektrik", "elektrik": "Elektrik", "electric": "Elektrik",
+}
+TRANSMISSION_KEYWORDS = {
+    "otomatik": "Otomatik", "automatic": "Otomatik",
+    "manuel": "Manuel", "manual": "Manuel", "düz vites": "Manuel",
+}
+BODY_KEYWORDS = {
+    "sedan": ["Sedan"], "hatchback": ["Hatchback/5", "Hatchback/3"], "station wagon": ["Station wagon"],
+    "mpv": ["MPV"], "coupe": ["Coupe"], "roadster": ["Roadster"],
+}
+SEGMENT_KEYWORDS = [
+    (("aile arabası", "aile arabasi", "aile için", "aile icin", "family car"), FAMILY_CAR_SEGMENTS, "Interpreted family car intent."),
+    (("şehir arabası", "sehir arabasi", "şehir içi", "city car"), CITY_CAR_SEGMENTS, "Interpreted city car intent."),
+    (("kompakt", "compact"), COMPACT_SEGMENTS, "Interpreted compact car intent."),
+    (("ekonomik", "economical"), ECONOMICAL_SEGMENTS, "Interpreted economical car intent."),
+    (("geniş", "genis", "spacious"), SPACIOUS_SEGMENTS, "Interpreted spacious car intent."),
+    (("pratik", "practical"), PRACTICAL_SEGMENTS, "Interpreted practical car intent."),
+    (("lüks", "luks", "luxury"), LUXURY_SEGMENTS, "Interpreted luxury car intent."),
+    (("spor araba", "sports car"), SPORTS_CAR_SEGMENTS, "Interpreted sports car intent."),
+]
+MILEAGE_KEYWORDS = [
+    (("çok az kilometreli", "cok az kilometreli", "very low mileage"), LOW_MILEAGE_THRESHOLD_KM, "Inferred very low mileage threshold."),
+    (("az kilometreli", "az km", "düşük kilometreli", "low mileage"), MEDIUM_MILEAGE_THRESHOLD_KM, "Inferred low mileage threshold."),
+    (("orta kilometreli", "moderate mileage"), HIGH_MILEAGE_THRESHOLD_KM, "Inferred moderate mileage threshold."),
+]
+AGE_KEYWORDS = [
+    (("sıfır ayarında", "sifir ayarinda", "brand new"), VERY_YOUNG_CAR_THRESHOLD_YEARS, "Inferred brand new car threshold."),
+    (("genç araba", "genc araba", "young car"), YOUNG_CAR_THRESHOLD_YEARS, "Inferred young car threshold."),
+    (("modern araba", "modern car"), MODERN_CAR_THRESHOLD_YEARS, "Inferred modern car threshold."),
+]
+COLOR_WORDS = {
+    "beyaz": "Beyaz", "siyah": "Siyah", "gri": "Gri", "kırmızı": "Kırmızı", "kirmizi": "Kırmızı",
+    "mavi": "Mavi", "lacivert": "Lacivert", "füme": "Füme", "fume": "Füme", "bordo": "Bordo",
+    "yeşil": "Yeşil", "yesil": "Yeşil", "sarı": "Sarı", "sari": "Sarı", "kahverengi": "Kahverengi", "turuncu": "Turuncu",
+}
+DIVERSITY_PHRASES = ("farklı", "farkli", "different", "çeşit", "cesit", "variety", "başka seçenek", "baska secenek", "other options")
+VALUE_PHRASES = ("fırsat", "firsat", "kelepir", "piyasanın altında", "piyasanin altinda", "best deal", "good deal", "bargain")
+RESET_PHRASES = ("başka bir şey", "baska bir sey", "something else", "farklı araba", "farkli araba", "different cars")
+
+# An amount such as "650 bin", "1,2 milyon", "600.000 tl" or "100 bin km".
+AMOUNT_PATTERN = re.compile(
+    r"(\d+(?:[.,]\d+)*)\s*(milyon|million|bin|k)?\b\s*(tl|lira|₺|km|kilometre)?",
+    re.IGNORECASE,
+)
+AGE_PATTERN = re.compile(r"(\d+)\s*(?:yaş|yas|yaşından|yasindan|years?)")
+YEAR_PATTERN = re.compile(r"\b(19[7-9]\d|20[0-4]\d)\b\s*(sonrası|sonrasi|ve sonrası|üstü|ustu|öncesi|oncesi|model)?")
+
+def turkish_lower(text: str) -> str:
+    """Lower-cases with Turkish rules (İ -> i, I -> ı) so keyword matching works."""
+    return text.replace("İ", "i").replace("I", "ı").lower()
+
+def _parse_number(raw: str, multiplier: Optional[str]) -> int:
+    multiplier = (multiplier or "").lower()
+    if multiplier:
+        # "1,2 milyon" / "1.5 milyon": the separator is a decimal point.
+        value = float(raw.replace(",", ".")) if raw.count(",") + raw.count(".") == 1 else float(re.sub(r"[.,]", "", raw))
+    else:
+        # "600.000" / "600,000": separators are thousands separators.
+        value = float(re.sub(r"[.,]", "", raw))
+    if multiplier in ("milyon", "million"):
+        value *= 1_000_000
+    elif multiplier in ("bin", "k"):
+        value *= 1_000
+    return int(value)
+
+def _context_after(text: str, end: int, width: int = 25) -> str:
+    return text[end:end + width]
+
+def _context_before(text: str, start: int, width: int = 25) -> str:
+    return text[max(0, start - width):start]
+
+def _bound_direction(text: str, start: int, end: int) -> str:
+    """'max' for "800 bin altı", 'min' for "500 bin üstü"; defaults to 'max' (a budget)."""
+    after, before = _context_after(text, end), _context_before(text, start)
+    if any(word in after for word in LOWER_BOUND_WORDS) or "en az" in before:
+        return "min"
+    return "max"
+
+# Joins negatable terms that share one negation word ("bmw ve audi olmasın").
+NEGATION_CONNECTORS = ("ve", "veya", "ya da", "ile", "and", "or", ",")
+# A negation word counts only as a whole space-separated token, as before ("değil." does not).
+NEGATION_PATTERN = re.compile(rf"\s*(?:{'|'.join(map(re.escape, NEGATION_WORDS))})(?=\s|$)")
+CONNECTOR_PATTERN = re.compile(rf"\s*(?:{'|'.join(map(re.escape, NEGATION_CONNECTORS))})(?:\s+|(?<=,))")
+_negatable_term_pattern: Optional["re.Pattern[str]"] = None
+
+def _negatable_term() -> "re.Pattern[str]":
+    """Matches one brand, fuel, transmission or colour term at the start of a string."""
+    global _negatable_term_pattern
+    if _negatable_term_pattern is None:
+        phrases = set(FUZZY_BRAND_MAP) | set(FUEL_KEYWORDS) | set(TRANSMISSION_KEYWORDS) | set(COLOR_WORDS)
+        alternation = "|".join(re.escape(p) for p in sorted(phrases, key=len, reverse=True))
+        _negatable_term_pattern = re.compile(rf"(?:{alternation})(?!\w)")
+    return _negatable_term_pattern
+
+def _is_negated(text: str, end: int) -> bool:
+    """
+    True when a negation word directly follows the term ending at `end`, or follows a run
+    of other negatable terms joined to it by "ve"/"," ("dizel ve benzin olmasın"). A term
+    next to a negated one without a connector ("dizel bmw olmasın") is not negated.
+    """
+    position = end
+    while True:
+        if NEGATION_PATTERN.match(text, position):
+            return True
+        joined = CONNECTOR_PATTERN.match(text, position)
+        if not joined:
+            return False
+        term = _negatable_term().match(text, joined.end())
+        if not term:
+            return False
+        position = term.end()
+
+def _extract_amounts(text: str, filters: Dict[str, Any]):
+    year_spans = [m.span(1) for m in YEAR_PATTERN.finditer(text)]
+    age_spans = [m.span(1) for m in AGE_PATTERN.finditer(text)]
+    ranges: Dict[str, List[Tuple[int, str, int]]] = {"fiyat": [], "km": []}
+
+    for match in AMOUNT_PATTERN.finditer(text):
+        raw, multiplier, unit = match.group(1), match.group(2), (match.group(3) or "").lower()
+        if match.span(1) in year_spans or match.span(1) in age_spans:
+            continue
+        value = _parse_number(raw, multiplier)
+        if unit in ("km", "kilometre") or "kilometre" in _context_after(text, match.end(), 12):
+            kind = "km"
+        elif unit in ("tl", "lira", "₺") or multiplier or value >= 10_000:
+            kind = "fiyat"
+        else:
+            continue
+        direction = _bound_direction(text, match.start(), match.end())
+        ranges[kind].append((value, direction, match.end()))
+
+    for kind, found in ranges.items():
+        if not found:
+            continue
+        is_range = len(found) >= 2 and any(w in _context_after(text, found[1][2], 12) for w in ("arası", "arasi", "between"))
+        if is_range:
+            low, high = sorted([found[0][0], found[1][0]])
+            filters[f"{kind}_min"], filters[f"{kind}_max"] = low, high
+        else:
+            for value, direction, _ in found:
+                filters[f"{kind}_{direction}"] = value
+
+def _extract_age(text: str, filters: Dict[str, Any], assumptions: List[str]):
+    match = AGE_PATTERN.search(text)
+    if match:
+        filters["age_max"] = int(match.group(1))
+    for match in YEAR_PATTERN.finditer(text):
+        year, qualifier = int(match.group(1)), (match.group(2) or "")
+        if qualifier in ("öncesi", "oncesi"):
+            filters["age_min"] = max(0, CURRENT_YEAR - year)
+        else:
+            filters["age_max"] = max(0, CURRENT_YEAR - year)
+            assumptions.append(f"Interpreted model year {year} as the oldest acceptable year.")
+    for phrases, years, rationale in AGE_KEYWORDS:
+        if filters.get("age_max") is None and any(p in text for p in phrases):
+            filters["age_max"] = years
+            assumptions.append(rationale)
+
+def _find_terms(text: str, vocabulary: Dict[str, Any]) -> List[Tuple[Any, int]]:
+    """All vocabulary hits as (value, end position), longest phrases first, without overlaps."""
+    hits, taken = [], []
+    for phrase in sorted(vocabulary, key=len, reverse=True):
+        for match in re.finditer(rf"(?<!\w){re.escape(phrase)}(?!\w)", text):
+            if any(match.start() < end and start < match.end() for start, end in taken):
+                continue
+            taken.append(match.span())
+            hits.append((vocabulary[phrase], match.end(), match.start()))
+    return [(value, end) for value, end, _ in sorted(hits, key=lambda hit: hit[2])]
+
+def parse_query_deterministic(query: str) -> Dict[str, Any]:
+    """Parses a query with keyword and pattern rules only. Never calls an LLM."""
+    text = turkish_lower(query or "")
+    filters: Dict[str, Any] = {}
+    exclusions: Dict[str, Any] = {"exclude_brands": [], "exclude_fuel_types": [], "exclude_colors": []}
+    inferred: Dict[str, Any] = {"assumptions": ["Yapay zeka ayrıştırıcısına ulaşılamadı; kural tabanlı ayrıştırıcı kullanıldı."]}
+    raw: Dict[str, Any] = {"brands": [], "models": [], "colors": [], "segments": []}
+
+    _extract_amounts(text, filters)
+    _extract_age(text, filters, inferred["assumptions"])
+
+    for phrases, km, rationale in MILEAGE_KEYWORDS:
+        if filters.get("km_max") is None and any(p in text for p in phrases):
+            filters["km_max"] = km
+            inferred["assumptions"].append(rationale)
+
+    for brand, end in _find_terms(text, FUZZY_BRAND_MAP):
+        raw["brands"].append(brand)
+        target = exclusions["exclude_brands"] if _is_negated(text, end) else filters.setdefault("marka", [])
+        if brand not in target:
+            target.append(brand)
+
+    # Series names known to the inventory ("golf 1.6 tdi", "corolla hibrit").
+    import text_index
+    for term in text_index.get_index().extract_terms(text):
+        raw["models"].append(term)
+        if term not in filters.setdefault("model", []):
+            filters["model"].append(term)
+
+    for fuel, end in _find_terms(text, FUEL_KEYWORDS):
+        target = exclusions["exclude_fuel_types"] if _is_negated(text, end) else filters.setdefault("yakit", [])
+        if fuel not in target:
+            target.append(fuel)
+
+    for transmission, end in _find_terms(text, TRANSMISSION_KEYWORDS):
+        if _is_negated(text, end):
+            # Mirrors the LLM prompt, which files "manuel hariç" under exclude_fuel_types.
+            exclusions["exclude_fuel_types"].append(transmission)
+        else:
+            filters["vites"] = transmission
+
+    for body_types, end in _find_terms(text, BODY_KEYWORDS):
+        for body in body_types:
+            if body not in filters.setdefault("kasa_tipi", []):
+                filters["kasa_tipi"].append(body)
+
+    for phrases, segments, rationale in SEGMENT_KEYWORDS:
+        if any(p in text for p in phrases):
+            raw["segments"].append(phrases[0])
+            for body in segments:
+                if body not in filters.setdefault("kasa_tipi", []):
+                    filters["kasa_tipi"].append(body)
+            inferred["assumptions"].append(rationale)
+            if segments is FAMILY_CAR_SEGMENTS:
+                exclusions["sports_car_excluded"] = True
+
+    if any(p in text for p in ("spor araba olmasın", "spor olmasın", "not a sports car")):
+        exclusions["sports_car_excluded"] = True
+    if any(p in text for p in ("boyasız", "boyasiz", "hatasız", "hatasiz")):
+        filters["boya_durumu"] = "Yok"
+    if any(p in text for p in ("değişensiz", "degisensiz", "hatasız", "hatasiz")):
+        filters["parca_durumu"] = "Yok"
+
+    for color, end in _find_terms(text, COLOR_WORDS):
+        raw["colors"].append(color)
+        if _is_negated(text, end) and color not in exclusions["exclude_colors"]:
+            exclusions["exclude_colors"].append(color)
+
+    if any(p in text for p in DIVERSITY_PHRASES):
+        inferred["seek_diversity"] = True
+        inferred["assumptions"].append("User wants diverse car options.")
+    if any(p in text for p in RESET_PHRASES):
+        inferred["reset_filters"] = True
+    if any(p in text for p in VALUE_PHRASES):
+        inferred["sort_by_value"] = True
+        inferred["assumptions"].append("User wants the best-value listings first.")
+
+    found_constraints = any(v not in (None, []) for v in filters.values()) or any(
+        v not in (None, [], False) for v in exclusions.values()
+    ) or inferred.get("seek_diversity", False) or inferred.get("sort_by_value", False)
+    # Below 0.3 the engine treats the message as chit-chat, which is what we want when nothing matched.
+    confidence = 0.6 if found_constraints else 0.2
+
+    return ParsedUserQuery(
+        filters=Filters(**filters),
+        exclusions=Exclusions(**exclusions),
+        inferred=Inferred(**inferred),
+        raw_entities=RawEntities(**raw),
+        confidence=confidence,
+    ).model_dump()
@@ -0,0 +1,236 @@
+# app/inventory.py
+"""
+Columnar in-memory snapshot of the listings table.
+
+Every column is held as a numpy array so filter states can be evaluated as boolean
+masks without touching SQLite or an LLM. `mask_for` mirrors the semantics of
+query_builder.build_where_clause, including SQLite's comparison rules for the few
+rows whose `yil` or `km` columns hold text, so counts agree with the compiled search.
+
+The snapshot is rebuilt when the database reports a new data version (a commit by
+another connection, e.g. the crawler). Structures derived from a snapshot are cached
+on it through `Inventory.derived`, so they are rebuilt together with the inventory.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import threading
+from contextlib import closing
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+import text_index
+from langchain_agent import DB_PATH, CURRENT_YEAR
+from query_builder import (
+    TABLE_NAME, VITES_VALUES, YAKIT_VALUES, BOYA_NONE_VALUE, PARCA_NONE_VALUE, SPORTS_BODY_TYPES, expand_values,
+    canonical_clause,
+)
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+TEXT_COLUMNS = ["link", "marka", "seri", "model", "vites", "yakit", "kasa_tipi", "renk", "boya", "parca"]
+
+_LEADING_INT = re.compile(r"[+-]?\d+")
+
+def _sqlite_number(value: Any) -> float:
+    """Numeric value as SQLite compares it: text sorts after every number, NULL matches nothing."""
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        return np.inf
+    return float(value)
+
+def _km_number(value: Any) -> float:
+    """Mirror of query_builder.KM_EXPR: '69.000 km' -> 69000, unparsable text -> 0."""
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        match = _LEADING_INT.match(value.replace(".", "").replace(" km", "").strip())
+        return float(match.group()) if match else 0.0
+    return float(value)
+
+class Inventory:
+    """One immutable snapshot of the listings table, stored column by column."""
+
+    def __init__(self, version: int, rows: List[sqlite3.Row]):
+        self.version = version
+        self.size = len(rows)
+        self.ids = np.array([row["id"] for row in rows], dtype=np.int64)
+        self.fiyat = np.array([_sqlite_number(row["fiyat"]) for row in rows], dtype=np.float64)
+        self.yil = np.array([_sqlite_number(row["yil"]) for row in rows], dtype=np.float64)
+        self.km = np.array([_km_number(row["km"]) for row in rows], dtype=np.float64)
+        self.text: Dict[str, np.ndarray] = {
+            column: np.array([row[column] for row in rows], dtype=object) for column in TEXT_COLUMNS
+        }
+        self.position = {int(listing_id): i for i, listing_id in enumerate(self.ids)}
+        self.fingerprint: Optional[tuple] = None    # Set by _load (see _current_version)
+        self.parent: Optional["Inventory"] = None      # Set on subsets (see `subset`)
+        self.positions: Optional[np.ndarray] = None
+        self._derived: Dict[str, Any] = {}
+        self._derived_lock = threading.Lock()
+
+    def subset(self, positions: np.ndarray) -> "Inventory":
+        """A view over some rows of this snapshot; masks computed on it are indexed like `positions`."""
+        view = object.__new__(Inventory)
+        view.version = self.version
+        view.size = len(positions)
+        view.ids = self.ids[positions]
+        view.fiyat = self.fiyat[positions]
+        view.yil = self.yil[positions]
+        view.km = self.km[positions]
+        view.text = {column: values[positions] for column, values in self.text.items()}
+        view.position = None
+        view.fingerprint = self.fingerprint
+        view.parent = self
+        view.positions = positions
+        view._derived = {}
+        view._derived_lock = threading.Lock()
+        return view
+
+    def derived(self, name: str, build: Callable[["Inventory"], Any]) -> Any:
+        """Returns a structure computed from this snapshot, building it on first use."""
+        with self._derived_lock:
+            if name not in self._derived:
+                self._derived[name] = build(self)
+            return self._derived[name]
+
+    # --- Masks ---
+
+    def isin(self, column: str, values: List[str]) -> np.ndarray:
+        return np.isin(self.text[column], list(values))
+
+    def not_in(self, column: str, values: List[str]) -> np.ndarray:
+        # `col NOT IN (...)` is NULL (no match) when the column itself is NULL.
+        column_values = self.text[column]
+        return ~np.isin(column_values, list(values)) & (column_values != None)  # noqa: E711
+
+    def not_like_prefix(self, column: str, prefix: str) -> np.ndarray:
+        prefix = prefix.lower()
+        return np.array([value is not None and not value.lower().startswith(prefix) for value in self.text[column]])
+
+    def clause_masks(self, constraints: Dict[str, Any]) -> Dict[str, np.ndarray]:
+        """One boolean mask per active filter or exclusion key; the search matches their conjunction."""
+        filters = constraints.get("filters", {}) or {}
+        exclusions = constraints.get("exclusions", {}) or {}
+        masks: Dict[str, np.ndarray] = {}
+
+        with np.errstate(invalid="ignore"):
+            if filters.get("fiyat_max") is not None:
+                masks["fiyat_max"] = self.fiyat <= filters["fiyat_max"]
+            if filters.get("fiyat_min") is not None:
+                masks["fiyat_min"] = self.fiyat >= filters["fiyat_min"]
+            if filters.get("age_max") is not None:
+                masks["age_max"] = self.yil >= CURRENT_YEAR - filters["age_max"]
+            if filters.get("age_min") is not None:
+                masks["age_min"] = self.yil <= CURRENT_YEAR - filters["age_min"]
+            if filters.get("km_max") is not None:
+                masks["km_max"] = self.km <= filters["km_max"]
+            if filters.get("km_min") is not None:
+                masks["km_min"] = self.km >= filters["km_min"]
+        if filters.get("yakit"):
+            masks["yakit"] = self.isin("yakit", expand_values(filters["yakit"], YAKIT_VALUES))
+        if filters.get("vites"):
+            masks["vites"] = self.isin("vites", expand_values([filters["vites"]], VITES_VALUES))
+        if filters.get("marka"):
+            masks["marka"] = self.isin("marka", filters["marka"])
+        if filters.get("kasa_tipi"):
+            masks["kasa_tipi"] = self.isin("kasa_tipi", filters["kasa_tipi"])
+        if filters.get("model"):
+            if self.parent is None:
+                masks["model"] = text_index.for_inventory(self).mask_for_terms(filters["model"])
+            else:
+                masks["model"] = text_index.for_inventory(self.parent).mask_for_terms(filters["model"])[self.positions]
+        if filters.get("boya_durumu") == "Yok":
+            masks["boya_durumu"] = self.text["boya"] == BOYA_NONE_VALUE
+        if filters.get("parca_durumu") == "Yok":
+            masks["parca_durumu"] = self.text["parca"] == PARCA_NONE_VALUE
+
+        if exclusions.get("exclude_brands"):
+            masks["exclude_brands"] = self.not_in("marka", exclusions["exclude_brands"])
+        if exclusions.get("exclude_fuel_types"):
+            mask = np.ones(self.size, dtype=bool)
+            fuels = [v for v in exclusions["exclude_fuel_types"] if v not in VITES_VALUES]
+            transmissions = [v for v in exclusions["exclude_fuel_types"] if v in VITES_VALUES]
+            if fuels:
+                mask &= self.not_in("yakit", expand_values(fuels, YAKIT_VALUES))
+            if transmissions:
+                mask &= self.not_in("vites", expand_values(transmissions, VITES_VALUES))
+            masks["exclude_fuel_types"] = mask
+        if exclusions.get("exclude_colors"):
+            mask = np.ones(self.size, dtype=bool)
+            for color in exclusions["exclude_colors"]:
+                mask &= self.not_like_prefix("renk", color)
+            masks["exclude_colors"] = mask
+        if exclusions.get("sports_car_excluded"):
+            masks["sports_car_excluded"] = self.not_in("kasa_tipi", SPORTS_BODY_TYPES)
+        return masks
+
+    def mask_for(self, constraints: Dict[str, Any], skip: tuple = ()) -> np.ndarray:
+        """
+        Boolean mask of the listings matching the session's filters and exclusions.
+        Filter or exclusion keys listed in `skip` are ignored (used for facets and relaxation).
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for key, clause in self.clause_masks(constraints).items():
+            if key not in skip:
+                mask &= clause
+        return mask
+
+    def count(self, constraints: Dict[str, Any], skip: tuple = ()) -> int:
+        return int(self.mask_for(constraints, skip).sum())
+
+# --- Snapshot management ---
+_inventory: Optional[Inventory] = None
+_version_conn: Optional[sqlite3.Connection] = None
+_version_pid: Optional[int] = None
+_lock = threading.Lock()
+
+def _fingerprint(conn: sqlite3.Connection) -> tuple:
+    return tuple(conn.execute(
+        f'SELECT COUNT(*), MAX("id"), TOTAL("fiyat") FROM {TABLE_NAME} WHERE {canonical_clause()}'
+    ).fetchone())
+
+def _current_version() -> int:
+    """
+    PRAGMA data_version on a long-lived connection changes whenever another connection commits.
+    The connection is per process: a worker forked from a preloading gunicorn master opens its
+    own and keeps the inherited snapshot (shared copy-on-write) if the table still matches it.
+    """
+    global _version_conn, _version_pid
+    if _version_conn is None or _version_pid != os.getpid():
+        _version_conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+        _version_pid = os.getpid()
+        version = _version_conn.execute("PRAGMA data_version").fetchone()[0]
+        if _inventory is not None and _inventory.fingerprint == _fingerprint(_version_conn):
+            _inventory.version = version
+            logger.info(f"Adopted the preloaded inventory snapshot in process {_version_pid}.")
+        return version
+    return _version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+def _load(version: int) -> Inventory:
+    columns = ", ".join(f'"{c}"' for c in ["id", "fiyat", "yil", "km"] + TEXT_COLUMNS)
+    with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)) as conn:
+        conn.row_factory = sqlite3.Row
+        # Relisted copies are left out of the snapshot (see dedup.py).
+        rows = conn.execute(f"SELECT {columns} FROM {TABLE_NAME} WHERE {canonical_clause()} ORDER BY id").fetchall()
+        fingerprint = _fingerprint(conn)
+    inventory = Inventory(version, rows)
+    inventory.fingerprint = fingerprint
+    logger.info(f"Loaded inventory snapshot v{version} with {inventory.size} listings.")
+    return inventory
+
+def get_inventory() -> Inventory:
+    """The current snapshot, reloaded when the listings database has changed."""
+    global _inventory
+    with _lock:
+        version = _current_version()
+        if _inventory is None or _inventory.version != version:
+            _inventory = _load(version)
+        return _inventory
+
+def is_initialised() -> bool:
+    return _inventory is not None
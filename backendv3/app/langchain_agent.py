@@ -1,19 +1,24 @@
 # app/langchain_agent.py
 
 import os
+import time
 import logging
 import ast
 import re
 import signal
+import sqlite3
+import threading
+from contextlib import closing
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional, Tuple
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from langchain_community.utilities.sql_database import SQLDatabase
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.agent_toolkits.sql.base import create_sql_agent
-from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
+
+import usage_ledger
+import model_router
+from admission import llm_slot, AdmissionRejected
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -29,16 +34,6 @@ DB_URL = f"sqlite:///{DB_PATH}"
 LLM_MODEL = "gemini-2.5-flash"
 CURRENT_YEAR = datetime.now().year
 
-engine = create_engine(DB_URL)
-db = SQLDatabase(engine=engine, sample_rows_in_table_info=0) # No need to sample rows
-llm = ChatGoogleGenerativeAI(
-    model=LLM_MODEL, 
-    temperature=0, 
-    google_api_key=os.getenv("GEMINI_API_KEY"),
-    timeout=30,  # 30 second timeout
-    max_retries=2
-)
-
 SCHEMA_GUIDE = f"""
 Database Schema Guide for the 'araba_ilanlari' table:
 The table contains used car listings. All column names are lowercase.
@@ -56,6 +51,8 @@ The table contains used car listings. All column names are lowercase.
 - renk: (TEXT) Color of the car.
 - boya: (TEXT) Description of painted parts. "Yok" means no painted parts.
 - parca: (TEXT) Description of replaced parts. "Yok" means no replaced parts.
+- deal_score: (REAL) Price against the market median of the same series, year band and mileage band: 0.15 means 15% below the median, negative means above. NULL when there are too few comparable listings. Sort by "deal_score" DESC for the best deals.
+- duplicate_of: (INTEGER) For a relisted copy of a car, the id of its canonical listing; NULL for canonical listings. Always filter on `"duplicate_of" IS NULL`.
 """
 
 AGENT_PROMPT_PREFIX = f"""
@@ -74,6 +71,7 @@ The current year is {CURRENT_YEAR}. Adhere to these rules STRICTLY:
     - `boya_durumu: "Yok"` -> `"boya" = 'Yok'`.
     - `parca_durumu: "Yok"` -> `"parca" = 'Yok'`.
     - `sports_car_excluded: True` -> `"kasa_tipi" NOT IN ('Coupe', 'Cabrio', 'Roadster', 'Sport')`.
+    - Always add `"duplicate_of" IS NULL` so relisted copies of a car are left out.
 6.  **Diversity Handling**: If the task description mentions "diverse", "different brands", or "variety", prioritize showing cars from different brands by using `ORDER BY "marka", RANDOM()` or similar techniques to ensure brand diversity in results.
 7.  **Result Limit**: You MUST add `LIMIT 5` to every query.
 8.  **Single Statement**: Generate only one SQL statement. And it should start with "SELECT * ... "
@@ -83,17 +81,151 @@ The current year is {CURRENT_YEAR}. Adhere to these rules STRICTLY:
 {SCHEMA_GUIDE}
 """
 
-# Tool and Agent setup
-toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-sql_agent_executor = create_sql_agent(
-    llm=llm,
-    toolkit=toolkit,
-    agent_type="openai-tools",
-    verbose=False,  # Disable verbose logging for speed
-    prefix=AGENT_PROMPT_PREFIX,
-    agent_executor_kwargs={"handle_parsing_errors": True},
-    max_execution_time=40  # 40 second timeout for agent execution
-)
+# --- Lazy Initialisation ---
+# The engine, schema reflection, Gemini client and SQL agent are expensive to build,
+# so they are created on first use (or by warm_up() at startup) instead of at import time.
+_init_lock = threading.RLock()
+_instances: Dict[str, Any] = {}
+
+def _get_or_create(name: str, factory: Callable[[], Any]) -> Any:
+    """Returns the named singleton, building it exactly once even under concurrent access."""
+    instance = _instances.get(name)
+    if instance is None:
+        with _init_lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = factory()
+                _instances[name] = instance
+                logger.info(f"Initialised '{name}'.")
+    return instance
+
+def _create_engine():
+    from sqlalchemy import create_engine
+    return create_engine(DB_URL)
+
+def _create_db():
+    from langchain_community.utilities.sql_database import SQLDatabase
+    return SQLDatabase(engine=get_engine(), sample_rows_in_table_info=0) # No need to sample rows
+
+def _create_llm(model: str = LLM_MODEL):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model=model, 
+        temperature=0, 
+        google_api_key=os.getenv("GEMINI_API_KEY"),
+        timeout=30,  # 30 second timeout
+        max_retries=2
+    )
+
+def _create_toolkit(model: Optional[str] = None):
+    # The toolkit's query tool is swapped for one that captures executed SQL and typed rows.
+    from sql_tools import CapturingSQLDatabaseToolkit
+    return CapturingSQLDatabaseToolkit(db=get_db(), llm=get_llm(model))
+
+def _create_sql_agent(model: Optional[str] = None):
+    from langchain_community.agent_toolkits.sql.base import create_sql_agent
+    return create_sql_agent(
+        llm=get_llm(model),
+        toolkit=get_toolkit(model),
+        agent_type="openai-tools",
+        verbose=False,  # Disable verbose logging for speed
+        prefix=AGENT_PROMPT_PREFIX,
+        agent_executor_kwargs={"handle_parsing_errors": True},
+        max_execution_time=40  # 40 second timeout for agent execution
+    )
+
+def get_engine():
+    """Returns the shared SQLAlchemy engine for the car listings database."""
+    return _get_or_create("engine", _create_engine)
+
+def get_db():
+    """Returns the LangChain SQLDatabase wrapper (reflects the schema on first use)."""
+    return _get_or_create("db", _create_db)
+
+def _instance_name(name: str, model: Optional[str]) -> str:
+    # Components for the default model keep their plain names (see is_initialised).
+    return name if model in (None, LLM_MODEL) else f"{name}:{model}"
+
+def get_llm(model: Optional[str] = None):
+    """Returns the shared Gemini chat model (LLM_MODEL unless another model is given)."""
+    return _get_or_create(_instance_name("llm", model), lambda: _create_llm(model or LLM_MODEL))
+
+def get_toolkit(model: Optional[str] = None):
+    """Returns the SQL toolkit used by the agent."""
+    return _get_or_create(_instance_name("toolkit", model), lambda: _create_toolkit(model))
+
+def get_sql_agent(model: Optional[str] = None):
+    """Returns the SQL agent executor."""
+    return _get_or_create(_instance_name("sql_agent_executor", model), lambda: _create_sql_agent(model))
+
+_LAZY_ATTRIBUTES = {
+    "engine": get_engine,
+    "db": get_db,
+    "llm": get_llm,
+    "toolkit": get_toolkit,
+    "sql_agent_executor": get_sql_agent,
+}
+
+def __getattr__(name: str) -> Any:
+    # Keeps `langchain_agent.llm` style access working while deferring construction.
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def is_initialised() -> Dict[str, bool]:
+    """Reports which of the lazy components have been built so far."""
+    return {name: name in _instances for name in _LAZY_ATTRIBUTES}
+
+def warm_up():
+    """Builds every lazy component so the first request does not pay the setup cost."""
+    get_sql_agent()
+
+# --- Structured Result Capture ---
+
+@dataclass
+class CapturedQuery:
+    """A statement executed by the agent's query tool, with its typed result rows."""
+    sql: str
+    columns: List[str]
+    rows: List[Dict[str, Any]] = field(default_factory=list)
+
+@dataclass
+class AgentQueryResult:
+    """Outcome of one agent run: the SQL that produced the rows (if known) and the rows."""
+    sql: Optional[str]
+    rows: List[Dict[str, Any]]
+
+# Set for the duration of an agent run; the query tool appends every statement it executes.
+_query_capture: ContextVar[Optional[List[CapturedQuery]]] = ContextVar("query_capture", default=None)
+
+# (PRAGMA schema_version, column names); schema_version is bumped by any ALTER in any process.
+_table_columns: Tuple[int, Tuple[str, ...]] = (-1, ())
+_table_columns_lock = threading.Lock()
+
+def get_table_columns() -> Tuple[str, ...]:
+    """Column names of the listings table, re-read whenever the schema version moves (e.g. a dedup or market migration run by the crawler or another worker)."""
+    global _table_columns
+    with closing(sqlite3.connect(DB_PATH)) as conn:
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        with _table_columns_lock:
+            if _table_columns[0] != version:
+                _table_columns = (version, tuple(row[1] for row in conn.execute("PRAGMA table_info(araba_ilanlari)")))
+            return _table_columns[1]
+
+def execute_select(sql: str) -> CapturedQuery:
+    """Executes a statement on the listings database and returns column names and row dicts from the cursor."""
+    from sqlalchemy import text
+    with get_engine().connect() as connection:
+        result = connection.execute(text(sql))
+        columns = list(result.keys())
+        rows = [dict(zip(columns, row)) for row in result.fetchall()]
+    return CapturedQuery(sql=sql, columns=columns, rows=rows)
+
+def record_captured_query(captured: CapturedQuery):
+    """Called by the query tool; a no-op outside of an agent run."""
+    capture = _query_capture.get()
+    if capture is not None:
+        capture.append(captured)
 
 class TimeoutException(Exception):
     pass
@@ -101,84 +233,90 @@ class TimeoutException(Exception):
 def timeout_handler(signum, frame):
     raise TimeoutException("Operation timed out")
 
-def run_sql_query_from_text(task: str, constraints: dict) -> List[Dict[str, Any]]:
+def run_sql_agent(task: str, constraints: dict) -> AgentQueryResult:
     """
     Executes a natural language query against the database using an LLM agent.
+    The rows come straight from the agent's query tool call, so nothing is re-executed or re-parsed.
     """
     prompt = f"Task: {task}\n\nStructured Constraints to apply:\n{constraints}"
     logger.info("Invoking SQL agent.")
 
+    captured: List[CapturedQuery] = []
+    token = _query_capture.set(captured)
     try:
-        # Set up timeout (only works on Unix-like systems)
-        try:
+        # Set up timeout (only works on Unix-like systems, and only from the main thread;
+        # requests served from the thread pool rely on the agent's max_execution_time instead)
+        use_alarm = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+        if use_alarm:
             signal.signal(signal.SIGALRM, timeout_handler)
-            signal.alarm(40)  # 30 second timeout
-        except AttributeError:
-            # Windows doesn't support SIGALRM, skip timeout
-            pass
-        
-        result = sql_agent_executor.invoke({"input": prompt})
+            signal.alarm(40)  # 40 second timeout
         
-        # Cancel timeout
         try:
-            signal.alarm(0)
-        except AttributeError:
-            pass
-            
+            model = model_router.model_for("sql")
+            with llm_slot("sql"):
+                started = time.perf_counter()
+                result = get_sql_agent(model).invoke(
+                    {"input": prompt}, config={"callbacks": usage_ledger.callbacks_for("sql")}
+                )
+                model_router.observe("sql", model or LLM_MODEL, time.perf_counter() - started)
+        finally:
+            # Cancel timeout
+            if use_alarm:
+                signal.alarm(0)
+
+        # 1. Adım: Ajanın sorgu aracı üzerinden çalıştırdığı son ilan sorgusunu doğrudan kullan.
+        listing_queries = [q for q in captured if "id" in q.columns]
+        if listing_queries:
+            final_query = listing_queries[-1]
+            logger.info(f"Captured {len(final_query.rows)} rows from the agent's query tool: {final_query.sql}")
+            return AgentQueryResult(sql=final_query.sql, rows=final_query.rows)
+
         output = result.get("output", "[]")
 
-        # 1. Adım: Ajan çıktısının bir SQL sorgusu olup olmadığını kontrol et. Varsa çalıştır.
-        # ```sql...``` formatındaki metni bulmak için regex kullanıyoruz.
-        sql_match = re.search(r"```sql\s*(.*?)\s*```", output, re.DOTALL)
+        # 2. Adım: Ajan sorguyu hiç çalıştırmadan ```sql...``` bloğu döndürdüyse, onu bir kez çalıştır.
+        sql_match = re.search(r"```sql\s*(.*?)\s*```", output, re.DOTALL) if isinstance(output, str) else None
 
         if sql_match:
             sql_query = sql_match.group(1).strip()
-            logger.info(f"Agent returned a raw SQL query. Executing it: {sql_query}")
-            
-            # Sorguyu veritabanı motorunda çalıştırma
-            with engine.connect() as connection:
-                result_proxy = connection.execute(str(sql_query))
-                
-                # Sonuçları Dict formatına dönüştürme
-                columns = result_proxy.keys()
-                rows = [dict(zip(columns, row)) for row in result_proxy.fetchall()]
-                
-                logger.info(f"SQL execution successful. Returned {len(rows)} results.")
-                return rows
+            logger.info(f"Agent returned a raw SQL query without executing it. Executing it: {sql_query}")
+            executed = execute_select(sql_query)
+            logger.info(f"SQL execution successful. Returned {len(executed.rows)} results.")
+            return AgentQueryResult(sql=sql_query, rows=executed.rows)
         
-        # Ajanın çıktısını doğrudan liste/tuple formatında değerlendiriyoruz.
-        # Bu, en son AGENT_PROMPT_PREFIX'ine uygun davranışıdır.
+        # 3. Adım: Son çare olarak ajanın metin çıktısını tuple listesi olarak değerlendir.
         if isinstance(output, str):
             try:
                 # ast.literal_eval, string'i güvenli bir şekilde Python listesine çevirir.
                 parsed_output = ast.literal_eval(output)
 
-                # Sonuç tuple listesiyse, sözlük listesine çeviriyoruz.
+                # Sonuç tuple listesiyse, önbellekteki sütun isimleriyle sözlük listesine çeviriyoruz.
                 if isinstance(parsed_output, list) and all(isinstance(item, tuple) for item in parsed_output):
-                    
-                    # Veritabanından gelen sütun isimlerini almak için küçük bir sorgu yapıyoruz.
-                    with engine.connect() as connection:
-                        columns_result = connection.execute(text("PRAGMA table_info(araba_ilanlari)"))
-                        columns = [col[1] for col in columns_result.fetchall()]
-
-                    # Tuple listesini sözlük listesine çeviriyoruz.
-                    rows = [dict(zip(columns, row)) for row in parsed_output]
-                    return rows
+                    columns = get_table_columns()
+                    return AgentQueryResult(sql=None, rows=[dict(zip(columns, row)) for row in parsed_output])
 
                 # Eğer çıktı tuple listesi değilse boş liste döndürür.
-                return []
+                return AgentQueryResult(sql=None, rows=[])
 
             except (ValueError, SyntaxError):
                 logger.error(f"Could not parse agent string output: {output}")
-                return []
+                return AgentQueryResult(sql=None, rows=[])
         
         # Eğer çıktı zaten doğrudan bir liste ise, onu döndür.
-        return output if isinstance(output, list) else []
+        return AgentQueryResult(sql=None, rows=output if isinstance(output, list) else [])
 
+    except AdmissionRejected:
+        raise
     except TimeoutException:
         logger.error("SQL agent execution timed out after 40 seconds")
         raise ValueError("Sorgu işlemi zaman aşımına uğradı. Lütfen daha basit bir sorgu deneyin.")
     except Exception as e:
         logger.error(f"An error occurred during SQL agent execution: {e}", exc_info=True)
         raise ValueError(f"Failed to execute search query due to an agent or database error: {e}")
-    
+    finally:
+        _query_capture.reset(token)
+
+def run_sql_query_from_text(task: str, constraints: dict) -> List[Dict[str, Any]]:
+    """
+    Executes a natural language query against the database using an LLM agent and returns the rows.
+    """
+    return run_sql_agent(task, constraints).rows
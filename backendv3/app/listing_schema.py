@@ -0,0 +1,80 @@
+# app/listing_schema.py
+"""
+The listing payload: typed schema, field projection, JSON encoding and the LLM table.
+
+Result rows come from SQLite with every column of the table (including internal ones
+such as duplicate_of). Endpoints return only the fields of `Listing`, or the subset the
+client asks for with `fields`, and encode them with orjson straight into the response
+(CompactJSONResponse) instead of validating generic dicts through pydantic. `Listing`
+documents the payload in the OpenAPI schema.
+
+The summary prompt gets the rows as a pipe-separated table with one header line
+(`to_table`), which is a fraction of the tokens of a list of Python dicts.
+"""
+
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class Listing(BaseModel):
+    id: int = Field(..., description="Listing id.")
+    link: Optional[str] = Field(None, description="URL of the listing on arabam.com.")
+    fiyat: Optional[float] = Field(None, description="Price in TL.")
+    marka: Optional[str] = None
+    seri: Optional[str] = None
+    model: Optional[str] = None
+    yil: Optional[Union[int, str]] = Field(None, description="Model year.")
+    km: Optional[Union[float, str]] = Field(None, description="Mileage, e.g. '69.000 km'.")
+    vites: Optional[str] = None
+    yakit: Optional[str] = None
+    kasa_tipi: Optional[str] = None
+    renk: Optional[str] = None
+    boya: Optional[str] = None
+    parca: Optional[str] = None
+    deal_score: Optional[float] = Field(None, description="Price against the market median; 0.15 is 15% below.")
+
+LISTING_FIELDS: Tuple[str, ...] = tuple(Listing.model_fields)
+# The columns the summary prompt needs to describe a result.
+SUMMARY_FIELDS: Tuple[str, ...] = ("marka", "seri", "model", "yil", "km", "fiyat", "vites", "yakit", "deal_score")
+
+def parse_fields(fields: Optional[Union[str, Sequence[str]]]) -> Tuple[str, ...]:
+    """
+    The projection a client asked for: a comma-separated string or a list of field names,
+    all fields when empty. "id" is always included. Raises ValueError for unknown fields.
+    """
+    if not fields:
+        return LISTING_FIELDS
+    names = [name.strip() for name in (fields.split(",") if isinstance(fields, str) else fields) if name.strip()]
+    unknown = [name for name in names if name not in LISTING_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown listing fields: {', '.join(unknown)}. Available: {', '.join(LISTING_FIELDS)}.")
+    return ("id",) + tuple(dict.fromkeys(name for name in names if name != "id"))
+
+def project(rows: Iterable[Dict[str, Any]], fields: Sequence[str] = LISTING_FIELDS) -> List[Dict[str, Any]]:
+    """The rows with only the given fields, in schema order."""
+    return [{name: row.get(name) for name in fields} for row in rows]
+
+def to_table(rows: Sequence[Dict[str, Any]], fields: Sequence[str] = SUMMARY_FIELDS) -> str:
+    """Rows as a compact pipe-separated table for LLM prompts; empty cells for missing values."""
+    def cell(value: Any) -> str:
+        if value is None:
+            return ""
+        if isinstance(value, float):
+            return str(int(value)) if value.is_integer() else f"{value:.2f}"
+        return str(value).replace("|", "/")
+    lines = ["|".join(fields)]
+    lines.extend("|".join(cell(row.get(name)) for name in fields) for row in rows)
+    return "\n".join(lines)
+
+class CompactJSONResponse(JSONResponse):
+    """JSON response encoded with orjson (numpy values included)."""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
@@ -3,10 +3,13 @@
 import sys
 import os
 import uuid
+import time
+import asyncio
 import logging
-import json
+import hmac
+from contextlib import nullcontext
 logger = logging.getLogger(__name__)
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 
 # --- Project Setup ---
 # Ensures that modules within the 'app' directory can be imported
@@ -14,39 +17,92 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 # warnings.filterwarnings("ignore")
 
 # --- FastAPI and Pydantic Imports ---
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header, Depends, WebSocket
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 
 # --- Local Module Imports ---
 import database
+import parser
+import langchain_agent
+import singleflight
+import admission
+import circuit_breaker
+import plan_cache
+import usage_ledger
+import profiling
+import inventory
+import text_index
+import similarity
+import candidate_cache
+import maintenance
+import chat_socket
+import model_router
+import market
+import dedup
+import listing_schema
+import batch_eval
+import query_cache
+import shared_cache
+import prefetch
+from admission import AdmissionRejected
+from brand_mapping import get_database_brands
 from engine import process_chat_turn, SearchExecutionError
 from parser import Filters, Exclusions, Inferred, RawEntities
+from listing_schema import Listing, CompactJSONResponse
 
 # --- Application Setup ---
 app = FastAPI(
     title="Conversational Car Search API",
     description="An API that allows users to find cars through a stateful conversation.",
-    version="2.0.0"
+    version="2.0.0",
+    default_response_class=CompactJSONResponse,
 )
 
-# In-memory session storage. For production, use Redis or a similar persistent store.
-SESSIONS: Dict[str, Dict[str, Any]] = {}
+# Readiness state, filled in by the startup warm-up and reported by /ready.
+READINESS: Dict[str, Any] = {"ready": False, "warmup_seconds": None, "error": None}
+
+# Shared secret for the /admin endpoints and admin-only request headers. Unset disables them.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Dependency guarding admin endpoints with the X-Admin-Token header."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required.")
 
 # --- API Models ---
 
 class ChatRequest(BaseModel):
     user_query: str = Field(..., description="The user's latest message in the conversation.")
     session_id: Optional[str] = Field(None, description="The ID of the ongoing conversation. If null, a new session is created.")
+    fields: Optional[List[str]] = Field(None, description="Listing fields to return for each result; all fields if null.")
 
 class ChatResponse(BaseModel):
     session_id: str = Field(..., description="The unique ID for the conversation session.")
     response: str = Field(..., description="An AI-generated summary of the search results.")
-    results: List[Dict] = Field(..., description="A list of up to 25 cars matching the query.")
+    results: List[Listing] = Field(..., description="A list of up to 25 cars matching the query, with only the requested fields.")
     active_filters: Dict = Field(..., description="The currently active filters for the search.")
     inferred_assumptions: List[str] = Field(..., description="A list of assumptions made by the AI.")
 
+class BatchItem(BaseModel):
+    session_id: Optional[str] = Field(None, description="Items sharing a session_id run as consecutive turns; null for a one-turn session.")
+    user_query: str = Field(..., description="The message of this turn.")
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(..., description="Queries to run, answered in this order.")
+    max_concurrency: int = Field(batch_eval.BATCH_CONCURRENCY, ge=1, le=32, description="Parallel LLM calls and sessions.")
+    persist: bool = Field(False, description="Store the turns in the session history.")
+    fields: Optional[List[str]] = Field(None, description="Listing fields to return for each result; all fields if null.")
+
 # --- Middleware ---
+# Result lists compress well; small responses are not worth the CPU.
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MIN_BYTES", "1000")))
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://aracasistani.duckdns.org"],  # React frontend adresi
@@ -56,10 +112,62 @@ app.add_middleware(
 )
 
 # --- Application Events ---
+def preload():
+    """
+    Builds the read-only structures (inventory snapshot, model index, similarity matrix,
+    brand list, parse cache). gunicorn.conf.py calls this in the master process, so the
+    forked workers share them copy-on-write; in a single process warm_up() calls it.
+    """
+    database.init_db()
+    try:
+        # Clusters relisted copies of listings added since the last run (see dedup.py).
+        dedup.refresh()
+    except Exception as e:
+        logger.warning(f"Listing dedup failed; searches may show relisted copies: {e}")
+    try:
+        # Scores listings added since the last run before the inventory snapshot is taken.
+        market.refresh()
+    except Exception as e:
+        logger.warning(f"Market rollup refresh failed; deal scores may be stale: {e}")
+    get_database_brands()
+    inventory.get_inventory()
+    text_index.get_index()
+    similarity.get_matrix()
+    query_cache.warm()
+
+def warm_up():
+    """Primes caches and builds the LLM clients and SQL agent before traffic arrives."""
+    started = time.perf_counter()
+    try:
+        # Cheap when the master already preloaded: every structure is reused.
+        preload()
+        parser.warm_up()
+        langchain_agent.warm_up()
+        READINESS["ready"] = True
+    except Exception as e:
+        READINESS["error"] = str(e)
+        logger.error(f"Warm-up failed: {e}", exc_info=True)
+    finally:
+        READINESS["warmup_seconds"] = round(time.perf_counter() - started, 3)
+        logger.info(f"Warm-up finished in {READINESS['warmup_seconds']}s (ready={READINESS['ready']}).")
+
 @app.on_event("startup")
 async def startup_event():
-    """On application startup, initialize the database."""
+    """On application startup, initialize the database and warm up in the background."""
     database.init_db()
+    # Run the warm-up off the event loop so /health answers immediately.
+    asyncio.get_running_loop().run_in_executor(None, warm_up)
+    if maintenance.MAINTENANCE_INTERVAL_MINUTES > 0:
+        asyncio.create_task(history_maintenance_loop())
+
+async def history_maintenance_loop():
+    """Archives and deletes idle sessions every MAINTENANCE_INTERVAL_MINUTES (see maintenance.py)."""
+    while True:
+        await asyncio.sleep(maintenance.MAINTENANCE_INTERVAL_MINUTES * 60)
+        try:
+            await run_in_threadpool(maintenance.run)
+        except Exception as e:
+            logger.error(f"History maintenance failed: {e}", exc_info=True)
 
 # --- API Endpoints ---
 
@@ -68,43 +176,249 @@ async def health_check():
     """Provides a simple health check endpoint."""
     return {"status": "ok", "message": "All good!"}
 
-@app.post("/chat", response_model=ChatResponse, summary="Continue or Start a Conversation")
-async def search_and_chat(request: ChatRequest):
+@app.get("/ready", summary="Readiness Check")
+async def readiness_check():
+    """Reports whether caches and clients are primed. Returns 503 until warm-up completes."""
+    body = {
+        **READINESS,
+        "components": {
+            "brand_cache": get_database_brands.cache_info().currsize > 0,
+            "inventory": inventory.is_initialised(),
+            "parser_chain": parser.is_initialised(),
+            **langchain_agent.is_initialised(),
+        },
+    }
+    return JSONResponse(status_code=200 if READINESS["ready"] else 503, content=body)
+
+@app.get("/metrics", summary="Runtime Metrics")
+async def metrics():
+    """Exposes in-process counters: single-flight savings, LLM queue depth / wait times, breaker states and plan cache."""
+    return {
+        "singleflight": singleflight.stats(),
+        "admission": admission.stats(),
+        "circuit_breakers": circuit_breaker.stats(),
+        "plan_cache": plan_cache.stats(),
+        "candidate_cache": candidate_cache.stats(),
+        "history_maintenance": maintenance.stats(),
+        "model_router": model_router.stats(),
+        "market": market.stats(),
+        "dedup": dedup.stats(),
+        "query_cache": query_cache.stats(),
+        "shared_cache": shared_cache.stats(),
+        "prefetch": prefetch.stats(),
+        "pid": os.getpid(),
+    }
+
+# Admin only: grouping by session_id lists every live session id, the only key to a session.
+@app.get("/usage", summary="LLM Token and Cost Usage", dependencies=[Depends(require_admin)])
+async def llm_usage(
+    group_by: str = Query("stage,model,hour", description="Comma-separated: stage, model, hour, session_id."),
+    since_hours: Optional[int] = Query(24, description="Only include calls from the last N hours."),
+):
+    """Aggregates the per-call LLM usage ledger (tokens, cost, latency, retries)."""
+    columns = [c.strip() for c in group_by.split(",") if c.strip()]
+    try:
+        rows = await run_in_threadpool(usage_ledger.aggregate, columns, since_hours)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"group_by": columns, "since_hours": since_hours, "rows": rows}
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, session_id: Optional[str] = None):
+    """
+    Chat over a WebSocket with the session held by the connection: stage events, streamed
+    summary tokens and cancellation of the turn in flight (see chat_socket.py).
+    """
+    await chat_socket.serve(websocket, session_id)
+
+@app.get("/facets/{session_id}", summary="Facet Counts for a Session")
+async def session_facets(session_id: str):
+    """
+    Counts per brand, fuel, transmission, body type, year bucket and price bucket for the
+    session's current filters and exclusions. Served from in-memory masks, without an LLM call.
+    """
+    state = await run_in_threadpool(database.get_session_state, session_id)
+    if not state:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found.")
+    result = await run_in_threadpool(prefetch.get_facets, state)
+    return {"session_id": session_id, "active_filters": state.get("filters", {}), **result}
+
+@app.get("/results/{session_id}", summary="More Results for a Session")
+async def session_results(session_id: str, page: int = Query(1, ge=0, le=100, description="Page of 5 results; 0 is the turn's own page."),
+                          fields: Optional[str] = Query(None, description="Comma-separated listing fields; all if omitted.")):
+    """
+    A further page of results for the session's current filters, newest (or best value) first.
+    Usually served from the prefetch after the last turn, without an LLM call.
+    """
+    projection = _fields_or_400(fields)
+    state = await run_in_threadpool(database.get_session_state, session_id)
+    if not state:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found.")
+    results = await run_in_threadpool(prefetch.get_page, state, page)
+    return {"session_id": session_id, "page": page, "results": listing_schema.project(results, projection)}
+
+@app.get("/similar/{listing_id}", summary="Similar Listings")
+async def similar_listings(
+    listing_id: int,
+    k: int = Query(5, ge=1, le=similarity.MAX_NEIGHBOURS, description="Number of similar listings."),
+    max_per_brand: Optional[int] = Query(None, ge=1, description="Brand diversity: at most this many per brand."),
+    fields: Optional[str] = Query(None, description="Comma-separated listing fields; all if omitted."),
+):
+    """Nearest neighbours of a listing by price, mileage, year, brand, series, body, fuel and transmission."""
+    projection = _fields_or_400(fields)
+    result = await run_in_threadpool(similarity.find_similar, listing_id, k, max_per_brand)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Listing {listing_id} not found.")
+    return {
+        "listing_id": listing_id,
+        "listing": listing_schema.project([result["listing"]], projection)[0] if result["listing"] else None,
+        "results": [{**projected, "distance": row["distance"]}
+                    for projected, row in zip(listing_schema.project(result["results"], projection), result["results"])],
+    }
+
+@app.get("/admin/profiles", summary="List Stored Request Profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """Most recent request profiles first."""
+    return {"sample_rate": profiling.PROFILE_SAMPLE_RATE, "profiles": await run_in_threadpool(profiling.list_profiles)}
+
+@app.get("/admin/profiles/{request_id}", summary="Get a Request Profile", dependencies=[Depends(require_admin)])
+async def get_profile(request_id: str, format: str = Query("folded", description="'folded' (flame graph input) or 'json'.")):
+    """Returns a stored profile as folded stacks for flamegraph.pl / speedscope, or as a JSON summary."""
+    profile = await run_in_threadpool(profiling.get, request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"No profile stored for request '{request_id}'.")
+    if format == "folded":
+        return PlainTextResponse(profile.folded())
+    if format == "json":
+        return {**profile.summary(), "top_functions": profile.top_functions(), "stacks": dict(profile.stacks)}
+    raise HTTPException(status_code=400, detail="format must be 'folded' or 'json'.")
+
+@app.post("/admin/maintenance", summary="Run History Retention Now", dependencies=[Depends(require_admin)])
+async def run_maintenance(
+    dry_run: bool = Query(False, description="Only count the sessions that would be archived."),
+    ttl_hours: Optional[float] = Query(None, gt=0, description="Override SESSION_TTL_HOURS for this run."),
+):
+    """Archives sessions idle for longer than the TTL, deletes them in batches and reports the space reclaimed."""
+    try:
+        return await run_in_threadpool(
+            maintenance.run, ttl_hours or maintenance.SESSION_TTL_HOURS, maintenance.HISTORY_ARCHIVE_DIR, dry_run
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/admin/market/rebuild", summary="Recompute Market Rollups", dependencies=[Depends(require_admin)])
+async def rebuild_market(full: bool = Query(False, description="Recompute every series, not only those with new listings.")):
+    """Recomputes the market rollups and listing deal scores (see market.py)."""
+    return await run_in_threadpool(market.rebuild if full else market.refresh)
+
+@app.post("/admin/dedup/rebuild", summary="Re-cluster Duplicate Listings", dependencies=[Depends(require_admin)])
+async def rebuild_dedup(full: bool = Query(False, description="Re-cluster every block, not only those with new listings.")):
+    """
+    Clusters relisted copies of listings onto one canonical listing and recomputes the market
+    rollups of every series whose listings were relinked (see dedup.py).
+    """
+    return await run_in_threadpool(dedup.rebuild if full else dedup.refresh)
+
+@app.post("/chat/batch", summary="Run an Offline Query Set", dependencies=[Depends(require_admin)])
+async def chat_batch(request: BatchRequest):
+    """
+    Runs many chat turns in one call: identical queries are parsed once, parsing is batched
+    with bounded concurrency and sessions run in parallel. Items come back in input order.
+    """
+    projection = _fields_or_400(request.fields)
+    items = [item.model_dump() for item in request.items]
+    try:
+        report = await run_in_threadpool(batch_eval.run_batch, items, request.max_concurrency, request.persist)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for item in report["items"]:
+        if item and "results" in item:
+            item["results"] = listing_schema.project(item["results"], projection)
+    return report
+
+def _fields_or_400(fields) -> tuple:
+    try:
+        return listing_schema.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _run_turn(profile: Optional[profiling.RequestProfile], session_id: str, turn: int,
+              user_query: str, last_state: Dict[str, Any], conversation_history: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Runs one chat turn in the worker thread, sampled when a profile is active."""
+    with profile.attach("chat_turn") if profile else nullcontext():
+        return usage_ledger.run_in_turn(
+            session_id, turn, process_chat_turn, user_query, last_state, conversation_history, session_id=session_id
+        )
+
+def _load_session(session_id: str) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """The session's turns and current state; blocking SQLite reads, so callers use the thread pool."""
+    conversation_history = database.get_history_for_session(session_id)
+    return conversation_history, database.get_session_state(session_id) if conversation_history else {}
+
+def _save_turn(profile: Optional[profiling.RequestProfile], session_id: str, user_query: str, state: Dict[str, Any]):
+    """Stores the turn and schedules its prefetch in the worker thread; the history write may wait on the lock."""
+    with profile.attach("save_turn") if profile else nullcontext():
+        database.add_turn_to_history(session_id, user_query, state)
+        # Warm the likely next request in the background (see prefetch.py).
+        prefetch.schedule(session_id, state)
+
+# Not a response_model: the projected rows are encoded as they are, without validation through
+# ChatResponse (see listing_schema). ChatResponse only documents the payload in the OpenAPI schema.
+@app.post("/chat", response_model=None, responses={200: {"model": ChatResponse}},
+          summary="Continue or Start a Conversation")
+async def search_and_chat(request: ChatRequest,
+                          x_profile: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
 
     session_id = request.session_id or str(uuid.uuid4())
+    projection = _fields_or_400(request.fields)
     # Retrieve conversation history and determine the last known state of filters
-    conversation_history = database.get_history_for_session(session_id)
-    last_state = json.loads(conversation_history[-1]['filters_json']) if conversation_history else {}
+    conversation_history, last_state = await run_in_threadpool(_load_session, session_id)
 
     
     logger.info(f"Processing turn for session_id: {session_id}")
+
+    # Profiling is opt-in: admins send "X-Profile: 1", otherwise a sampled fraction of traffic.
+    profile_reason = profiling.should_profile(x_profile == "1" and is_admin(x_admin_token))
+    profile = profiling.start(profile_reason) if profile_reason else None
     
     try:
         # The engine now manages the conversational turn and returns all necessary components
-        processed_data = process_chat_turn(request.user_query, last_state, conversation_history)
-        
-        # Save the new turn to the database
-        database.add_turn_to_history(
-            session_id,
-            request.user_query,
-            processed_data["updated_session_state"]
+        # Run the blocking turn in the thread pool so concurrent requests (and single-flight
+        # coalescing between them) are not serialised on the event loop.
+        # LLM usage of this turn is attributed to (session_id, turn) in the usage ledger.
+        turn = len(conversation_history) + 1
+        processed_data = await run_in_threadpool(
+            _run_turn, profile, session_id, turn, request.user_query, last_state, conversation_history
         )
         
-        # Construct the final response
-        return ChatResponse(
-            session_id=session_id,
-            response=processed_data["comment"],
-            results=processed_data["results"],
-            active_filters=processed_data["updated_session_state"].get("filters", {}),
-            inferred_assumptions=processed_data["updated_session_state"].get("inferred", {}).get("assumptions", [])
+        # Save the new turn to the database (off the event loop: the write serialises with other writers)
+        await run_in_threadpool(
+            _save_turn, profile, session_id, request.user_query, processed_data["updated_session_state"]
         )
 
+        with profile.attach("serialise") if profile else nullcontext():
+            # Construct the final response: projected rows encoded directly, not validated against ChatResponse
+            return CompactJSONResponse({
+                "session_id": session_id,
+                "response": processed_data["comment"],
+                "results": listing_schema.project(processed_data["results"], projection),
+                "active_filters": processed_data["updated_session_state"].get("filters", {}),
+                "inferred_assumptions": processed_data["updated_session_state"].get("inferred", {}).get("assumptions", []),
+            }, headers={"X-Profile-ID": profile.request_id} if profile else None)
+
+    except AdmissionRejected as e:
+        logger.warning(f"Rejected turn for session {session_id}: {e}")
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except SearchExecutionError as e:
         logger.error(f"SearchExecutionError in session {session_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         logger.error(f"An unexpected error occurred in session {session_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An unexpected internal error occurred.")
+    finally:
+        if profile:
+            # Off the event loop: joins the sampler thread and writes the profile to the shared cache
+            await run_in_threadpool(profiling.finish, profile)
 
 # --- Main Entry ---
 if __name__ == "__main__":
@@ -0,0 +1,222 @@
+# app/maintenance.py
+"""
+Retention for user_history.db.
+
+Sessions idle for longer than SESSION_TTL_HOURS are archived and removed from the live
+conversation_history table. Archives are gzip-compressed JSON lines, one line per session
+with every turn's query and fully rebuilt state (no deltas), in one append-only segment
+file per UTC day under HISTORY_ARCHIVE_DIR. Each batch is appended as its own gzip member,
+so a segment is never rewritten and a crash can at worst leave a truncated last member.
+
+Deletion runs in small batches, each in its own write transaction that also covers the
+archive write, so /chat never waits long for the lock and no session is deleted before it
+is archived. Freed pages are returned to the filesystem with incremental vacuum.
+"""
+
+import os
+import gzip
+import json
+import glob
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import database
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", str(30 * 24)))
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", os.path.join(os.path.dirname(__file__), "archive"))
+MAINTENANCE_BATCH_SESSIONS = int(os.getenv("MAINTENANCE_BATCH_SESSIONS", "200"))
+MAINTENANCE_BATCH_PAUSE_SECONDS = float(os.getenv("MAINTENANCE_BATCH_PAUSE_SECONDS", "0.05"))
+# Interval of the background job started by main.py; 0 disables it.
+MAINTENANCE_INTERVAL_MINUTES = float(os.getenv("MAINTENANCE_INTERVAL_MINUTES", "60"))
+
+# Pages returned to the filesystem per incremental_vacuum call.
+VACUUM_PAGES_PER_STEP = 256
+
+_run_lock = threading.Lock()
+_last_report: Optional[Dict[str, Any]] = None
+
+# --- Archive segments ---
+
+def segment_path(archive_dir: str, now: Optional[datetime] = None) -> str:
+    day = (now or datetime.now(timezone.utc)).strftime("%Y%m%d")
+    return os.path.join(archive_dir, f"history-{day}.jsonl.gz")
+
+def _append_segment(path: str, sessions: List[Dict[str, Any]]) -> int:
+    """Appends one gzip member with one JSON line per session; returns the bytes written."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    payload = "".join(json.dumps(s, ensure_ascii=False) + "\n" for s in sessions).encode("utf-8")
+    member = gzip.compress(payload)
+    with open(path, "ab") as f:
+        f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+    return len(member)
+
+def read_archive(archive_dir: str = HISTORY_ARCHIVE_DIR) -> Iterator[Dict[str, Any]]:
+    """
+    Archived sessions, oldest segment first. A truncated final member (e.g. after a crash
+    during an append) ends that segment instead of failing the whole read.
+    """
+    for path in sorted(glob.glob(os.path.join(archive_dir, "history-*.jsonl.gz"))):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+            logger.warning(f"Stopped reading truncated archive segment {path}: {e}")
+
+# --- Retention job ---
+
+def _space(conn: sqlite3.Connection) -> Dict[str, int]:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        "file_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+    }
+
+def _ensure_incremental_vacuum(conn: sqlite3.Connection):
+    """Switches the database to auto_vacuum=INCREMENTAL; an existing file needs one full VACUUM for that."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logger.info("Enabling incremental auto-vacuum on user_history.db (one-off full VACUUM).")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+def _archive_batch(conn: sqlite3.Connection, cutoff: str, archive_path: str) -> Dict[str, int]:
+    """Archives and deletes up to MAINTENANCE_BATCH_SESSIONS expired sessions in one write transaction."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        session_ids = [row[0] for row in conn.execute("""
+            SELECT session_id FROM conversation_history
+            GROUP BY session_id
+            HAVING MAX(created_at) < ?
+            LIMIT ?
+        """, (cutoff, MAINTENANCE_BATCH_SESSIONS))]
+        if not session_ids:
+            conn.execute("ROLLBACK")
+            return {"sessions": 0, "turns": 0, "archive_bytes": 0}
+
+        ids_json = json.dumps(session_ids)
+        # Databases not yet migrated by database.init_db hold full states only.
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(conversation_history)")}
+        state_kind = "state_kind" if "state_kind" in columns else "'snapshot' AS state_kind"
+        rows = conn.execute(f"""
+            SELECT session_id, turn, user_query, {state_kind}, filters_json, created_at
+            FROM conversation_history
+            WHERE session_id IN (SELECT value FROM json_each(?))
+            ORDER BY session_id, turn
+        """, (ids_json,)).fetchall()
+
+        by_session: Dict[str, List[sqlite3.Row]] = {}
+        for row in rows:
+            by_session.setdefault(row["session_id"], []).append(row)
+        archived_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        sessions = []
+        for session_id, turns in by_session.items():
+            states = database.replay_states([(t["state_kind"], t["filters_json"]) for t in turns])
+            sessions.append({
+                "session_id": session_id,
+                "archived_at": archived_at,
+                "turns": [
+                    {"turn": t["turn"], "user_query": t["user_query"], "created_at": t["created_at"], "state": state}
+                    for t, state in zip(turns, states)
+                ],
+            })
+
+        archive_bytes = _append_segment(archive_path, sessions)
+        conn.execute("DELETE FROM conversation_history WHERE session_id IN (SELECT value FROM json_each(?))", (ids_json,))
+        conn.execute("COMMIT")
+        return {"sessions": len(sessions), "turns": len(rows), "archive_bytes": archive_bytes}
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+def run(ttl_hours: float = SESSION_TTL_HOURS, archive_dir: str = HISTORY_ARCHIVE_DIR,
+        dry_run: bool = False, db_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Archives and deletes every session idle for longer than `ttl_hours`, then vacuums the
+    freed pages. With dry_run, only counts what would be archived.
+    """
+    global _last_report
+    if not _run_lock.acquire(blocking=False):
+        raise RuntimeError("A maintenance run is already in progress.")
+    started = time.perf_counter()
+    try:
+        with closing(sqlite3.connect(db_path or database.DB_PATH, isolation_level=None)) as conn:
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout = 5000")
+            before = _space(conn)
+            if not dry_run:
+                _ensure_incremental_vacuum(conn)
+
+            cutoff = conn.execute("SELECT datetime('now', ?)", (f"-{ttl_hours} hours",)).fetchone()[0]
+            archive_path = segment_path(archive_dir)
+            totals = {"sessions": 0, "turns": 0, "archive_bytes": 0, "batches": 0}
+            if dry_run:
+                totals["sessions"], totals["turns"] = conn.execute("""
+                    SELECT COUNT(*), COALESCE(SUM(turns), 0) FROM (
+                        SELECT COUNT(*) AS turns FROM conversation_history
+                        GROUP BY session_id HAVING MAX(created_at) < ?
+                    )
+                """, (cutoff,)).fetchone()
+            else:
+                while True:
+                    batch = _archive_batch(conn, cutoff, archive_path)
+                    if not batch["sessions"]:
+                        break
+                    totals["batches"] += 1
+                    for key in ("sessions", "turns", "archive_bytes"):
+                        totals[key] += batch[key]
+                    # Return some of the freed pages right away and let /chat writers in between batches.
+                    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})").fetchall()
+                    time.sleep(MAINTENANCE_BATCH_PAUSE_SECONDS)
+                while conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+                    conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP})").fetchall()
+            after = _space(conn)
+            remaining = conn.execute("SELECT COUNT(DISTINCT session_id) FROM conversation_history").fetchone()[0]
+
+        report = {
+            "dry_run": dry_run,
+            "ttl_hours": ttl_hours,
+            "cutoff": cutoff,
+            "archive_segment": archive_path if totals["sessions"] and not dry_run else None,
+            "archived_sessions": totals["sessions"],
+            "archived_turns": totals["turns"],
+            "batches": totals["batches"],
+            "archive_bytes": totals["archive_bytes"],
+            "live_sessions": remaining,
+            "file_bytes_before": before["file_bytes"],
+            "file_bytes_after": after["file_bytes"],
+            "reclaimed_bytes": before["file_bytes"] - after["file_bytes"],
+            "seconds": round(time.perf_counter() - started, 3),
+            "finished_at": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if not dry_run:
+            _last_report = report
+        logger.info(f"History maintenance: {report}")
+        return report
+    finally:
+        _run_lock.release()
+
+def stats() -> Optional[Dict[str, Any]]:
+    """The report of the last completed (non-dry) run, if any."""
+    return _last_report
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description="Archive and delete idle sessions from user_history.db.")
+    arg_parser.add_argument("--ttl-hours", type=float, default=SESSION_TTL_HOURS)
+    arg_parser.add_argument("--archive-dir", default=HISTORY_ARCHIVE_DIR)
+    arg_parser.add_argument("--dry-run", action="store_true")
+    args = arg_parser.parse_args()
+    print(json.dumps(run(args.ttl_hours, args.archive_dir, args.dry_run), indent=2))
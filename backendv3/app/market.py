@@ -0,0 +1,401 @@
+# app/market.py
+"""
+Market rollups and deal scores.
+
+`market_rollups` holds, per (marka, seri, yil bucket, km bucket), the number of listings,
+the 25th / 50th / 75th percentile price and the series' yearly depreciation rate (from a
+log-price-by-year fit over the whole series). A second row per (marka, seri, yil bucket)
+with km_bucket = ANY_KM covers every mileage and is used when the mileage band has fewer
+than MARKET_MIN_GROUP_SIZE listings. Prices outside their series' IQR fences around its
+log-price-by-year trend (drop_outliers) are left out of every rollup, so one placeholder price
+cannot move a thin band.
+
+Every listing gets `deal_score = 1 - fiyat / median` against its band, so 0.15 means 15%
+below the market median and negative values are above it. The column is indexed, so
+"best deals" searches sort in SQL. Listings whose band has fewer than
+MARKET_MIN_SCORE_COMPARABLES listings, and outliers, keep NULL.
+
+Recomputation is incremental: `refresh()` only rebuilds the series of listings added since
+the last run (tracked by an id watermark in `market_meta`); the crawler calls it after each
+insert and warm_up() calls it at startup. `rebuild()` recomputes every series, and
+`recompute_series()` the series whose listings dedup.py relinked.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+# pandas is imported where rollups are computed, which keeps it out of the API's import time.
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.path.join(os.path.dirname(__file__), "araba_verileri.db")
+TABLE_NAME = "araba_ilanlari"
+
+YEAR_BUCKET_YEARS = int(os.getenv("MARKET_YEAR_BUCKET_YEARS", "2"))
+KM_BUCKET_SIZE = int(os.getenv("MARKET_KM_BUCKET_SIZE", "50000"))
+KM_BUCKET_CAP = int(os.getenv("MARKET_KM_BUCKET_CAP", "250000"))   # One band for everything above
+MIN_GROUP_SIZE = int(os.getenv("MARKET_MIN_GROUP_SIZE", "5"))
+# Comparables a band needs before its median sets deal_score, which orders best-value searches.
+MIN_SCORE_COMPARABLES = int(os.getenv("MARKET_MIN_SCORE_COMPARABLES", "10"))
+# Prices further than this many interquartile ranges outside their series' quartiles, after the
+# series' year trend (placeholders such as 2.000.005 TL on a 1995 R19, typos), are left out of the rollups.
+OUTLIER_IQR_FACTOR = float(os.getenv("MARKET_OUTLIER_IQR_FACTOR", "3.0"))
+# Lower bound on the log-price IQR, so a series of near-identical prices keeps its ordinary listings.
+MIN_LOG_IQR = 0.1
+# Listings at least this far below their market median are called out in summaries.
+GOOD_DEAL_THRESHOLD = float(os.getenv("MARKET_GOOD_DEAL_THRESHOLD", "0.10"))
+
+ANY_KM = -1
+
+_lock = threading.Lock()
+_stats: Dict[str, Any] = {"last_refresh": None, "refreshes": 0, "series_recomputed": 0}
+
+# --- Schema ---
+
+def ensure_schema(conn: sqlite3.Connection) -> bool:
+    """Creates the rollup tables and the indexed deal_score column; True if anything was added."""
+    changed = False
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+    if "deal_score" not in columns:
+        conn.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN deal_score REAL")
+        changed = True
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_deal_score ON {TABLE_NAME}("deal_score")')
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS market_rollups (
+            marka TEXT NOT NULL,
+            seri TEXT NOT NULL,
+            yil_bucket INTEGER NOT NULL,
+            km_bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            price_p25 REAL,
+            price_median REAL,
+            price_p75 REAL,
+            depreciation_rate REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (marka, seri, yil_bucket, km_bucket)
+        )
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS market_meta (key TEXT PRIMARY KEY, value INTEGER)")
+    return changed
+
+# --- Vectorised computation ---
+
+def _km_numbers(km: "pd.Series") -> "pd.Series":
+    """Same parsing as query_builder.KM_EXPR: '69.000 km' -> 69000."""
+    import pandas as pd
+    text = km.map(lambda v: isinstance(v, str))
+    parsed = pd.to_numeric(km.where(~text), errors="coerce")
+    cleaned = km[text].astype(str).str.replace(".", "", regex=False).str.replace(" km", "", regex=False)
+    parsed[text] = pd.to_numeric(cleaned.str.extract(r"^\s*(\d+)", expand=False), errors="coerce")
+    return parsed
+
+def _km_value(value: Any) -> float:
+    """Scalar form of _km_numbers for single rows."""
+    if isinstance(value, str):
+        return float(value.replace(".", "").replace(" km", "").strip())
+    return float(value)
+
+def bucket_year(yil: Any) -> Any:
+    return (yil // YEAR_BUCKET_YEARS) * YEAR_BUCKET_YEARS
+
+def bucket_km(km: Any) -> Any:
+    return np.minimum(km // KM_BUCKET_SIZE * KM_BUCKET_SIZE, KM_BUCKET_CAP)
+
+def _prepare(frame: "pd.DataFrame") -> "pd.DataFrame":
+    """Listings with a usable price, year and mileage, with their bucket keys."""
+    import pandas as pd
+    frame = frame.assign(
+        fiyat=pd.to_numeric(frame["fiyat"], errors="coerce"),
+        yil=pd.to_numeric(frame["yil"], errors="coerce"),
+        km=_km_numbers(frame["km"]),
+    )
+    frame = frame[(frame["fiyat"] > 0) & frame["yil"].notna() & frame["km"].notna()
+                  & frame["marka"].notna() & frame["seri"].notna()].copy()
+    frame["yil_bucket"] = bucket_year(frame["yil"]).astype(int)
+    frame["km_bucket"] = bucket_km(frame["km"]).astype(int)
+    return frame
+
+def drop_outliers(frame: "pd.DataFrame") -> "pd.DataFrame":
+    """
+    The prepared listings without price outliers. Log prices are taken relative to their
+    series' least-squares log-price-by-year trend, and residuals beyond OUTLIER_IQR_FACTOR
+    interquartile ranges from the series' residual quartiles are dropped. Series smaller
+    than MIN_GROUP_SIZE are kept as they are.
+    """
+    keys = [frame["marka"], frame["seri"]]
+    x, y = frame["yil"].astype(float), np.log(frame["fiyat"])
+    dx = x - x.groupby(keys).transform("mean")
+    dy = y - y.groupby(keys).transform("mean")
+    sxx = (dx * dx).groupby(keys).transform("sum")
+    sxy = (dx * dy).groupby(keys).transform("sum")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (sxy / sxx).where(sxx > 1e-9, 0.0)
+    residual = dy - slope * dx
+    grouped = residual.groupby(keys)
+    q1, q3 = grouped.transform("quantile", 0.25), grouped.transform("quantile", 0.75)
+    fence = OUTLIER_IQR_FACTOR * np.maximum(q3 - q1, MIN_LOG_IQR)
+    keep = (grouped.transform("size") < MIN_GROUP_SIZE) | residual.between(q1 - fence, q3 + fence)
+    return frame[keep]
+
+def _depreciation(frame: "pd.DataFrame") -> "pd.Series":
+    """Yearly depreciation per (marka, seri): slope of the least-squares fit of log(price) on year."""
+    import pandas as pd
+    x = frame["yil"]
+    y = np.log(frame["fiyat"])
+    grouped = pd.DataFrame({"marka": frame["marka"], "seri": frame["seri"], "x": x, "y": y, "xy": x * y, "xx": x * x})
+    sums = grouped.groupby(["marka", "seri"]).agg(n=("x", "size"), x=("x", "sum"), y=("y", "sum"),
+                                                   xy=("xy", "sum"), xx=("xx", "sum"))
+    var = sums["xx"] - sums["x"] ** 2 / sums["n"]
+    cov = sums["xy"] - sums["x"] * sums["y"] / sums["n"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = cov / var
+    rate = 1 - np.exp(-slope)
+    # Too few listings or a single model year: no meaningful slope.
+    return rate.where((sums["n"] >= MIN_GROUP_SIZE) & (var > 1e-9)).rename("depreciation_rate")
+
+def compute_rollups(frame: "pd.DataFrame") -> "pd.DataFrame":
+    """Rollup rows for the prepared listings: one per mileage band plus one ANY_KM row per year bucket."""
+    import pandas as pd
+    bands = frame.assign(km_bucket=frame["km_bucket"])
+    any_km = frame.assign(km_bucket=ANY_KM)
+    both = pd.concat([bands, any_km], ignore_index=True)
+    keys = ["marka", "seri", "yil_bucket", "km_bucket"]
+    quantiles = both.groupby(keys)["fiyat"].quantile([0.25, 0.5, 0.75]).unstack()
+    quantiles.columns = ["price_p25", "price_median", "price_p75"]
+    rollups = both.groupby(keys).size().rename("count").to_frame().join(quantiles).reset_index()
+    return rollups.join(_depreciation(frame), on=["marka", "seri"])
+
+def compute_deal_scores(frame: "pd.DataFrame", rollups: "pd.DataFrame") -> "pd.Series":
+    """
+    deal_score per listing id against its mileage band, or the whole year bucket for thin bands.
+    Bands with fewer than MIN_SCORE_COMPARABLES listings give no score.
+    """
+    import pandas as pd
+    usable = rollups[rollups["count"] >= MIN_SCORE_COMPARABLES]
+    keys = ["marka", "seri", "yil_bucket", "km_bucket"]
+    band = frame.merge(usable[keys + ["price_median"]], on=keys, how="left")["price_median"]
+    year = frame.merge(
+        usable[usable["km_bucket"] == ANY_KM][["marka", "seri", "yil_bucket", "price_median"]],
+        on=["marka", "seri", "yil_bucket"], how="left",
+    )["price_median"]
+    median = band.fillna(year).to_numpy()
+    scores = np.round(1 - frame["fiyat"].to_numpy() / median, 4)
+    return pd.Series(scores, index=frame["id"].to_numpy(), name="deal_score")
+
+# --- Persistence ---
+
+def _columns(conn: sqlite3.Connection) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE_NAME})")}
+
+def _load(conn: sqlite3.Connection, series: Optional[List[Tuple[str, str]]]) -> "pd.DataFrame":
+    import pandas as pd
+    # Relisted copies (see dedup.py) would count one car several times in the medians.
+    canonical = '"duplicate_of" IS NULL' if "duplicate_of" in _columns(conn) else "1 = 1"
+    sql = f'SELECT "id", "marka", "seri", "fiyat", "yil", "km" FROM {TABLE_NAME} WHERE {canonical}'
+    params: List[Any] = []
+    if series is not None:
+        sql += """ AND ("marka", "seri") IN (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))"""
+        params.append(json.dumps(series, ensure_ascii=False))
+    return pd.read_sql_query(sql, conn, params=params)
+
+def _recompute(conn: sqlite3.Connection, series: Optional[List[Tuple[str, str]]]) -> int:
+    """Replaces the rollups and deal scores of the given series (all when None); returns the series count."""
+    raw = _load(conn, series)
+    frame = drop_outliers(_prepare(raw))
+    rollups = compute_rollups(frame)
+    scores = compute_deal_scores(frame, rollups)
+
+    if series is None:
+        conn.execute("DELETE FROM market_rollups")
+        conn.execute(f"UPDATE {TABLE_NAME} SET deal_score = NULL WHERE deal_score IS NOT NULL")
+    else:
+        series_json = json.dumps(series, ensure_ascii=False)
+        conn.execute("""
+            DELETE FROM market_rollups WHERE (marka, seri) IN (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+        """, (series_json,))
+        # Every row of the series, so listings that have become relisted copies lose their score too.
+        conn.execute(f"""
+            UPDATE {TABLE_NAME} SET deal_score = NULL WHERE deal_score IS NOT NULL AND ("marka", "seri") IN (
+                SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+        """, (series_json,))
+    conn.executemany(
+        """INSERT INTO market_rollups (marka, seri, yil_bucket, km_bucket, count, price_p25, price_median,
+                                       price_p75, depreciation_rate)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (r.marka, r.seri, int(r.yil_bucket), int(r.km_bucket), int(r.count), float(r.price_p25),
+             float(r.price_median), float(r.price_p75),
+             None if np.isnan(r.depreciation_rate) else round(float(r.depreciation_rate), 4))
+            for r in rollups.itertuples(index=False)
+        ],
+    )
+    scored = scores.dropna()
+    conn.executemany(f'UPDATE {TABLE_NAME} SET deal_score = ? WHERE "id" = ?',
+                     zip(scored.tolist(), scored.index.tolist()))
+    return int(frame.groupby(["marka", "seri"]).ngroups)
+
+def _set_watermark(conn: sqlite3.Connection):
+    conn.execute(
+        f"INSERT OR REPLACE INTO market_meta (key, value) SELECT 'last_listing_id', COALESCE(MAX(\"id\"), 0) FROM {TABLE_NAME}"
+    )
+
+def _connect(db_path: Optional[str]) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path or DB_PATH, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    return conn
+
+def _finish(kind: str, series_count: int, started: float) -> Dict[str, Any]:
+    report = {"kind": kind, "series_recomputed": series_count, "seconds": round(time.perf_counter() - started, 3)}
+    with _lock:
+        _stats["last_refresh"] = report
+        _stats["refreshes"] += 1
+        _stats["series_recomputed"] += series_count
+    logger.info(f"Market rollups {kind}: {series_count} series in {report['seconds']}s.")
+    return report
+
+def rebuild(db_path: Optional[str] = None) -> Dict[str, Any]:
+    """Recomputes the rollups and deal scores of every series."""
+    started = time.perf_counter()
+    with closing(_connect(db_path)) as conn:
+        ensure_schema(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            series_count = _recompute(conn, None)
+            _set_watermark(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return _finish("rebuild", series_count, started)
+
+def refresh(db_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Recomputes only the series of listings added since the last refresh. The first call on
+    a database without rollups is a full rebuild.
+    """
+    started = time.perf_counter()
+    with closing(_connect(db_path)) as conn:
+        ensure_schema(conn)
+        watermark = conn.execute("SELECT value FROM market_meta WHERE key = 'last_listing_id'").fetchone()
+        if watermark is None:
+            return rebuild(db_path)
+        # Nothing new: skip the write, which would also invalidate every process's inventory snapshot.
+        latest = conn.execute(f'SELECT COALESCE(MAX("id"), 0) FROM {TABLE_NAME}').fetchone()[0]
+        if latest <= watermark[0]:
+            return _finish("refresh", 0, started)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            series = [tuple(row) for row in conn.execute(
+                f'SELECT DISTINCT "marka", "seri" FROM {TABLE_NAME} WHERE "id" > ? AND "marka" IS NOT NULL AND "seri" IS NOT NULL',
+                (watermark[0],),
+            )]
+            series_count = _recompute(conn, series) if series else 0
+            _set_watermark(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return _finish("refresh", series_count, started)
+
+def recompute_series(series: List[Tuple[str, str]], db_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Recomputes the rollups and deal scores of the given (marka, seri) series, e.g. after dedup
+    relinked some of their listings. Does nothing on a database without rollups yet: the
+    first refresh() rebuilds everything anyway.
+    """
+    started = time.perf_counter()
+    with closing(_connect(db_path)) as conn:
+        ensure_schema(conn)
+        if conn.execute("SELECT 1 FROM market_meta WHERE key = 'last_listing_id'").fetchone() is None:
+            return _finish("series", 0, started)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            series_count = _recompute(conn, [tuple(s) for s in series])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return _finish("series", series_count, started)
+
+# --- Lookups ---
+
+def context_for(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Market context of each result row for summaries: the band median, the number of
+    comparables, the deal score and the series' yearly depreciation. Rows without a usable
+    band are left out.
+    """
+    keyed = []
+    for row in rows:
+        try:
+            yil = int(row.get("yil"))
+            km = _km_value(row.get("km"))
+        except (TypeError, ValueError):
+            continue
+        if not row.get("marka") or not row.get("seri"):
+            continue
+        keyed.append((row, int(bucket_year(yil)), int(bucket_km(km))))
+    if not keyed:
+        return []
+
+    try:
+        with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)) as conn:
+            # No rollups until warm-up has migrated the database: no context, and nothing to report.
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'market_rollups'").fetchone() is None:
+                return []
+            lookups = {}
+            for row, yil_bucket, km_bucket in keyed:
+                lookups[row.get("id")] = conn.execute("""
+                    SELECT km_bucket, count, price_p25, price_median, price_p75, depreciation_rate
+                    FROM market_rollups
+                    WHERE marka = ? AND seri = ? AND yil_bucket = ? AND km_bucket IN (?, ?) AND count >= ?
+                    ORDER BY km_bucket = ? LIMIT 1
+                """, (row["marka"], row["seri"], yil_bucket, km_bucket, ANY_KM, MIN_GROUP_SIZE, ANY_KM)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Market context unavailable: {e}")
+        return []
+
+    context = []
+    for row, yil_bucket, km_bucket in keyed:
+        found = lookups.get(row.get("id"))
+        if found is None:
+            continue
+        band_km, count, p25, median, p75, depreciation = found
+        entry = {
+            "id": row.get("id"),
+            "ilan": f"{row.get('yil')} {row.get('marka')} {row.get('seri')}",
+            "karsilastirma": f"{yil_bucket}-{yil_bucket + YEAR_BUCKET_YEARS - 1} model"
+                             + ("" if band_km == ANY_KM else f", {band_km // 1000}-{(band_km + KM_BUCKET_SIZE) // 1000} bin km"),
+            "benzer_ilan_sayisi": count,
+            "piyasa_medyani": round(median),
+            "piyasa_araligi": [round(p25), round(p75)],
+        }
+        if row.get("fiyat"):
+            entry["medyana_gore_fark_yuzde"] = round((1 - row["fiyat"] / median) * 100, 1)
+        if depreciation is not None:
+            entry["yillik_deger_kaybi_yuzde"] = round(depreciation * 100, 1)
+        context.append(entry)
+    return context
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return dict(_stats)
+
+if __name__ == "__main__":
+    import argparse
+    logging.basicConfig(level=logging.INFO)
+    arg_parser = argparse.ArgumentParser(description="Recompute market rollups and deal scores.")
+    arg_parser.add_argument("--full", action="store_true", help="Recompute every series instead of only new listings.")
+    arg_parser.add_argument("--db", default=DB_PATH)
+    args = arg_parser.parse_args()
+    print(json.dumps((rebuild if args.full else refresh)(args.db), indent=2))
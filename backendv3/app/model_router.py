@@ -0,0 +1,221 @@
+# app/model_router.py
+"""
+Per-stage model routing.
+
+Each LLM stage (parse, sql, summary) picks a tier for the turn:
+  lite  the cheaper, faster model (gemini-2.5-flash-lite)
+  full  the stronger model (gemini-2.5-flash)
+  skip  no LLM call; the stage takes its local path (rule-based parser, compiled SQL,
+        template summary)
+The choice uses complexity signals (active constraints, raw entities, parse confidence,
+diversity requests, query length) and the time left before the turn's deadline, measured
+against an exponentially weighted average of each (stage, model) latency observed so far.
+Every decision is logged and counted, and the usage ledger records the model of every
+call, so `/usage?group_by=stage,model` shows what routing saved.
+
+The chosen model reaches the parser, the SQL agent and the summary chain through a
+context variable (see `routed` and `model_for`), so their signatures do not change.
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+ROUTING_ENABLED = os.getenv("MODEL_ROUTING", "1") != "0"
+MODEL_TIERS = {
+    "lite": os.getenv("ROUTER_LITE_MODEL", "gemini-2.5-flash-lite"),
+    "full": os.getenv("ROUTER_FULL_MODEL", "gemini-2.5-flash"),
+}
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "25"))
+SIMPLE_MAX_CONSTRAINTS = int(os.getenv("ROUTER_SIMPLE_MAX_CONSTRAINTS", "3"))
+SIMPLE_MAX_ENTITIES = int(os.getenv("ROUTER_SIMPLE_MAX_ENTITIES", "3"))
+MIN_CONFIDENCE = float(os.getenv("ROUTER_MIN_CONFIDENCE", "0.7"))
+PARSE_FULL_MIN_WORDS = int(os.getenv("ROUTER_PARSE_FULL_MIN_WORDS", "20"))
+
+# Latency estimates (seconds) used until a (stage, tier) has been observed.
+PRIOR_LATENCY = {
+    "parse": {"lite": 1.5, "full": 3.0},
+    "sql": {"lite": 6.0, "full": 12.0},
+    "summary": {"lite": 2.0, "full": 4.0},
+}
+EWMA_ALPHA = 0.2
+
+@dataclass
+class Route:
+    stage: str
+    tier: str                 # "lite", "full" or "skip"
+    model: Optional[str]
+    reason: str
+    expected_seconds: float
+
+    def as_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+class ModelRouter:
+    """Latency estimates per (stage, tier) and counters of the decisions taken."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency: Dict[Tuple[str, str], float] = {}
+        self._decisions: Dict[Tuple[str, str], int] = {}
+        self._seconds_saved = 0.0
+
+    def observe(self, stage: str, model: Optional[str], seconds: float):
+        tier = next((t for t, m in MODEL_TIERS.items() if m == model), None)
+        if tier is None:
+            return
+        with self._lock:
+            previous = self._latency.get((stage, tier))
+            self._latency[(stage, tier)] = seconds if previous is None else previous + EWMA_ALPHA * (seconds - previous)
+
+    def expected(self, stage: str, tier: str) -> float:
+        if tier == "skip":
+            return 0.0
+        with self._lock:
+            observed = self._latency.get((stage, tier))
+        return observed if observed is not None else PRIOR_LATENCY[stage][tier]
+
+    def choose(self, stage: str, wants_full: bool, reason: str, remaining: Optional[float]) -> Route:
+        tier = "full" if wants_full else "lite"
+        if remaining is not None:
+            if tier == "full" and self.expected(stage, "full") > remaining:
+                tier, reason = "lite", f"{reason}; full model would miss the deadline"
+            if self.expected(stage, tier) > remaining:
+                tier, reason = "skip", f"{reason}; no time left for an LLM call"
+        return self.record(Route(stage, tier, MODEL_TIERS.get(tier), reason, round(self.expected(stage, tier), 3)))
+
+    def record(self, route: Route) -> Route:
+        with self._lock:
+            key = (route.stage, route.tier)
+            self._decisions[key] = self._decisions.get(key, 0) + 1
+        # Compared with the previous fixed setup of the full model for every stage but parsing.
+        baseline = "lite" if route.stage == "parse" else "full"
+        saved = self.expected(route.stage, baseline) - route.expected_seconds
+        with self._lock:
+            self._seconds_saved += saved
+        logger.info(
+            f"Routing {route.stage}: {route.tier} ({route.model or 'local path'}) - {route.reason}; "
+            f"expected {route.expected_seconds:.2f}s"
+        )
+        decisions = _turn_decisions.get()
+        if decisions is not None:
+            decisions.append(route.as_dict())
+        return route
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            decisions: Dict[str, Dict[str, int]] = {}
+            for (stage, tier), count in sorted(self._decisions.items()):
+                decisions.setdefault(stage, {})[tier] = count
+            latency = {f"{stage}:{tier}": round(seconds, 3) for (stage, tier), seconds in sorted(self._latency.items())}
+            return {
+                "enabled": ROUTING_ENABLED,
+                "tiers": MODEL_TIERS,
+                "decisions": decisions,
+                "observed_latency_seconds": latency,
+                "estimated_seconds_saved": round(self._seconds_saved, 3),
+            }
+
+_router = ModelRouter()
+
+# --- Per-turn context ---
+_deadline: ContextVar[Optional[float]] = ContextVar("model_router_deadline", default=None)
+_turn_decisions: ContextVar[Optional[List[Dict[str, Any]]]] = ContextVar("model_router_decisions", default=None)
+_models: ContextVar[Dict[str, Route]] = ContextVar("model_router_models", default={})
+
+def start_turn(deadline_seconds: float = REQUEST_DEADLINE_SECONDS) -> List[Dict[str, Any]]:
+    """Starts the deadline of a turn in this context; returns the list its decisions are appended to."""
+    decisions: List[Dict[str, Any]] = []
+    _deadline.set(time.monotonic() + deadline_seconds)
+    _turn_decisions.set(decisions)
+    return decisions
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+@contextmanager
+def routed(route: Optional[Route]) -> Iterator[None]:
+    """Makes `route` the active choice for its stage inside the block."""
+    if route is None:
+        yield
+        return
+    token = _models.set({**_models.get(), route.stage: route})
+    try:
+        yield
+    finally:
+        _models.reset(token)
+
+def model_for(stage: str) -> Optional[str]:
+    """The routed model of the stage, or None for the stage's default model."""
+    route = _models.get().get(stage)
+    return route.model if route is not None else None
+
+def skipped(stage: str) -> bool:
+    route = _models.get().get(stage)
+    return route is not None and route.tier == "skip"
+
+def observe(stage: str, model: Optional[str], seconds: float):
+    """Feeds the latency of a completed LLM call into the estimates."""
+    _router.observe(stage, model, seconds)
+
+def stats() -> Dict[str, Any]:
+    return _router.stats()
+
+# --- Complexity signals ---
+
+def constraint_count(state: Dict[str, Any]) -> int:
+    """Active filter and exclusion keys of a session state."""
+    sections = [(state.get("filters") or {}), (state.get("exclusions") or {})]
+    return sum(1 for section in sections for value in section.values() if value not in (None, [], False))
+
+def entity_count(state: Dict[str, Any]) -> int:
+    raw = state.get("raw_entities") or {}
+    return sum(len(value) if isinstance(value, list) else 1 for value in raw.values() if value not in (None, [], ""))
+
+def _constraints(state: Dict[str, Any]) -> Tuple[Any, Any]:
+    return state.get("filters") or {}, state.get("exclusions") or {}
+
+# --- Stage decisions ---
+
+def route_parse(user_query: str) -> Optional[Route]:
+    if not ROUTING_ENABLED:
+        return None
+    words = len(user_query.split())
+    wants_full = words >= PARSE_FULL_MIN_WORDS
+    reason = f"{words} words" + (" (long query)" if wants_full else "")
+    return _router.choose("parse", wants_full, reason, remaining())
+
+def route_sql(state: Dict[str, Any]) -> Optional[Route]:
+    if not ROUTING_ENABLED:
+        return None
+    constraints = constraint_count(state)
+    entities = entity_count(state)
+    confidence = state.get("confidence", 1.0)
+    diverse = state.get("inferred", {}).get("seek_diversity", False)
+    wants_full = diverse or constraints > SIMPLE_MAX_CONSTRAINTS or entities > SIMPLE_MAX_ENTITIES or confidence < MIN_CONFIDENCE
+    reason = f"{constraints} constraints, {entities} entities, confidence {confidence}" + (", diversity" if diverse else "")
+    return _router.choose("sql", wants_full, reason, remaining())
+
+def route_summary(state: Dict[str, Any], previous_state: Dict[str, Any], has_results: bool) -> Optional[Route]:
+    """
+    Summaries of a turn whose constraints did not change (a "show me again" follow-up) are
+    skipped: the results are the same, so the template summary says all there is to say.
+    """
+    if not ROUTING_ENABLED:
+        return None
+    diverse = state.get("inferred", {}).get("seek_diversity", False)
+    if has_results and previous_state and not diverse and _constraints(state) == _constraints(previous_state):
+        return _router.record(Route("summary", "skip", None, "constraints unchanged since the previous turn", 0.0))
+    constraints = constraint_count(state)
+    wants_full = has_results and (constraints > SIMPLE_MAX_CONSTRAINTS or diverse)
+    reason = f"{constraints} constraints" + ("" if has_results else ", no results")
+    return _router.choose("summary", wants_full, reason, remaining())
@@ -1,13 +1,19 @@
 # app/parser.py
 
 import os
+import time
 import logging
+import threading
 from typing import List, Dict, Optional, Any
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
+
+import circuit_breaker
+import usage_ledger
+import model_router
+import query_cache
+from admission import llm_slot, AdmissionRejected, controller as admission_controller
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -56,6 +62,7 @@ class Filters(BaseModel):
     vites: Optional[str] = Field(None, description="Normalized transmission: 'Otomatik' or 'Manuel'.")
     marka: Optional[List[str]] = Field(default_factory=list, description="List of preferred brands.")
     kasa_tipi: Optional[List[str]] = Field(default_factory=list, description="List of preferred body types.")
+    model: Optional[List[str]] = Field(default_factory=list, description="Model / trim terms as written by the user, e.g. ['Golf 1.6 TDI', 'Corolla hybrid'].")
     boya_durumu: Optional[str] = Field(None, description="Condition of paint, e.g., 'Yok' for none.")
     parca_durumu: Optional[str] = Field(None, description="Condition of replaced parts, e.g., 'Yok' for none.")
 
@@ -69,6 +76,7 @@ class Inferred(BaseModel):
     assumptions: List[str] = Field(default_factory=list, description="A list of rationales for any assumptions made.")
     reset_filters: bool = Field(False, description="True if user wants to clear/reset previous filters for variety.")
     seek_diversity: bool = Field(False, description="True if user explicitly wants diverse/different options.")
+    sort_by_value: bool = Field(False, description="True if user wants the best deals / cars priced below the market first.")
 
 class RawEntities(BaseModel):
     brands: List[str] = Field(default_factory=list, description="Brands mentioned.")
@@ -103,6 +111,7 @@ The database columns are: id, link, fiyat, marka, seri, model, yil, km, vites, y
     -   **Brands:** Extract brand names as mentioned by user (e.g., "Mercedes", "BMW", "VW") and add to `marka` list. Don't worry about exact database naming - the system will normalize them. Common variations like "Mercedes" (for Mercedes-Benz), "VW" (for Volkswagen), "Benz" are acceptable.
     -   **Fuel Type:** Map synonyms (`benzinli/gasoline -> Benzin`, `dizel/diesel -> Dizel`, etc.) and assign to `yakit`.
     -   **Transmission:** Map `otomatik/automatic -> Otomatik`, `manuel/manual -> Manuel` and assign to `vites`.
+    -   **Models/Trims:** Put model and trim mentions ("Golf 1.6 TDI", "Corolla hybrid", "Clio") into `filters.model` as written, and also into `raw_entities.models`. Do not put the brand alone there.
     -   **Paint/Parts:** Map "boyasız" (no paint) to `boya_durumu: "Yok"`. Map "değişensiz" (no replaced parts) to `parca_durumu: "Yok"`.
 
 2.  **Enhanced Heuristics & Inferences:** Apply these rules and document them in the `inferred.assumptions` list.
@@ -138,12 +147,103 @@ The database columns are: id, link, fiyat, marka, seri, model, yil, km, vites, y
     -   "something else" / "başka bir şey": Set `inferred.reset_filters` to `True`. Rationale: 'User wants to change search criteria.'
     -   "show me other options" / "başka seçenekler": Set `inferred.seek_diversity` to `True`. Rationale: 'User wants alternative options.'
     -   "variety" / "çeşitlilik": Set `inferred.seek_diversity` to `True`. Clear brand filters. Rationale: 'User explicitly wants variety.'
+    -   "best deals" / "fırsat araçlar" / "piyasanın altında": Set `inferred.sort_by_value` to `True`. Rationale: 'User wants the best-value listings first.'
 
 4.  **Confidence Score:** Provide a confidence score from 0.0 to 1.0 based on query ambiguity.
 
 **Output Format:** Your entire output must be a single, valid JSON object that conforms to the `ParsedUserQuery` schema.
 """
 
+# The parser chain (Gemini client + formatted prompt) is built once per model, on first use.
+_chain_lock = threading.Lock()
+_parser_chains: Dict[str, Any] = {}
+
+def _build_parser_chain(model: str):
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    llm = ChatGoogleGenerativeAI(
+        model=model, google_api_key=os.getenv("GEMINI_API_KEY"), temperature=0.0
+    )
+    structured_llm = llm.with_structured_output(ParsedUserQuery)
+
+    formatted_prompt = SYSTEM_PROMPT.format(
+        LOW_MILEAGE_THRESHOLD_KM=LOW_MILEAGE_THRESHOLD_KM,
+        MEDIUM_MILEAGE_THRESHOLD_KM=MEDIUM_MILEAGE_THRESHOLD_KM,
+        HIGH_MILEAGE_THRESHOLD_KM=HIGH_MILEAGE_THRESHOLD_KM,
+        VERY_YOUNG_CAR_THRESHOLD_YEARS=VERY_YOUNG_CAR_THRESHOLD_YEARS,
+        YOUNG_CAR_THRESHOLD_YEARS=YOUNG_CAR_THRESHOLD_YEARS,
+        MODERN_CAR_THRESHOLD_YEARS=MODERN_CAR_THRESHOLD_YEARS,
+        FAMILY_CAR_SEGMENTS=FAMILY_CAR_SEGMENTS,
+        CITY_CAR_SEGMENTS=CITY_CAR_SEGMENTS,
+        SPORTS_CAR_SEGMENTS=SPORTS_CAR_SEGMENTS,
+        COMPACT_SEGMENTS=COMPACT_SEGMENTS,
+        LUXURY_SEGMENTS=LUXURY_SEGMENTS,
+        PRACTICAL_SEGMENTS=PRACTICAL_SEGMENTS,
+        ECONOMICAL_SEGMENTS=ECONOMICAL_SEGMENTS,
+        SPACIOUS_SEGMENTS=SPACIOUS_SEGMENTS,
+    )
+
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", formatted_prompt), ("human", "Please parse this user query: {user_query}")
+    ])
+    return prompt | structured_llm
+
+def get_parser_chain(model: Optional[str] = None):
+    """Returns the cached prompt | structured LLM chain for a model (default LLM_MODEL), building it on first use."""
+    model = model or LLM_MODEL
+    chain = _parser_chains.get(model)
+    if chain is None:
+        with _chain_lock:
+            chain = _parser_chains.get(model)
+            if chain is None:
+                chain = _parser_chains[model] = _build_parser_chain(model)
+                logger.info(f"Parser chain initialised for {model}.")
+    return chain
+
+def is_initialised() -> bool:
+    """True once the default parser chain has been built."""
+    return LLM_MODEL in _parser_chains
+
+def warm_up():
+    """Builds the parser chain ahead of the first request."""
+    get_parser_chain()
+
+def _parse_with_llm(query: str) -> Dict[str, Any]:
+    model = model_router.model_for("parse") or LLM_MODEL
+    chain = get_parser_chain(model)
+    logger.info(f"Parsing user query with {model}: '{query}'")
+
+    with llm_slot("parse"):
+        started = time.perf_counter()
+        response: ParsedUserQuery = chain.invoke(
+            {"user_query": query}, config={"callbacks": usage_ledger.callbacks_for("parse")}
+        )
+        model_router.observe("parse", model, time.perf_counter() - started)
+    return response.model_dump()
+
+def _parse_locally(query: str) -> Dict[str, Any]:
+    """Deterministic fallback used while the parse circuit is open or the LLM call failed."""
+    try:
+        from fallback_parser import parse_query_deterministic
+        return parse_query_deterministic(query)
+    except Exception as e:
+        logger.error(f"Failed to parse user query locally: {e}", exc_info=True)
+        return ParsedUserQuery(
+            filters=Filters(), exclusions=Exclusions(),
+            inferred=Inferred(assumptions=[f"Parser failed due to an error: {e}"]),
+            raw_entities=RawEntities(), confidence=0.1
+        ).model_dump()
+
+def _probe_parser():
+    with llm_slot("parse"):
+        get_parser_chain().invoke({"user_query": "otomatik araba"})
+
+# Trips when Gemini errors or is slow; parsing then falls back to the rule-based parser.
+_parse_breaker = circuit_breaker.get_breaker(
+    "parse", slow_call_seconds=8.0, probe=_probe_parser, ignored_exceptions=(AdmissionRejected,)
+)
+
 def parse_user_query(query: str) -> Dict[str, Any]:
     """
     Parses a multilingual user query to extract structured vehicle search filters.
@@ -154,43 +254,73 @@ def parse_user_query(query: str) -> Dict[str, Any]:
             raw_entities=RawEntities(), confidence=0.0
         ).model_dump()
 
-    try:
-        llm = ChatGoogleGenerativeAI(
-            model=LLM_MODEL, google_api_key=os.getenv("GEMINI_API_KEY"), temperature=0.0
-        )
-        structured_llm = llm.with_structured_output(ParsedUserQuery)
-
-        formatted_prompt = SYSTEM_PROMPT.format(
-            LOW_MILEAGE_THRESHOLD_KM=LOW_MILEAGE_THRESHOLD_KM,
-            MEDIUM_MILEAGE_THRESHOLD_KM=MEDIUM_MILEAGE_THRESHOLD_KM,
-            HIGH_MILEAGE_THRESHOLD_KM=HIGH_MILEAGE_THRESHOLD_KM,
-            VERY_YOUNG_CAR_THRESHOLD_YEARS=VERY_YOUNG_CAR_THRESHOLD_YEARS,
-            YOUNG_CAR_THRESHOLD_YEARS=YOUNG_CAR_THRESHOLD_YEARS,
-            MODERN_CAR_THRESHOLD_YEARS=MODERN_CAR_THRESHOLD_YEARS,
-            FAMILY_CAR_SEGMENTS=FAMILY_CAR_SEGMENTS,
-            CITY_CAR_SEGMENTS=CITY_CAR_SEGMENTS,
-            SPORTS_CAR_SEGMENTS=SPORTS_CAR_SEGMENTS,
-            COMPACT_SEGMENTS=COMPACT_SEGMENTS,
-            LUXURY_SEGMENTS=LUXURY_SEGMENTS,
-            PRACTICAL_SEGMENTS=PRACTICAL_SEGMENTS,
-            ECONOMICAL_SEGMENTS=ECONOMICAL_SEGMENTS,
-            SPACIOUS_SEGMENTS=SPACIOUS_SEGMENTS,
-        )
-
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", formatted_prompt), ("human", "Please parse this user query: {user_query}")
-        ])
-
-        chain = prompt | structured_llm
-        logger.info(f"Parsing user query: '{query}'")
+    # Near-duplicates of an earlier LLM parse reuse it (see query_cache.py).
+    cached = query_cache.lookup(query, verify=_parse_with_llm)
+    if cached is not None:
+        return cached
+    if model_router.skipped("parse"):
+        return _parse_locally(query)
+    return _parse_breaker.call(lambda: _parse_and_cache(query), lambda: _parse_locally(query))
 
-        response: ParsedUserQuery = chain.invoke({"user_query": query})
-        return response.model_dump()
+def _parse_and_cache(query: str) -> Dict[str, Any]:
+    parsed = _parse_with_llm(query)
+    query_cache.store(query, parsed)
+    return parsed
 
-    except Exception as e:
-        logger.error(f"Failed to parse user query with LLM: {e}", exc_info=True)
-        return ParsedUserQuery(
-            filters=Filters(), exclusions=Exclusions(),
-            inferred=Inferred(assumptions=[f"Parser failed due to an error: {e}"]),
-            raw_entities=RawEntities(), confidence=0.1
-        ).model_dump()
\ No newline at end of file
+def _parse_chunk_with_llm(queries: List[str], max_concurrency: int) -> List[Dict[str, Any]]:
+    """
+    One provider-side batch; items the LLM failed on (or that were not admitted) are parsed
+    locally. Every in-flight item holds its own parse admission slot, and the batch never runs
+    wider than the parse stage's admission limit.
+    """
+    from langchain_core.runnables import RunnableLambda
+
+    model = model_router.model_for("parse") or LLM_MODEL
+    chain = get_parser_chain(model)
+
+    def admitted(inputs: Dict[str, Any], config) -> Any:
+        with llm_slot("parse"):
+            return chain.invoke(inputs, config=config)
+
+    started = time.perf_counter()
+    responses = RunnableLambda(admitted).batch(
+        [{"user_query": q} for q in queries],
+        config={"max_concurrency": min(max_concurrency, admission_controller.stage_limits["parse"]),
+                "callbacks": usage_ledger.callbacks_for("parse")},
+        return_exceptions=True,
+    )
+    model_router.observe("parse", model, time.perf_counter() - started)
+    parsed = []
+    for query, response in zip(queries, responses):
+        if isinstance(response, Exception):
+            logger.warning(f"Batch parse failed for '{query}' ({response}); parsing locally.")
+            parsed.append(_parse_locally(query))
+        else:
+            parsed.append(response.model_dump())
+            query_cache.store(query, parsed[-1])
+    return parsed
+
+def parse_user_queries(queries: List[str], max_concurrency: int = 8) -> List[Dict[str, Any]]:
+    """
+    parse_user_query for many queries at once: queries the cache cannot answer go to the LLM
+    in chunks of `max_concurrency` through chain.batch, each chunk behind the parse circuit breaker.
+    """
+    parsed: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+    for i, query in enumerate(queries):
+        if not query or not query.strip():
+            parsed[i] = parse_user_query(query)
+        else:
+            parsed[i] = query_cache.lookup(query, verify=_parse_with_llm)
+    pending = [i for i, result in enumerate(parsed) if result is None]
+    for start in range(0, len(pending), max_concurrency):
+        chunk = pending[start:start + max_concurrency]
+        texts = [queries[i] for i in chunk]
+        if model_router.skipped("parse"):
+            results = [_parse_locally(q) for q in texts]
+        else:
+            results = _parse_breaker.call(
+                lambda: _parse_chunk_with_llm(texts, max_concurrency), lambda: [_parse_locally(q) for q in texts]
+            )
+        for i, result in zip(chunk, results):
+            parsed[i] = result
+    return parsed
@@ -0,0 +1,320 @@
+# app/plan_cache.py
+"""
+Parameterised plan cache for SQL generated by the agent.
+
+The agent's SQL depends on which constraints are set (the "shape"), not on their values.
+After a successful agent run, the executed SQL is turned into a template: every literal
+that came from the constraints becomes a `?` slot that remembers where its value comes
+from. A later turn with the same shape binds its own values and runs the template
+directly, with no LLM round-trip. Templates are dropped when the database schema
+version changes, and every statement passes a read-only authorizer that only allows
+SELECTs reading the listings table. Recorded templates are also written to the shared
+cache, so a plan learnt by one worker process is used by the others.
+"""
+
+import os
+import re
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+import shared_cache
+from langchain_agent import DB_PATH, CURRENT_YEAR
+from query_builder import SPORTS_BODY_TYPES
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+ALLOWED_TABLE = "araba_ilanlari"
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "256"))
+
+# Literals that may appear in agent SQL without coming from the constraints.
+CONSTANT_STRINGS = set(SPORTS_BODY_TYPES)
+CONSTANT_NUMBERS = {0.0, 1.0}
+
+SCALAR_FILTERS = ("fiyat_max", "fiyat_min", "km_max", "km_min", "vites", "boya_durumu", "parca_durumu")
+AGE_FILTERS = ("age_max", "age_min")
+LIST_FILTERS = ("yakit", "marka", "kasa_tipi")
+LIST_EXCLUSIONS = ("exclude_brands", "exclude_fuel_types", "exclude_colors")
+
+class PlanRejected(Exception):
+    """The agent SQL cannot be turned into a safe, reusable template."""
+
+class PlanTemplate:
+    def __init__(self, sql: str, slots: List[Tuple[str, str, Optional[int]]], schema_version: int):
+        self.sql = sql
+        self.slots = slots              # (section, field, list index or None) per `?`
+        self.schema_version = schema_version
+        self.hits = 0
+
+# --- Read-only authorizer ---
+
+def _readonly_authorizer(action, arg1, arg2, db_name, trigger):
+    if action == sqlite3.SQLITE_SELECT:
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_READ:
+        return sqlite3.SQLITE_OK if arg1 == ALLOWED_TABLE else sqlite3.SQLITE_DENY
+    if action == sqlite3.SQLITE_FUNCTION:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+def get_authorized_connection() -> sqlite3.Connection:
+    """Read-only connection that rejects anything other than a SELECT on the listings table."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.set_authorizer(_readonly_authorizer)
+    return conn
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    conn.set_authorizer(None)
+    try:
+        return conn.execute("PRAGMA schema_version").fetchone()[0]
+    finally:
+        conn.set_authorizer(_readonly_authorizer)
+
+# --- Shapes and slots ---
+
+def _set(value: Any) -> bool:
+    return value not in (None, [], False, "")
+
+def constraint_shape(constraints: Dict[str, Any], seek_diversity: bool) -> str:
+    """Which constraints are set (with list lengths), independent of their values."""
+    filters = constraints.get("filters", {}) or {}
+    exclusions = constraints.get("exclusions", {}) or {}
+    parts = []
+    for section, values in (("f", filters), ("x", exclusions)):
+        for field in sorted(values):
+            value = values[field]
+            if not _set(value):
+                continue
+            parts.append(f"{section}.{field}[{len(value)}]" if isinstance(value, list) else f"{section}.{field}")
+    parts.append(f"diverse={bool(seek_diversity)}")
+    return "|".join(parts)
+
+def _slot_value(constraints: Dict[str, Any], slot: Tuple[str, str, Optional[int]]) -> Any:
+    section, field, index = slot
+    if section == "age":
+        return CURRENT_YEAR - constraints["filters"][field]
+    value = constraints["filters" if section == "filters" else "exclusions"][field]
+    return value[index] if index is not None else value
+
+def _literal_key(value: Any) -> Tuple[str, Any]:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return ("num", float(value))
+    return ("str", str(value))
+
+def _candidate_slots(constraints: Dict[str, Any]) -> Dict[Tuple[str, Any], List[Tuple[str, str, Optional[int]]]]:
+    """Maps every constraint value (as it would appear in SQL) to the slot(s) it can come from."""
+    filters = constraints.get("filters", {}) or {}
+    exclusions = constraints.get("exclusions", {}) or {}
+    candidates: Dict[Tuple[str, Any], List[Tuple[str, str, Optional[int]]]] = {}
+
+    def add(value, slot):
+        candidates.setdefault(_literal_key(value), []).append(slot)
+
+    for field in SCALAR_FILTERS:
+        if _set(filters.get(field)):
+            add(filters[field], ("filters", field, None))
+    for field in AGE_FILTERS:
+        if _set(filters.get(field)) or filters.get(field) == 0:
+            add(CURRENT_YEAR - filters[field], ("age", field, None))
+    for field in LIST_FILTERS:
+        for index, value in enumerate(filters.get(field) or []):
+            add(value, ("filters", field, index))
+    for field in LIST_EXCLUSIONS:
+        for index, value in enumerate(exclusions.get(field) or []):
+            add(value, ("exclusions", field, index))
+    return candidates
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+def _scan_literals(sql: str) -> List[Tuple[int, int, Tuple[str, Any], str]]:
+    """Finds string and numeric literals outside identifiers: (start, end, key, previous keyword)."""
+    literals = []
+    i, n = 0, len(sql)
+    previous_word = ""
+    while i < n:
+        ch = sql[i]
+        if ch == "'":
+            j = i + 1
+            chars = []
+            while j < n:
+                if sql[j] == "'" and j + 1 < n and sql[j + 1] == "'":
+                    chars.append("'")
+                    j += 2
+                    continue
+                if sql[j] == "'":
+                    break
+                chars.append(sql[j])
+                j += 1
+            literals.append((i, j + 1, ("str", "".join(chars)), previous_word))
+            i = j + 1
+        elif ch in '"`[':
+            closing_char = {"\"": "\"", "`": "`", "[": "]"}[ch]
+            j = sql.find(closing_char, i + 1)
+            i = n if j == -1 else j + 1
+            previous_word = ""
+        elif ch.isalpha() or ch == "_":
+            j = i
+            while j < n and (sql[j].isalnum() or sql[j] == "_"):
+                j += 1
+            previous_word = sql[i:j].upper()
+            i = j
+        elif ch.isdigit():
+            match = _NUMBER.match(sql, i)
+            literals.append((i, match.end(), ("num", float(match.group())), previous_word))
+            i = match.end()
+        else:
+            i += 1
+    return literals
+
+def build_template(sql: str, constraints: Dict[str, Any]) -> Tuple[str, List[Tuple[str, str, Optional[int]]]]:
+    """Replaces constraint-derived literals with `?` slots. Raises PlanRejected if that is not unambiguous."""
+    sql = sql.strip().rstrip(";")
+    candidates = _candidate_slots(constraints)
+    slots: List[Tuple[str, str, Optional[int]]] = []
+    used = set()
+    pieces, cursor = [], 0
+
+    for start, end, key, previous_word in _scan_literals(sql):
+        if previous_word in ("LIMIT", "OFFSET"):
+            continue
+        matches = candidates.get(key)
+        if not matches:
+            if (key[0] == "str" and key[1] in CONSTANT_STRINGS) or (key[0] == "num" and key[1] in CONSTANT_NUMBERS):
+                continue
+            raise PlanRejected(f"literal {key[1]!r} does not come from the constraints")
+        if len(matches) > 1:
+            raise PlanRejected(f"literal {key[1]!r} is ambiguous between {matches}")
+        pieces.append(sql[cursor:start])
+        pieces.append("?")
+        cursor = end
+        slots.append(matches[0])
+        used.add(matches[0])
+
+    pieces.append(sql[cursor:])
+    unused = [slot for slots_for_value in candidates.values() for slot in slots_for_value if slot not in used]
+    if unused:
+        raise PlanRejected(f"constraints not used by the SQL: {unused}")
+    return "".join(pieces), slots
+
+# --- Cache ---
+
+class PlanCache:
+    def __init__(self, max_size: int = PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._plans: "OrderedDict[str, PlanTemplate]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._schema_version: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self.rejected = 0
+        self.invalidations = 0
+
+    def _check_schema(self, conn: sqlite3.Connection):
+        version = get_schema_version(conn)
+        with self._lock:
+            if self._schema_version != version:
+                if self._plans:
+                    logger.info(f"Schema version changed ({self._schema_version} -> {version}); dropping {len(self._plans)} plans.")
+                    self.invalidations += 1
+                self._plans.clear()
+                self._schema_version = version
+        return version
+
+    def record(self, sql: str, constraints: Dict[str, Any], seek_diversity: bool) -> bool:
+        """Validates the agent's SQL and stores it as a template for this constraint shape."""
+        shape = constraint_shape(constraints, seek_diversity)
+        try:
+            template_sql, slots = build_template(sql, constraints)
+            params = [_slot_value(constraints, slot) for slot in slots]
+            with closing(get_authorized_connection()) as conn:
+                version = self._check_schema(conn)
+                # Preparing the statement runs the authorizer without reading any rows.
+                conn.execute(f"EXPLAIN {template_sql}", params)
+        except (PlanRejected, sqlite3.Error) as e:
+            with self._lock:
+                self.rejected += 1
+            logger.info(f"Agent SQL not cached for shape '{shape}': {e}")
+            return False
+
+        self._install(shape, PlanTemplate(template_sql, slots, version))
+        with self._lock:
+            self.recorded += 1
+        shared_cache.put("plan", shape, (template_sql, slots, version))
+        logger.info(f"Cached agent SQL plan for shape '{shape}'.")
+        return True
+
+    def _install(self, shape: str, plan: PlanTemplate):
+        with self._lock:
+            self._plans[shape] = plan
+            self._plans.move_to_end(shape)
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+
+    def _from_shared(self, shape: str, version: int) -> Optional[PlanTemplate]:
+        """A template another worker recorded for this shape and schema version."""
+        shared = shared_cache.get("plan", shape)
+        if shared is None or shared[2] != version:
+            return None
+        plan = PlanTemplate(*shared)
+        self._install(shape, plan)
+        return plan
+
+    def execute(self, constraints: Dict[str, Any], seek_diversity: bool) -> Optional[List[Dict[str, Any]]]:
+        """Runs the cached template for this shape with the new values, or returns None on a miss."""
+        shape = constraint_shape(constraints, seek_diversity)
+        with closing(get_authorized_connection()) as conn:
+            version = self._check_schema(conn)
+            with self._lock:
+                plan = self._plans.get(shape)
+                if plan is not None:
+                    self._plans.move_to_end(shape)
+            if plan is None:
+                plan = self._from_shared(shape, version)
+            if plan is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            params = [_slot_value(constraints, slot) for slot in plan.slots]
+            try:
+                rows = [dict(row) for row in conn.execute(plan.sql, params).fetchall()]
+            except sqlite3.Error as e:
+                logger.warning(f"Cached plan for shape '{shape}' failed ({e}); dropping it.")
+                with self._lock:
+                    self._plans.pop(shape, None)
+                    self.misses += 1
+                shared_cache.delete("plan", shape)
+                return None
+        with self._lock:
+            plan.hits += 1
+            self.hits += 1
+        logger.info(f"Plan cache hit for shape '{shape}': {len(rows)} rows without an LLM call.")
+        return rows
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": len(self._plans),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+                "rejected": self.rejected,
+                "invalidations": self.invalidations,
+                "schema_version": self._schema_version,
+            }
+
+plan_cache = PlanCache()
+
+def record(sql: str, constraints: Dict[str, Any], seek_diversity: bool) -> bool:
+    return plan_cache.record(sql, constraints, seek_diversity)
+
+def execute(constraints: Dict[str, Any], seek_diversity: bool) -> Optional[List[Dict[str, Any]]]:
+    return plan_cache.execute(constraints, seek_diversity)
+
+def stats() -> Dict[str, Any]:
+    return plan_cache.stats()
@@ -0,0 +1,324 @@
+# app/prefetch.py
+"""
+Speculative prefetch of a session's likely next request, run after each turn's response.
+
+After a turn the next action is usually one of: the next result page, a facet
+refinement on vites or yakit ("otomatik olsun", "dizel olsun"), or "başka seçenekler"
+(the diversity variant of the same filters). A background thread computes those with
+the compiled query and in-memory facets (never an LLM) and keeps them in a result
+cache that the next turn's search stage, GET /results and GET /facets look in first.
+
+Work is bounded per session and turn: PREFETCH_CPU_BUDGET_MS of thread CPU time (the
+remaining tasks are skipped) and PREFETCH_SESSION_MAX_BYTES of cached results. A new
+turn of the session cancels its queued prefetch and drops its unused predictions.
+Result pages are also written through to shared_cache, so a turn served by another
+worker finds them; keys carry the inventory fingerprint, so a new snapshot misses.
+"""
+
+import os
+import time
+import pickle
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import facets
+import inventory
+import query_builder
+import shared_cache
+import singleflight
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH", "1") != "0"
+PREFETCH_CPU_BUDGET_MS = float(os.getenv("PREFETCH_CPU_BUDGET_MS", "150"))
+PREFETCH_SESSION_MAX_BYTES = int(os.getenv("PREFETCH_SESSION_MAX_BYTES", str(256 * 1024)))
+PREFETCH_MAX_BYTES = int(os.getenv("PREFETCH_MAX_BYTES", str(32 * 1024 * 1024)))
+PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", "64"))
+PREFETCH_SHARED_TTL_SECONDS = int(os.getenv("PREFETCH_SHARED_TTL_SECONDS", "600"))
+# Facet refinements tried per facet: the values with the most listings first.
+PREFETCH_FACET_VALUES = 2
+PAGE_SIZE = 5
+
+# --- Keys ---
+
+def _empty(value: Any) -> bool:
+    return value in (None, [], "", False)
+
+def _view(state: Dict[str, Any]) -> Dict[str, Any]:
+    """What the search results depend on, with empty values dropped and lists sorted."""
+    def clean(section: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: sorted(value) if isinstance(value, list) else value
+                for key, value in (section or {}).items() if not _empty(value)}
+    inferred = state.get("inferred", {}) or {}
+    return {
+        "filters": clean(state.get("filters", {})),
+        "exclusions": clean(state.get("exclusions", {})),
+        "seek_diversity": bool(inferred.get("seek_diversity")),
+        "sort_by_value": bool(inferred.get("sort_by_value")),
+    }
+
+def _key(kind: str, snapshot: inventory.Inventory, state: Dict[str, Any], page: int = 0) -> str:
+    return singleflight.canonical_key(kind, snapshot.fingerprint or snapshot.version, _view(state), page)
+
+# --- Predictions ---
+
+def _with_filter(state: Dict[str, Any], key: str, value: Any) -> Dict[str, Any]:
+    """The state after a turn that only adds this filter (see engine.merge_filters)."""
+    inferred = dict(state.get("inferred", {}) or {})
+    inferred["seek_diversity"] = False
+    return {**state, "filters": {**(state.get("filters", {}) or {}), key: value}, "inferred": inferred}
+
+def _diversity_variant(state: Dict[str, Any]) -> Dict[str, Any]:
+    """The state after "başka seçenekler": same filters, brands cleared, diverse ordering."""
+    inferred = dict(state.get("inferred", {}) or {})
+    inferred["seek_diversity"] = True
+    return {**state, "filters": {**(state.get("filters", {}) or {}), "marka": []}, "inferred": inferred}
+
+def search_page(state: Dict[str, Any], page: int = 0) -> List[Dict[str, Any]]:
+    """One page of the compiled search for a session state."""
+    inferred = state.get("inferred", {}) or {}
+    return query_builder.run_compiled_search(
+        state, seek_diversity=inferred.get("seek_diversity", False), limit=PAGE_SIZE,
+        offset=page * PAGE_SIZE, order_by_value=inferred.get("sort_by_value", False),
+    )
+
+# --- Cache ---
+
+@dataclass
+class Entry:
+    kind: str                   # "page", "facets", "refine" or "diversity"
+    session_id: str
+    value: Any
+    nbytes: int
+    used: bool = False
+
+class Prefetcher:
+    def __init__(self, max_bytes: int = PREFETCH_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Entry]" = OrderedDict()
+        self._by_session: Dict[str, List[str]] = {}
+        # Generation of each session's queued or running prefetch; removed when it finishes, so
+        # only sessions with work in flight are tracked. Numbers are global and never reused.
+        self._generation: Dict[str, int] = {}
+        self._generations = itertools.count(1)
+        self._bytes = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.counters = {"scheduled": 0, "dropped": 0, "cancelled": 0, "tasks_run": 0,
+                         "tasks_over_budget": 0, "entries_over_budget": 0, "wasted": 0, "evictions": 0}
+        self.cpu_seconds = 0.0
+        self.prefetched: Dict[str, int] = {}
+        self.used: Dict[str, int] = {}
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+
+    # Created on first use, so a preloading server master never forks with a live pool.
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+            return self._executor
+
+    def _bump(self, counts: Dict[str, int], kind: str):
+        counts[kind] = counts.get(kind, 0) + 1
+
+    def _drop_session(self, session_id: str):
+        """Forgets a session's predictions of an earlier turn. Caller holds the lock."""
+        for key in self._by_session.pop(session_id, []):
+            entry = self._entries.get(key)
+            if entry is not None and entry.session_id == session_id:
+                del self._entries[key]
+                self._bytes -= entry.nbytes
+                if not entry.used:
+                    self.counters["wasted"] += 1
+
+    def _forget_key(self, session_id: str, key: str):
+        """Removes an evicted entry from its session's key list. Caller holds the lock."""
+        keys = self._by_session.get(session_id)
+        if keys is not None and key in keys:
+            keys.remove(key)
+            if not keys:
+                del self._by_session[session_id]
+
+    def _store(self, session_id: str, generation: int, kind: str, key: str, value: Any) -> bool:
+        nbytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            if self._generation.get(session_id) != generation:
+                return False
+            keys = self._by_session.setdefault(session_id, [])
+            session_bytes = sum(self._entries[k].nbytes for k in keys if k in self._entries)
+            if session_bytes + nbytes > PREFETCH_SESSION_MAX_BYTES:
+                self.counters["entries_over_budget"] += 1
+                return False
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.nbytes
+            self._entries[key] = Entry(kind, session_id, value, nbytes)
+            self._bytes += nbytes
+            keys.append(key)
+            self._bump(self.prefetched, kind)
+            while self._bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._forget_key(evicted.session_id, evicted_key)
+                self.counters["evictions"] += 1
+                if not evicted.used:
+                    self.counters["wasted"] += 1
+        return True
+
+    def _take(self, lookup_kind: str, key: str, shared: bool = False) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if not entry.used:
+                    entry.used = True
+                    self._bump(self.used, entry.kind)
+                self._bump(self.hits, lookup_kind)
+                return entry.value
+        # Predicted by another worker.
+        value = shared_cache.get("prefetch", key) if shared else None
+        with self._lock:
+            self._bump(self.hits if value is not None else self.misses, lookup_kind)
+        return value
+
+    # --- Scheduling ---
+
+    def schedule(self, session_id: Optional[str], state: Dict[str, Any]):
+        """Queues the prefetch for a session's new state; replaces whatever the session had queued."""
+        if not PREFETCH_ENABLED or not session_id or not state or not state.get("filters"):
+            return
+        with self._lock:
+            generation = next(self._generations)
+            self._generation[session_id] = generation
+            self._drop_session(session_id)
+            if self._pending >= PREFETCH_MAX_PENDING:
+                # Nothing will run for this generation; a queued earlier run still sees it is stale.
+                del self._generation[session_id]
+                self.counters["dropped"] += 1
+                return
+            self._pending += 1
+            self.counters["scheduled"] += 1
+        self._pool().submit(self._run, session_id, generation, state)
+
+    def _tasks(self, snapshot: inventory.Inventory, state: Dict[str, Any]) -> List[Tuple[str, Callable[[], Any]]]:
+        """The predictions in priority order, as (kind, thunk) pairs; thunks store their own result."""
+        filters = state.get("filters", {}) or {}
+        tasks: List[Tuple[str, Callable[[], Any]]] = []
+        facet_counts: Dict[str, Any] = {}
+
+        if not state.get("inferred", {}).get("seek_diversity"):
+            # A random draw (diversity ordering) has no meaningful next page.
+            tasks.append(("page", lambda: ("page", _key("results", snapshot, state, 1), search_page(state, 1))))
+
+        def facet_task():
+            facet_counts.update(facets.compute_facets(snapshot, state))
+            return "facets", _key("facets", snapshot, state), facet_counts
+
+        tasks.append(("facets", facet_task))
+        for name, as_filter in (("vites", lambda value: value), ("yakit", lambda value: [value])):
+            if not _empty(filters.get(name)):
+                continue
+            for rank in range(PREFETCH_FACET_VALUES):
+                def refine_task(name=name, rank=rank, as_filter=as_filter):
+                    values = (facet_counts.get("facets") or {}).get(name) or []
+                    if rank >= len(values):
+                        return None
+                    refined = _with_filter(state, name, as_filter(values[rank]["value"]))
+                    return "refine", _key("results", snapshot, refined), search_page(refined)
+                tasks.append(("refine", refine_task))
+        variant = _diversity_variant(state)
+        tasks.append(("diversity", lambda: ("diversity", _key("results", snapshot, variant), search_page(variant))))
+        return tasks
+
+    def _run(self, session_id: str, generation: int, state: Dict[str, Any]):
+        started = time.thread_time()
+        try:
+            snapshot = inventory.get_inventory()
+            budget = PREFETCH_CPU_BUDGET_MS / 1000.0
+            tasks = self._tasks(snapshot, state)
+            for position, (_, task) in enumerate(tasks):
+                if self._generation.get(session_id) != generation:
+                    with self._lock:
+                        self.counters["cancelled"] += 1
+                    return
+                if time.thread_time() - started > budget:
+                    with self._lock:
+                        self.counters["tasks_over_budget"] += len(tasks) - position
+                    return
+                outcome = task()
+                with self._lock:
+                    self.counters["tasks_run"] += 1
+                if outcome is None:
+                    continue
+                kind, key, value = outcome
+                if self._store(session_id, generation, kind, key, value) and kind != "facets":
+                    shared_cache.put("prefetch", key, value, ttl_seconds=PREFETCH_SHARED_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Prefetch for session {session_id} failed: {e}")
+        finally:
+            with self._lock:
+                if self._generation.get(session_id) == generation:
+                    del self._generation[session_id]
+                self._pending -= 1
+                self.cpu_seconds += time.thread_time() - started
+
+    # --- Lookups ---
+
+    def lookup_results(self, state: Dict[str, Any], page: int = 0) -> Optional[List[Dict[str, Any]]]:
+        """Prefetched results of a state's page, or None."""
+        lookup_kind = "turn" if page == 0 else "page"
+        rows = self._take(lookup_kind, _key("results", inventory.get_inventory(), state, page), shared=True)
+        return list(rows) if rows is not None else None
+
+    def lookup_facets(self, state: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return self._take("facets", _key("facets", inventory.get_inventory(), state))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            hits, misses = sum(self.hits.values()), sum(self.misses.values())
+            prefetched, used = sum(self.prefetched.values()), sum(self.used.values())
+            return {
+                "enabled": PREFETCH_ENABLED,
+                **self.counters,
+                "pending": self._pending,
+                "entries": len(self._entries),
+                "sessions": len(self._by_session),
+                "sessions_in_flight": len(self._generation),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "cpu_seconds": round(self.cpu_seconds, 3),
+                "prefetched": dict(self.prefetched),
+                "used": dict(self.used),
+                "hits": dict(self.hits),
+                "misses": dict(self.misses),
+                "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+                "used_ratio": round(used / prefetched, 3) if prefetched else None,
+            }
+
+prefetcher = Prefetcher()
+
+def schedule(session_id: Optional[str], state: Dict[str, Any]):
+    prefetcher.schedule(session_id, state)
+
+def lookup_results(state: Dict[str, Any], page: int = 0) -> Optional[List[Dict[str, Any]]]:
+    return prefetcher.lookup_results(state, page)
+
+def get_page(state: Dict[str, Any], page: int) -> List[Dict[str, Any]]:
+    """A result page of a session state: prefetched if it was predicted, computed otherwise."""
+    rows = prefetcher.lookup_results(state, page)
+    return rows if rows is not None else search_page(state, page)
+
+def get_facets(state: Dict[str, Any]) -> Dict[str, Any]:
+    counts = prefetcher.lookup_facets(state)
+    return counts if counts is not None else facets.compute_facets(inventory.get_inventory(), state)
+
+def stats() -> Dict[str, Any]:
+    return prefetcher.stats()
@@ -0,0 +1,175 @@
+# app/profiling.py
+"""
+Opt-in sampling profiler for single chat turns.
+
+A profile is started only for requests that ask for it (admin header) or that fall
+into the sampled fraction of traffic; every other request pays a single random()
+comparison. While a profile is running, a background thread snapshots the stacks of
+the threads attached to it every PROFILE_INTERVAL_MS and counts identical stacks.
+The result is stored in the "folded" format (`frame;frame;frame count`) understood by
+flamegraph.pl, speedscope and inferno, keyed by the request id. Finished profiles are
+also written to the shared cache, so any gunicorn worker can serve them.
+"""
+
+import os
+import sys
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import shared_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))       # Fraction of /chat requests profiled
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_STORE_SIZE = int(os.getenv("PROFILE_STORE_SIZE", "50"))          # Most recent profiles kept in memory
+PROFILE_TTL_SECONDS = float(os.getenv("PROFILE_TTL_SECONDS", "86400"))   # Lifetime in the shared cache
+PROFILE_MAX_DEPTH = 128
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class RequestProfile:
+    """Samples the stacks of the threads attached to one request until stopped."""
+
+    def __init__(self, request_id: str, reason: str, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.request_id = request_id
+        self.reason = reason
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.cpu_seconds = 0.0
+        self.started_at = time.time()
+        self.wall_seconds: Optional[float] = None
+        self._started = time.perf_counter()
+        self._threads: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{request_id[:8]}", daemon=True)
+        self._sampler.start()
+
+    @contextmanager
+    def attach(self, label: str):
+        """Samples the calling thread for the duration of the block; `label` becomes the root frame."""
+        ident = threading.get_ident()
+        cpu_started = time.thread_time()
+        with self._lock:
+            self._threads[ident] = label
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._threads.pop(ident, None)
+                self.cpu_seconds += time.thread_time() - cpu_started
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                threads = dict(self._threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for ident, label in threads.items():
+                frame = frames.get(ident)
+                stack: List[str] = []
+                while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(label)
+                with self._lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+                    self.samples += 1
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.wall_seconds = time.perf_counter() - self._started
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Only a stopped profile is pickled (for the shared cache): the sampling machinery is left out."""
+        return {key: value for key, value in self.__dict__.items()
+                if key not in ("_threads", "_lock", "_stop", "_sampler")}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stop.set()
+        self._sampler = None
+
+    def folded(self) -> str:
+        """Flame-graph input: one `stack count` line per distinct stack."""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "reason": self.reason,
+            "started_at": self.started_at,
+            "wall_seconds": round(self.wall_seconds, 4) if self.wall_seconds is not None else None,
+            "cpu_seconds": round(self.cpu_seconds, 4),
+            "samples": self.samples,
+            "interval_ms": self.interval * 1000,
+        }
+
+    def top_functions(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Self and total sample counts per function, for a quick look without a flame-graph viewer."""
+        self_counts: Counter = Counter()
+        total_counts: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                total_counts[frame] += count
+        return [
+            {"function": frame, "self": self_counts[frame], "total": total}
+            for frame, total in total_counts.most_common(limit)
+        ]
+
+# --- Store ---
+# The in-memory store is per worker; the shared cache copy is what the other workers find.
+_profiles: "OrderedDict[str, RequestProfile]" = OrderedDict()
+_profiles_lock = threading.Lock()
+
+def should_profile(requested: bool) -> Optional[str]:
+    """Returns why this request should be profiled ('header' or 'sampled'), or None."""
+    if requested:
+        return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+def start(reason: str, request_id: Optional[str] = None) -> RequestProfile:
+    return RequestProfile(request_id or uuid.uuid4().hex, reason)
+
+def finish(profile: RequestProfile):
+    """Stops sampling and stores the profile, evicting the oldest beyond PROFILE_STORE_SIZE."""
+    profile.stop()
+    with _profiles_lock:
+        _profiles[profile.request_id] = profile
+        while len(_profiles) > PROFILE_STORE_SIZE:
+            _profiles.popitem(last=False)
+    shared_cache.put("profile", profile.request_id, profile, ttl_seconds=PROFILE_TTL_SECONDS)
+    logger.info(f"Stored profile {profile.request_id} ({profile.samples} samples, {profile.wall_seconds:.3f}s).")
+
+def get(request_id: str) -> Optional[RequestProfile]:
+    with _profiles_lock:
+        profile = _profiles.get(request_id)
+    return profile if profile is not None else shared_cache.get("profile", request_id)
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Most recent first, from every worker when the shared cache is enabled."""
+    profiles = [profile for _, profile in shared_cache.recent("profile", PROFILE_STORE_SIZE)]
+    if not profiles:
+        with _profiles_lock:
+            profiles = list(reversed(_profiles.values()))
+    return [profile.summary() for profile in profiles]
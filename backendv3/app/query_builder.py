@@ -0,0 +1,182 @@
+# app/query_builder.py
+
+import json
+import logging
+import sqlite3
+from contextlib import closing
+from typing import List, Dict, Any, Tuple
+
+from langchain_agent import DB_PATH, CURRENT_YEAR, get_table_columns
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "araba_ilanlari"
+
+# --- Mapping of canonical filter values to the values actually stored by the crawler ---
+VITES_VALUES = {
+    "Otomatik": ["Otomatik", "Yarı Otomatik"],
+    "Manuel": ["Düz"],
+}
+YAKIT_VALUES = {
+    "Benzin": ["Benzin", "LPG & Benzin"],
+    "Dizel": ["Dizel"],
+    "Hibrit": ["Hibrit"],
+    "Elektrik": ["Elektrik"],
+}
+BOYA_NONE_VALUE = "Boya Orijinal"        # boya_durumu: "Yok"
+PARCA_NONE_VALUE = "Parça Orijinal"      # parca_durumu: "Yok"
+SPORTS_BODY_TYPES = ["Coupe", "Cabrio", "Roadster", "Sport"]
+
+# Relisted copies point at their canonical listing (see dedup.py); searches skip them.
+CANONICAL_CLAUSE = '"duplicate_of" IS NULL'
+
+# km is stored as text like "69.000 km"; this expression turns it into an integer.
+KM_EXPR = """(CASE WHEN typeof("km") = 'text' THEN CAST(REPLACE(REPLACE("km", '.', ''), ' km', '') AS INTEGER) ELSE "km" END)"""
+
+def expand_values(values: List[str], mapping: Dict[str, List[str]]) -> List[str]:
+    """Expands canonical values (e.g. 'Manuel') to the stored variants (e.g. 'Düz')."""
+    expanded = []
+    for value in values:
+        for stored in mapping.get(value, [value]):
+            if stored not in expanded:
+                expanded.append(stored)
+    return expanded
+
+def _placeholders(values: List[Any]) -> str:
+    return ", ".join("?" for _ in values)
+
+def canonical_clause() -> str:
+    """WHERE condition for canonical listings only, once dedup.py has added the column."""
+    return CANONICAL_CLAUSE if "duplicate_of" in get_table_columns() else "1 = 1"
+
+def build_where_clause(constraints: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """
+    Compiles the merged session state (filters + exclusions) into a parameterised WHERE clause.
+    Returns ("1 = 1", []) when there is nothing to filter on.
+    """
+    filters = constraints.get("filters", {}) or {}
+    exclusions = constraints.get("exclusions", {}) or {}
+    clauses: List[str] = []
+    params: List[Any] = []
+
+    if "duplicate_of" in get_table_columns():
+        clauses.append(CANONICAL_CLAUSE)
+
+    if filters.get("fiyat_max") is not None:
+        clauses.append('"fiyat" <= ?')
+        params.append(filters["fiyat_max"])
+    if filters.get("fiyat_min") is not None:
+        clauses.append('"fiyat" >= ?')
+        params.append(filters["fiyat_min"])
+    if filters.get("age_max") is not None:
+        clauses.append('"yil" >= ?')
+        params.append(CURRENT_YEAR - filters["age_max"])
+    if filters.get("age_min") is not None:
+        clauses.append('"yil" <= ?')
+        params.append(CURRENT_YEAR - filters["age_min"])
+    if filters.get("km_max") is not None:
+        clauses.append(f"{KM_EXPR} <= ?")
+        params.append(filters["km_max"])
+    if filters.get("km_min") is not None:
+        clauses.append(f"{KM_EXPR} >= ?")
+        params.append(filters["km_min"])
+    if filters.get("yakit"):
+        values = expand_values(filters["yakit"], YAKIT_VALUES)
+        clauses.append(f'"yakit" IN ({_placeholders(values)})')
+        params.extend(values)
+    if filters.get("vites"):
+        values = expand_values([filters["vites"]], VITES_VALUES)
+        clauses.append(f'"vites" IN ({_placeholders(values)})')
+        params.extend(values)
+    if filters.get("marka"):
+        clauses.append(f'"marka" IN ({_placeholders(filters["marka"])})')
+        params.extend(filters["marka"])
+    if filters.get("kasa_tipi"):
+        clauses.append(f'"kasa_tipi" IN ({_placeholders(filters["kasa_tipi"])})')
+        params.extend(filters["kasa_tipi"])
+    if filters.get("model"):
+        # Model / trim terms are resolved through the in-memory index, not LIKE scans.
+        import text_index
+        clauses.append('"id" IN (SELECT value FROM json_each(?))')
+        params.append(json.dumps(text_index.matching_ids(filters["model"])))
+    if filters.get("boya_durumu") == "Yok":
+        clauses.append('"boya" = ?')
+        params.append(BOYA_NONE_VALUE)
+    if filters.get("parca_durumu") == "Yok":
+        clauses.append('"parca" = ?')
+        params.append(PARCA_NONE_VALUE)
+
+    if exclusions.get("exclude_brands"):
+        clauses.append(f'"marka" NOT IN ({_placeholders(exclusions["exclude_brands"])})')
+        params.extend(exclusions["exclude_brands"])
+    if exclusions.get("exclude_fuel_types"):
+        # The parser sometimes files transmissions ("manuel hariç") under fuel exclusions.
+        fuels = [v for v in exclusions["exclude_fuel_types"] if v not in VITES_VALUES]
+        transmissions = [v for v in exclusions["exclude_fuel_types"] if v in VITES_VALUES]
+        if fuels:
+            values = expand_values(fuels, YAKIT_VALUES)
+            clauses.append(f'"yakit" NOT IN ({_placeholders(values)})')
+            params.extend(values)
+        if transmissions:
+            values = expand_values(transmissions, VITES_VALUES)
+            clauses.append(f'"vites" NOT IN ({_placeholders(values)})')
+            params.extend(values)
+    for color in exclusions.get("exclude_colors") or []:
+        # Stored colours carry qualifiers such as 'Gri (metalik)'.
+        clauses.append('"renk" NOT LIKE ?')
+        params.append(f"{color}%")
+    if exclusions.get("sports_car_excluded"):
+        clauses.append(f'"kasa_tipi" NOT IN ({_placeholders(SPORTS_BODY_TYPES)})')
+        params.extend(SPORTS_BODY_TYPES)
+
+    return (" AND ".join(clauses) if clauses else "1 = 1"), params
+
+def build_search_query(constraints: Dict[str, Any], seek_diversity: bool = False,
+                       limit: int = 5, offset: int = 0, order_by_value: bool = False) -> Tuple[str, List[Any]]:
+    """
+    Compiles the session state into a complete SELECT with the same semantics the SQL agent is asked for.
+    With order_by_value, the best deals (highest market.py deal_score, indexed) come first.
+    """
+    where, params = build_where_clause(constraints)
+    columns = ", ".join(f'"{c}"' for c in get_table_columns())
+    if seek_diversity:
+        # One car per brand first, then the second car per brand, and so on.
+        sql = (
+            f"SELECT {columns} FROM ("
+            f"SELECT *, ROW_NUMBER() OVER (PARTITION BY \"marka\" ORDER BY RANDOM()) AS brand_rank "
+            f"FROM {TABLE_NAME} WHERE {where}"
+            f") ORDER BY brand_rank, RANDOM() LIMIT ? OFFSET ?"
+        )
+    elif order_by_value and "deal_score" in get_table_columns():
+        # NULL scores (too few comparable listings) sort last in descending order.
+        sql = f'SELECT {columns} FROM {TABLE_NAME} WHERE {where} ORDER BY "deal_score" DESC, "id" DESC LIMIT ? OFFSET ?'
+    else:
+        sql = f'SELECT {columns} FROM {TABLE_NAME} WHERE {where} ORDER BY "id" DESC LIMIT ? OFFSET ?'
+    return sql, params + [limit, offset]
+
+def get_readonly_connection() -> sqlite3.Connection:
+    """Read-only connection to the listings database."""
+    conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def fetch_rows_by_ids(ids: List[int]) -> List[Dict[str, Any]]:
+    """Full rows for the given listing ids, in the given order."""
+    if not ids:
+        return []
+    with closing(get_readonly_connection()) as conn:
+        rows = conn.execute(
+            f'SELECT * FROM {TABLE_NAME} WHERE "id" IN (SELECT value FROM json_each(?))', (json.dumps(ids),)
+        ).fetchall()
+    by_id = {row["id"]: dict(row) for row in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+def run_compiled_search(constraints: Dict[str, Any], seek_diversity: bool = False,
+                        limit: int = 5, offset: int = 0, order_by_value: bool = False) -> List[Dict[str, Any]]:
+    """Runs the compiled query directly, without any LLM involvement."""
+    sql, params = build_search_query(constraints, seek_diversity, limit, offset, order_by_value)
+    with closing(get_readonly_connection()) as conn:
+        rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+    logger.info(f"Compiled search returned {len(rows)} results.")
+    return rows
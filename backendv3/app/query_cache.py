@@ -0,0 +1,392 @@
+# app/query_cache.py
+"""
+Near-duplicate cache for parse_user_query.
+
+Queries are normalised (case, punctuation, filler words such as "bir" / "lütfen") and
+embedded locally as hashed character trigram counts, L2-normalised, in a fixed-size
+numpy matrix. A lookup is one matrix-vector product: the most similar cached query is
+reused when its cosine similarity reaches QUERY_CACHE_THRESHOLD and its guard key is
+identical. The guard key holds the tokens a trigram vector cannot be trusted with:
+numbers with their unit ("700 bin", "2015"), brands (canonicalised through
+brand_mapping), series and model words of the listings ("golf" / "polo", "tdi"),
+negations, condition words ("hasarlı" / "hasarsız") and the fuel / transmission / body /
+colour keywords of the rule-based parser, so "dizel olsun" never reuses "dizel olmasın".
+
+Only LLM parses are stored. A sample of near (non-exact) hits is re-parsed in the
+background and compared with the reused parse; the agreement rate is reported as the
+cache's precision, and disagreeing entries are replaced.
+
+Parses are also written to the shared cache: a local miss falls back on an exact match
+stored by another worker, and `warm()` fills the index from the most recent entries.
+"""
+
+import os
+import re
+import zlib
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+
+import shared_cache
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE", "1") != "0"
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2000"))
+QUERY_CACHE_DIM = int(os.getenv("QUERY_CACHE_DIM", "1024"))
+# Tuned with `python app/query_cache.py --pairs query_cache_pairs.tsv` (see evaluate_pairs) against
+# hand-labelled query pairs; `--reference llm` replays a query list against Gemini parses instead.
+# On the pairs the guard rejects every "different" pair at any threshold from 0.6 (precision 1.0);
+# recall is 0.97 at 0.65, 0.94 at 0.7, 0.91 at 0.75 and 0.82 at 0.8. 0.7 is the highest threshold
+# that keeps every near hit of the replay corpus, and leaves the guard some margin.
+QUERY_CACHE_THRESHOLD = float(os.getenv("QUERY_CACHE_THRESHOLD", "0.7"))
+QUERY_CACHE_VERIFY_RATE = float(os.getenv("QUERY_CACHE_VERIFY_RATE", "0.05"))
+NGRAM = 3
+
+FILLER_WORDS = {"bir", "bi", "lütfen", "lutfen", "acaba", "bana", "rica", "ederim", "please", "a", "an", "the", "me"}
+UNIT_WORDS = {"bin", "milyon", "million", "k", "m", "tl", "lira", "km", "kilometre", "yaş", "yas", "yaşında", "yasinda",
+              "yıl", "yil", "model", "years", "year"}
+
+# Listing condition words; the rule-based parser only matches some of them inline.
+CONDITION_WORDS = ("hasarlı", "hasarli", "hasarsız", "hasarsiz", "boyalı", "boyali", "boyasız", "boyasiz",
+                   "değişenli", "degisenli", "değişensiz", "degisensiz", "hatalı", "hatali", "hatasız", "hatasiz",
+                   "tramerli", "tramersiz", "kazalı", "kazali", "kazasız", "kazasiz")
+# Degree words that flip an intent the rest of the query shares ("az yakan" / "çok yakan").
+DEGREE_WORDS = ("az", "çok", "cok", "düşük", "dusuk", "yüksek", "yuksek", "yeni", "eski", "ucuz", "pahalı", "pahali")
+# Upper-bound words; the parser reads a bare amount as a maximum as well.
+UPPER_BOUND_WORDS = ("altı", "alti", "altında", "altinda", "under", "below", "en fazla", "maksimum", "max")
+# The parser matches diversity phrases as substrings; the guard matches whole words, so it needs the plurals.
+DIVERSITY_PLURALS = ("başka seçenekler", "baska secenekler")
+
+_TOKEN = re.compile(r"\d+(?:[.,]\d+)*|[^\W\d_]+")
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+# --- Normalisation and vectors ---
+
+def normalize(query: str) -> List[str]:
+    """Lower-cased word and number tokens without filler words."""
+    text = query.lower().replace("̇", "")  # "İ".lower() leaves a combining dot
+    return [token for token in _TOKEN.findall(text) if token not in FILLER_WORDS]
+
+def vectorize(tokens: List[str]) -> np.ndarray:
+    """L2-normalised counts of hashed character trigrams of the padded tokens."""
+    vector = np.zeros(QUERY_CACHE_DIM, dtype=np.float32)
+    for token in tokens:
+        padded = f" {token} "
+        for i in range(max(1, len(padded) - NGRAM + 1)):
+            vector[zlib.crc32(padded[i:i + NGRAM].encode("utf-8")) % QUERY_CACHE_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+_vocabulary: Optional[Tuple[Dict[str, str], FrozenSet[str], Dict[str, str]]] = None
+
+def _model_terms(brand_phrases) -> FrozenSet[str]:
+    """
+    Folded words of every seri / model value in the listings database ("golf", "tdi"), plus
+    one-letter series such as Mercedes "E" / "C"; brand names and aliases are left to the brand part.
+    """
+    import sqlite3
+    from contextlib import closing
+    import text_index
+    db_path = os.path.join(os.path.dirname(__file__), "araba_verileri.db")
+    try:
+        with closing(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)) as conn:
+            rows = conn.execute('SELECT DISTINCT "seri", "model" FROM araba_ilanlari').fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Model words unavailable for the query cache guard: {e}")
+        return frozenset()
+    brand_tokens = {token for phrase in brand_phrases for token in text_index.tokenize(phrase)}
+    terms = set()
+    for seri, model in rows:
+        seri_tokens = text_index.tokenize(seri or "")
+        if len(seri_tokens) == 1 and seri_tokens[0].isalpha():
+            terms.add(seri_tokens[0])
+        terms.update(token for token in seri_tokens + text_index.tokenize(model or "")
+                     if len(token) >= 2 and re.search(r"[a-z]", token))
+    return frozenset(terms - brand_tokens)
+
+def _guard_vocabulary() -> Tuple[Dict[str, str], FrozenSet[str], Dict[str, str]]:
+    """
+    (brand phrase -> canonical brand, series and model words, keyword -> canonical keyword),
+    built on first use. Spellings of one keyword ("altı" / "altında", "hibrit" / "hybrid") share
+    a canonical form, so they do not split the guard.
+    """
+    global _vocabulary
+    if _vocabulary is None:
+        # Imported lazily: fallback_parser imports parser, which imports this module.
+        import fallback_parser as fp
+        import text_index
+        from brand_mapping import FUZZY_BRAND_MAP, get_database_brands
+        brands = {brand.lower(): brand for brand in get_database_brands() if brand}
+        brands.update({alias.lower(): brand for alias, brand in FUZZY_BRAND_MAP.items()})
+        keywords: Dict[str, str] = {}
+        for mapping in (fp.FUEL_KEYWORDS, fp.TRANSMISSION_KEYWORDS, fp.BODY_KEYWORDS, fp.COLOR_WORDS):
+            keywords.update({word: str(value) for word, value in mapping.items()})
+        for table in (fp.SEGMENT_KEYWORDS, fp.MILEAGE_KEYWORDS, fp.AGE_KEYWORDS):
+            keywords.update({phrase: phrases[0] for phrases, *_ in table for phrase in phrases})
+        # The parser reads every word of these groups the same way, so each group is one keyword.
+        for words, canonical in ((UPPER_BOUND_WORDS, "max"), (fp.LOWER_BOUND_WORDS, "min"),
+                                 ((*fp.DIVERSITY_PHRASES, *DIVERSITY_PLURALS), "seek_diversity")):
+            for word in words:
+                keywords.setdefault(word, canonical)
+        for word in (*fp.NEGATION_WORDS, *fp.VALUE_PHRASES, *fp.RESET_PHRASES, *CONDITION_WORDS, *DEGREE_WORDS):
+            keywords.setdefault(word, text_index.fold(word))
+        _vocabulary = (brands, _model_terms(brands), keywords)
+    return _vocabulary
+
+def guard_key(tokens: List[str]) -> Tuple[Tuple[Tuple[str, str], ...], FrozenSet[str], FrozenSet[str], FrozenSet[str]]:
+    """Numbers with the unit word after them, canonical brands, series / model words and keywords of a query."""
+    import text_index
+    brands, model_terms, keywords = _guard_vocabulary()
+    numbers = tuple(
+        (token.replace(",", "."), text_index.fold(tokens[i + 1]) if i + 1 < len(tokens) and tokens[i + 1] in UNIT_WORDS else "")
+        for i, token in enumerate(tokens) if _NUMBER.fullmatch(token)
+    )
+    text = f" {' '.join(tokens)} "
+    found_brands = frozenset(brand for phrase, brand in brands.items() if f" {phrase} " in text)
+    found_models = frozenset(token for token in text_index.tokenize(text) if token in model_terms)
+    found_keywords = frozenset(canonical for word, canonical in keywords.items() if f" {word} " in text)
+    return numbers, found_brands, found_models, found_keywords
+
+def same_parse(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """Parses agree when their filters, exclusions and inferred flags are equal (assumption texts may differ)."""
+    flags = ("reset_filters", "seek_diversity", "sort_by_value")
+    return (a.get("filters") == b.get("filters") and a.get("exclusions") == b.get("exclusions")
+            and all((a.get("inferred") or {}).get(f) == (b.get("inferred") or {}).get(f) for f in flags))
+
+# --- Cache ---
+
+class QueryCache:
+    """Fixed-size matrix of query vectors; the oldest entry is overwritten when full."""
+
+    def __init__(self, size: int = QUERY_CACHE_SIZE, threshold: float = QUERY_CACHE_THRESHOLD,
+                 verify_rate: float = QUERY_CACHE_VERIFY_RATE):
+        self.size = size
+        self.threshold = threshold
+        self.verify_rate = verify_rate
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((size, QUERY_CACHE_DIM), dtype=np.float32)
+        self._entries: List[Optional[Tuple[str, Any, Dict[str, Any]]]] = [None] * size  # (text, guard, parsed)
+        self._slots: Dict[str, int] = {}
+        self._next = 0
+        self._verifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-cache-verify")
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.guard_rejections = 0
+        self.verified = 0
+        self.verified_agreeing = 0
+        self.shared_hits = 0
+
+    def lookup(self, query: str, verify: Optional[Callable[[str], Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+        """The cached parse of the most similar query above the threshold with the same guard key, or None."""
+        tokens = normalize(query)
+        text = " ".join(tokens)
+        vector = vectorize(tokens)
+        guard = guard_key(tokens)
+        with self._lock:
+            slot = self._slots.get(text)
+            if slot is not None:
+                self.exact_hits += 1
+                return self._entries[slot][2]
+            if not self._slots:
+                self.misses += 1
+                return None
+            scores = self._vectors @ vector
+            candidates = np.flatnonzero(scores >= self.threshold)
+            match = None
+            for candidate in candidates[np.argsort(-scores[candidates])]:
+                entry = self._entries[candidate]
+                if entry is not None and entry[1] == guard:
+                    match = (entry, float(scores[candidate]))
+                    break
+            if match is None:
+                self.misses += 1
+                if len(candidates):
+                    self.guard_rejections += 1
+                return None
+            self.near_hits += 1
+        (cached_text, _, parsed), similarity = match
+        logger.info(f"Query cache hit ({similarity:.3f}): '{query}' reuses the parse of '{cached_text}'.")
+        if verify is not None and random.random() < self.verify_rate:
+            self._verifier.submit(self._verify, query, parsed, verify)
+        return parsed
+
+    def store(self, query: str, parsed: Dict[str, Any]):
+        tokens = normalize(query)
+        text = " ".join(tokens)
+        if not text:
+            return
+        vector = vectorize(tokens)
+        guard = guard_key(tokens)
+        with self._lock:
+            slot = self._slots.get(text)
+            if slot is None:
+                slot = self._next
+                self._next = (self._next + 1) % self.size
+                evicted = self._entries[slot]
+                if evicted is not None:
+                    self._slots.pop(evicted[0], None)
+                self._slots[text] = slot
+            self._vectors[slot] = vector
+            self._entries[slot] = (text, guard, parsed)
+
+    def _verify(self, query: str, reused: Dict[str, Any], verify: Callable[[str], Dict[str, Any]]):
+        try:
+            fresh = verify(query)
+        except Exception as e:
+            logger.warning(f"Query cache verification of '{query}' failed: {e}")
+            return
+        agreeing = same_parse(reused, fresh)
+        with self._lock:
+            self.verified += 1
+            self.verified_agreeing += int(agreeing)
+        if not agreeing:
+            logger.warning(f"Query cache near hit for '{query}' disagreed with a fresh parse; storing the fresh one.")
+            self.store(query, fresh)
+
+    def record_shared_hit(self, query: str, parsed: Dict[str, Any]):
+        """Adopts a parse another worker stored for this exact (normalised) query."""
+        self.store(query, parsed)
+        with self._lock:
+            self.shared_hits += 1
+
+    def clear(self):
+        with self._lock:
+            self._vectors[:] = 0
+            self._entries = [None] * self.size
+            self._slots.clear()
+            self._next = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.exact_hits + self.near_hits + self.misses
+            hits = self.exact_hits + self.near_hits + self.shared_hits
+            return {
+                "enabled": QUERY_CACHE_ENABLED,
+                "entries": len(self._slots),
+                "size": self.size,
+                "threshold": self.threshold,
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "shared_hits": self.shared_hits,
+                "guard_rejections": self.guard_rejections,
+                "hit_rate": round(hits / lookups, 4) if lookups else None,
+                "verified_near_hits": self.verified,
+                "precision": round(self.verified_agreeing / self.verified, 4) if self.verified else None,
+            }
+
+query_cache = QueryCache()
+
+def lookup(query: str, verify: Optional[Callable[[str], Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+    if not QUERY_CACHE_ENABLED:
+        return None
+    parsed = query_cache.lookup(query, verify)
+    if parsed is None:
+        parsed = shared_cache.get("parse", " ".join(normalize(query)))
+        if parsed is not None:
+            query_cache.record_shared_hit(query, parsed)
+    return parsed
+
+def store(query: str, parsed: Dict[str, Any]):
+    if QUERY_CACHE_ENABLED:
+        query_cache.store(query, parsed)
+        shared_cache.put("parse", " ".join(normalize(query)), parsed)
+
+def warm():
+    """Loads the most recent shared parses into this process's index."""
+    if QUERY_CACHE_ENABLED:
+        for text, parsed in reversed(shared_cache.recent("parse", query_cache.size)):
+            query_cache.store(text, parsed)
+
+def stats() -> Dict[str, Any]:
+    return query_cache.stats()
+
+# --- Threshold tuning ---
+
+def evaluate(queries: List[str], parse: Callable[[str], Dict[str, Any]],
+             thresholds: List[float]) -> List[Dict[str, Any]]:
+    """
+    Replays `queries` in order through a fresh cache per threshold, with `parse` as the
+    reference: a near hit is correct when its reused parse equals parse(query).
+    """
+    reference = {query: parse(query) for query in set(queries)}
+    report = []
+    for threshold in thresholds:
+        cache = QueryCache(size=max(len(queries), 1), threshold=threshold, verify_rate=0.0)
+        correct = 0
+        for query in queries:
+            before = cache.near_hits
+            reused = cache.lookup(query)
+            if reused is None:
+                cache.store(query, reference[query])
+            elif cache.near_hits > before:
+                correct += int(same_parse(reused, reference[query]))
+        summary = cache.stats()
+        report.append({
+            "threshold": threshold,
+            "hit_rate": summary["hit_rate"],
+            "near_hits": summary["near_hits"],
+            "guard_rejections": summary["guard_rejections"],
+            "precision": round(correct / summary["near_hits"], 4) if summary["near_hits"] else None,
+        })
+    return report
+
+def evaluate_pairs(pairs: List[Tuple[str, str, bool]], thresholds: List[float]) -> List[Dict[str, Any]]:
+    """
+    Tunes against hand-labelled pairs (cached query, later query, may reuse): per threshold,
+    the share of reuses that were allowed (precision) and of allowed reuses that happened (recall).
+    """
+    report = []
+    for threshold in thresholds:
+        reused = correct = 0
+        for cached, later, same in pairs:
+            cache = QueryCache(size=1, threshold=threshold, verify_rate=0.0)
+            cache.store(cached, {"query": cached})
+            if cache.lookup(later) is not None:
+                reused += 1
+                correct += int(same)
+        allowed = sum(1 for _, _, same in pairs if same)
+        report.append({
+            "threshold": threshold,
+            "reused": reused,
+            "precision": round(correct / reused, 4) if reused else None,
+            "recall": round(correct / allowed, 4) if allowed else None,
+        })
+    return report
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    logging.basicConfig(level=logging.WARNING)
+    arg_parser = argparse.ArgumentParser(description="Tune the near-duplicate query cache threshold.")
+    arg_parser.add_argument("queries", nargs="?",
+                            help="Text file with one query per line, or a replay corpus (.jsonl).")
+    arg_parser.add_argument("--pairs", help="Hand-labelled pairs (TSV: cached query, later query, same|different).")
+    arg_parser.add_argument("--reference", choices=("rules", "llm"), default="rules",
+                            help="Parser whose output judges the near hits of a query list.")
+    arg_parser.add_argument("--thresholds", default="0.75,0.8,0.85,0.9,0.95")
+    args = arg_parser.parse_args()
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    if args.pairs:
+        with open(args.pairs, encoding="utf-8") as f:
+            rows = [line.rstrip("\n").split("\t") for line in f if line.strip() and not line.startswith("#")]
+        print(json.dumps(evaluate_pairs([(a, b, label == "same") for a, b, label in rows], thresholds), indent=2))
+        raise SystemExit
+    if not args.queries:
+        arg_parser.error("a query file or --pairs is required")
+    with open(args.queries, encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if args.queries.endswith(".jsonl"):
+        lines = [turn["user_query"] for line in lines for turn in json.loads(line)["turns"]]
+    if args.reference == "llm":
+        from parser import _parse_with_llm as reference
+    else:
+        from fallback_parser import parse_query_deterministic as reference
+    print(json.dumps(evaluate(lines, reference, thresholds), indent=2))
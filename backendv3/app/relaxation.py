@@ -0,0 +1,188 @@
+# app/relaxation.py
+"""
+Zero-result relaxation planner.
+
+When a search returns nothing, every active filter is tentatively widened or dropped and
+the matching rows are counted from the inventory's per-clause masks (one AND per
+candidate, no SQL). The cheapest relaxation that yields results wins; if no single step
+does, pairs of steps are tried. Costs express how far a step strays from what the user
+asked for: nudging a bound is cheaper than dropping it, and dropping something the user
+explicitly excluded or named (a brand) is the most expensive.
+"""
+
+import logging
+from copy import deepcopy
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from inventory import Inventory
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+MIN_RESULTS = 1
+MAX_STEPS = 2
+
+@dataclass
+class Relaxation:
+    """One way of loosening a single filter or exclusion key."""
+    key: str
+    section: str                    # "filters" or "exclusions"
+    cost: float
+    describe: Callable[[Any], str]  # old value -> Turkish description for inferred.assumptions
+    widen: Optional[Callable[[Any], Any]] = None   # None drops the constraint
+
+    def apply(self, state: Dict[str, Any]):
+        section = state.setdefault(self.section, {})
+        if self.widen is None:
+            section[self.key] = False if self.key == "sports_car_excluded" else ([] if isinstance(section.get(self.key), list) else None)
+        else:
+            section[self.key] = self.widen(section[self.key])
+
+@dataclass
+class RelaxationPlan:
+    steps: List[Relaxation]
+    count: int
+    cost: float
+    assumptions: List[str] = field(default_factory=list)
+
+    def apply(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns a relaxed copy of the session state with the steps recorded as assumptions."""
+        relaxed = deepcopy(state)
+        for step in self.steps:
+            step.apply(relaxed)
+        assumptions = relaxed.setdefault("inferred", {}).setdefault("assumptions", [])
+        assumptions.extend(a for a in self.assumptions if a not in assumptions)
+        return relaxed
+
+def _tl(value: float) -> str:
+    return f"{int(value):,}".replace(",", ".") + " TL"
+
+def _km(value: float) -> str:
+    return f"{int(value):,}".replace(",", ".") + " km"
+
+def _round_price(value: float) -> int:
+    return int(round(value / 10_000) * 10_000)
+
+def _round_km(value: float) -> int:
+    return int(round(value / 5_000) * 5_000)
+
+# Candidate steps per key, cheapest first.
+RELAXATIONS: Dict[str, List[Relaxation]] = {
+    "fiyat_max": [
+        Relaxation("fiyat_max", "filters", 1.0, lambda v: f"Sonuç bulunamadığı için bütçe %10 artırıldı ({_tl(v)} -> {_tl(_round_price(v * 1.10))}).",
+                   lambda v: _round_price(v * 1.10)),
+        Relaxation("fiyat_max", "filters", 2.5, lambda v: f"Sonuç bulunamadığı için bütçe %25 artırıldı ({_tl(v)} -> {_tl(_round_price(v * 1.25))}).",
+                   lambda v: _round_price(v * 1.25)),
+        Relaxation("fiyat_max", "filters", 6.0, lambda v: f"Sonuç bulunamadığı için üst fiyat sınırı ({_tl(v)}) kaldırıldı."),
+    ],
+    "fiyat_min": [
+        Relaxation("fiyat_min", "filters", 1.0, lambda v: f"Sonuç bulunamadığı için alt fiyat sınırı %10 düşürüldü ({_tl(v)} -> {_tl(_round_price(v * 0.90))}).",
+                   lambda v: _round_price(v * 0.90)),
+        Relaxation("fiyat_min", "filters", 3.0, lambda v: f"Sonuç bulunamadığı için alt fiyat sınırı ({_tl(v)}) kaldırıldı."),
+    ],
+    "age_max": [
+        Relaxation("age_max", "filters", 1.0, lambda v: f"Sonuç bulunamadığı için yaş sınırı 2 yıl artırıldı ({v} -> {v + 2} yaş).",
+                   lambda v: v + 2),
+        Relaxation("age_max", "filters", 2.5, lambda v: f"Sonuç bulunamadığı için yaş sınırı 5 yıl artırıldı ({v} -> {v + 5} yaş).",
+                   lambda v: v + 5),
+        Relaxation("age_max", "filters", 5.0, lambda v: f"Sonuç bulunamadığı için yaş sınırı ({v} yaş) kaldırıldı."),
+    ],
+    "age_min": [
+        Relaxation("age_min", "filters", 1.0, lambda v: f"Sonuç bulunamadığı için en az yaş 2 yıl düşürüldü ({v} -> {max(v - 2, 0)} yaş).",
+                   lambda v: max(v - 2, 0)),
+        Relaxation("age_min", "filters", 3.0, lambda v: f"Sonuç bulunamadığı için en az yaş sınırı ({v} yaş) kaldırıldı."),
+    ],
+    "km_max": [
+        Relaxation("km_max", "filters", 1.0, lambda v: f"Sonuç bulunamadığı için kilometre sınırı %25 artırıldı ({_km(v)} -> {_km(_round_km(v * 1.25))}).",
+                   lambda v: _round_km(v * 1.25)),
+        Relaxation("km_max", "filters", 4.0, lambda v: f"Sonuç bulunamadığı için kilometre sınırı ({_km(v)}) kaldırıldı."),
+    ],
+    "km_min": [
+        Relaxation("km_min", "filters", 2.0, lambda v: f"Sonuç bulunamadığı için en az kilometre sınırı ({_km(v)}) kaldırıldı."),
+    ],
+    "boya_durumu": [
+        Relaxation("boya_durumu", "filters", 3.0, lambda v: "Sonuç bulunamadığı için boyasız şartı kaldırıldı."),
+    ],
+    "parca_durumu": [
+        Relaxation("parca_durumu", "filters", 3.0, lambda v: "Sonuç bulunamadığı için değişensiz şartı kaldırıldı."),
+    ],
+    "kasa_tipi": [
+        Relaxation("kasa_tipi", "filters", 3.5, lambda v: f"Sonuç bulunamadığı için kasa tipi filtresi ({', '.join(v)}) kaldırıldı."),
+    ],
+    "vites": [
+        Relaxation("vites", "filters", 4.0, lambda v: f"Sonuç bulunamadığı için vites filtresi ({v}) kaldırıldı."),
+    ],
+    "yakit": [
+        Relaxation("yakit", "filters", 4.0, lambda v: f"Sonuç bulunamadığı için yakıt filtresi ({', '.join(v)}) kaldırıldı."),
+    ],
+    "exclude_colors": [
+        Relaxation("exclude_colors", "exclusions", 4.0, lambda v: f"Sonuç bulunamadığı için renk hariç tutması ({', '.join(v)}) kaldırıldı."),
+    ],
+    "sports_car_excluded": [
+        Relaxation("sports_car_excluded", "exclusions", 4.5, lambda v: "Sonuç bulunamadığı için spor araç hariç tutması kaldırıldı."),
+    ],
+    "model": [
+        Relaxation("model", "filters", 6.5, lambda v: f"Sonuç bulunamadığı için model filtresi ({', '.join(v)}) kaldırıldı."),
+    ],
+    "marka": [
+        Relaxation("marka", "filters", 7.0, lambda v: f"Sonuç bulunamadığı için marka filtresi ({', '.join(v)}) kaldırıldı."),
+    ],
+    "exclude_fuel_types": [
+        Relaxation("exclude_fuel_types", "exclusions", 8.0, lambda v: f"Sonuç bulunamadığı için hariç tutulan yakıt/vites ({', '.join(v)}) geri eklendi."),
+    ],
+    "exclude_brands": [
+        Relaxation("exclude_brands", "exclusions", 9.0, lambda v: f"Sonuç bulunamadığı için hariç tutulan markalar ({', '.join(v)}) geri eklendi."),
+    ],
+}
+
+def _step_mask(inventory: Inventory, state: Dict[str, Any], step: Relaxation) -> np.ndarray:
+    """The clause mask of `step.key` after the step, or all-true when the step drops it."""
+    if step.widen is None:
+        return np.ones(inventory.size, dtype=bool)
+    value = state[step.section][step.key]
+    widened = {step.section: {step.key: step.widen(value)}}
+    return inventory.clause_masks(widened)[step.key]
+
+def plan_relaxation(inventory: Inventory, state: Dict[str, Any], min_results: int = MIN_RESULTS) -> Optional[RelaxationPlan]:
+    """Finds the cheapest set of at most MAX_STEPS relaxations that returns at least `min_results` rows."""
+    clauses = inventory.clause_masks(state)
+    if not clauses:
+        return None
+
+    candidates = [(step, _step_mask(inventory, state, step)) for key in clauses for step in RELAXATIONS.get(key, [])]
+    best: Optional[RelaxationPlan] = None
+
+    for size in range(1, MAX_STEPS + 1):
+        for combo in combinations(candidates, size):
+            keys = [step.key for step, _ in combo]
+            if len(set(keys)) != len(keys):
+                continue
+            cost = sum(step.cost for step, _ in combo)
+            if best is not None and cost > best.cost:
+                continue
+            replaced = dict(clauses)
+            for step, mask in combo:
+                replaced[step.key] = mask
+            count = int(np.logical_and.reduce(list(replaced.values())).sum())
+            if count < min_results:
+                continue
+            if best is None or cost < best.cost or (cost == best.cost and count > best.count):
+                steps = [step for step, _ in combo]
+                best = RelaxationPlan(
+                    steps=steps,
+                    count=count,
+                    cost=cost,
+                    assumptions=[step.describe(state[step.section][step.key]) for step in steps],
+                )
+        if best is not None:
+            break
+
+    if best:
+        logger.info(f"Relaxation plan: {[s.key for s in best.steps]} (cost {best.cost}) -> {best.count} listings.")
+    else:
+        logger.info("No relaxation within the step budget returns results.")
+    return best
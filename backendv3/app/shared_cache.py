@@ -0,0 +1,149 @@
+# app/shared_cache.py
+"""
+Cache entries shared by every worker process.
+
+A small key-value store in its own SQLite database (WAL mode, so readers never wait for
+the writer) that the per-process caches write through to and fall back on: a plan,
+parse or candidate set computed by one gunicorn worker is found by the others. Values
+are pickled; entries expire after their TTL and each namespace keeps at most
+SHARED_CACHE_MAX_ROWS rows, oldest first out.
+
+Connections are per thread and per process: a connection opened before gunicorn forks
+its workers is never used by a worker.
+"""
+
+import os
+import time
+import pickle
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SHARED_CACHE_ENABLED = os.getenv("SHARED_CACHE", "1") != "0"
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", os.path.join(os.path.dirname(__file__), "shared_cache.db"))
+SHARED_CACHE_MAX_ROWS = int(os.getenv("SHARED_CACHE_MAX_ROWS", "5000"))
+# Every this many writes a namespace is trimmed back to SHARED_CACHE_MAX_ROWS.
+PRUNE_EVERY_WRITES = 200
+
+_local = threading.local()
+_lock = threading.Lock()
+_counters = {"hits": 0, "misses": 0, "writes": 0, "errors": 0}
+_writes_since_prune: Dict[str, int] = {}
+
+def _connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        conn = sqlite3.connect(SHARED_CACHE_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB NOT NULL,
+                expires_at REAL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_updated ON cache_entries (namespace, updated_at)")
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+def _count(name: str):
+    with _lock:
+        _counters[name] += 1
+
+def get(namespace: str, key: str) -> Optional[Any]:
+    """The live value stored under (namespace, key), or None. Errors count as misses."""
+    if not SHARED_CACHE_ENABLED:
+        return None
+    try:
+        row = _connection().execute(
+            "SELECT value FROM cache_entries WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (namespace, key, time.time()),
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Shared cache read failed ({namespace}): {e}")
+        _count("errors")
+        return None
+    if row is None:
+        _count("misses")
+        return None
+    _count("hits")
+    return pickle.loads(row[0])
+
+def put(namespace: str, key: str, value: Any, ttl_seconds: Optional[float] = None):
+    """Stores a value for every worker. Failures are logged, never raised into the request."""
+    if not SHARED_CACHE_ENABLED:
+        return
+    now = time.time()
+    try:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (namespace, key, value, expires_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+             now + ttl_seconds if ttl_seconds else None, now),
+        )
+        _count("writes")
+        with _lock:
+            _writes_since_prune[namespace] = _writes_since_prune.get(namespace, 0) + 1
+            prune = _writes_since_prune[namespace] >= PRUNE_EVERY_WRITES
+            if prune:
+                _writes_since_prune[namespace] = 0
+        if prune:
+            _prune(conn, namespace, now)
+    except sqlite3.Error as e:
+        logger.warning(f"Shared cache write failed ({namespace}): {e}")
+        _count("errors")
+
+def delete(namespace: str, key: str):
+    if not SHARED_CACHE_ENABLED:
+        return
+    try:
+        _connection().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+    except sqlite3.Error as e:
+        logger.warning(f"Shared cache delete failed ({namespace}): {e}")
+        _count("errors")
+
+def recent(namespace: str, limit: int) -> List[Tuple[str, Any]]:
+    """The most recently written live entries of a namespace, newest first."""
+    if not SHARED_CACHE_ENABLED:
+        return []
+    try:
+        rows = _connection().execute(
+            """SELECT key, value FROM cache_entries
+               WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)
+               ORDER BY updated_at DESC LIMIT ?""",
+            (namespace, time.time(), limit),
+        ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Shared cache scan failed ({namespace}): {e}")
+        return []
+    return [(key, pickle.loads(value)) for key, value in rows]
+
+def _prune(conn: sqlite3.Connection, namespace: str, now: float):
+    conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND expires_at <= ?", (namespace, now))
+    conn.execute("""
+        DELETE FROM cache_entries WHERE namespace = ? AND updated_at < (
+            SELECT updated_at FROM cache_entries WHERE namespace = ?
+            ORDER BY updated_at DESC LIMIT 1 OFFSET ?
+        )
+    """, (namespace, namespace, SHARED_CACHE_MAX_ROWS - 1))
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        counters = dict(_counters)
+    counters["enabled"] = SHARED_CACHE_ENABLED
+    if SHARED_CACHE_ENABLED:
+        try:
+            counters["entries"] = dict(_connection().execute(
+                "SELECT namespace, COUNT(*) FROM cache_entries GROUP BY namespace"
+            ).fetchall())
+        except sqlite3.Error:
+            counters["entries"] = None
+    return counters
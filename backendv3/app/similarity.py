@@ -0,0 +1,98 @@
+# app/similarity.py
+"""
+"More like this" nearest-neighbour search over the inventory.
+
+Each listing is described by standardised numeric features (log price, log km, year)
+and label-encoded categoricals (marka, seri, kasa_tipi, yakit, vites). The squared
+distance between two listings is the squared Euclidean distance of the numeric part
+plus the weight of every categorical that differs, which is the same as a weighted
+one-hot encoding without materialising the one-hot columns. The matrix is built once
+per inventory snapshot.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import inventory
+from query_builder import fetch_rows_by_ids
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Cost of a mismatch, in units of squared standard deviations of the numeric features.
+CATEGORICAL_WEIGHTS = {"seri": 2.0, "marka": 1.0, "kasa_tipi": 0.75, "yakit": 0.75, "vites": 0.5}
+MAX_NEIGHBOURS = 50
+
+def _standardise(values: np.ndarray) -> np.ndarray:
+    """z-scores, with missing or non-numeric (text) values set to the median first."""
+    values = values.astype(np.float64).copy()
+    valid = np.isfinite(values)
+    values[~valid] = np.median(values[valid]) if valid.any() else 0.0
+    std = values.std()
+    return (values - values.mean()) / (std if std > 0 else 1.0)
+
+class FeatureMatrix:
+    def __init__(self, snapshot: "inventory.Inventory"):
+        self.ids = snapshot.ids
+        self.position = snapshot.position
+        self.marka = snapshot.text["marka"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_price = np.log1p(np.where(snapshot.fiyat > 0, snapshot.fiyat, np.nan))
+            log_km = np.log1p(np.where(snapshot.km >= 0, snapshot.km, np.nan))
+        self.numeric = np.column_stack([
+            _standardise(log_price), _standardise(log_km), _standardise(snapshot.yil),
+        ]).astype(np.float32)
+        self.categorical = np.column_stack([
+            np.unique(snapshot.text[column].astype(str), return_inverse=True)[1]
+            for column in CATEGORICAL_WEIGHTS
+        ]).astype(np.int32)
+        self.weights = np.array(list(CATEGORICAL_WEIGHTS.values()), dtype=np.float32)
+        logger.info(f"Built similarity matrix for {len(self.ids)} listings (inventory v{snapshot.version}).")
+
+    def distances(self, position: int) -> np.ndarray:
+        numeric = self.numeric - self.numeric[position]
+        mismatches = (self.categorical != self.categorical[position]).astype(np.float32)
+        return np.einsum("ij,ij->i", numeric, numeric) + mismatches @ self.weights
+
+    def neighbours(self, position: int, k: int, max_per_brand: Optional[int] = None) -> List[tuple]:
+        """(position, distance) of the k nearest listings, at most max_per_brand per brand."""
+        distances = self.distances(position)
+        distances[position] = np.inf
+        pool = min(len(distances) - 1, k if not max_per_brand else k * 20)
+        candidates = np.argpartition(distances, pool)[:pool] if pool < len(distances) else np.arange(len(distances))
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+
+        chosen, per_brand = [], {}
+        for candidate in candidates:
+            if not np.isfinite(distances[candidate]):
+                continue
+            brand = self.marka[candidate]
+            if max_per_brand and per_brand.get(brand, 0) >= max_per_brand:
+                continue
+            per_brand[brand] = per_brand.get(brand, 0) + 1
+            chosen.append((int(candidate), float(distances[candidate])))
+            if len(chosen) == k:
+                break
+        return chosen
+
+def get_matrix() -> FeatureMatrix:
+    return inventory.get_inventory().derived("similarity", FeatureMatrix)
+
+def find_similar(listing_id: int, k: int = 5, max_per_brand: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """The reference listing and its k nearest neighbours, or None if the id is unknown."""
+    matrix = get_matrix()
+    position = matrix.position.get(listing_id)
+    if position is None:
+        return None
+    neighbours = matrix.neighbours(position, min(k, MAX_NEIGHBOURS), max_per_brand)
+    ids = [listing_id] + [int(matrix.ids[p]) for p, _ in neighbours]
+    rows = {row["id"]: row for row in fetch_rows_by_ids(ids)}
+    return {
+        "listing": rows.get(listing_id),
+        "results": [
+            {**rows[int(matrix.ids[p])], "distance": round(distance, 4)}
+            for p, distance in neighbours if int(matrix.ids[p]) in rows
+        ],
+    }
@@ -0,0 +1,91 @@
+# app/singleflight.py
+
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into a single execution.
+    The first caller (the leader) runs the function; callers arriving while it is
+    in flight wait on the same future and receive its result or exception.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.executions = 0
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Runs fn() once per in-flight key.
+        Returns (result, shared) where shared is True if the result came from another caller.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.executions += 1
+            else:
+                self.shared += 1
+
+        if not is_leader:
+            logger.info(f"[{self.name}] Joined an in-flight call instead of issuing a duplicate.")
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "saved_calls": self.shared,
+                "in_flight": len(self._in_flight),
+            }
+
+# --- Registry ---
+_groups: Dict[str, SingleFlight] = {}
+_groups_lock = threading.Lock()
+
+def get_group(name: str) -> SingleFlight:
+    """Returns the named single-flight group, creating it on first use."""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Counters for every group, e.g. for the /metrics endpoint."""
+    with _groups_lock:
+        groups = list(_groups.values())
+    return {group.name: group.stats() for group in groups}
+
+def canonical_key(*parts: Any) -> str:
+    """Builds a stable key from arbitrary JSON-like parts (dict ordering does not matter)."""
+    return json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a user query, used as a coalescing key."""
+    return " ".join(query.lower().split())
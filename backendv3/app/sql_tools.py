@@ -0,0 +1,45 @@
+# app/sql_tools.py
+"""
+SQL agent tools that hand structured results back to the caller.
+Imported lazily by langchain_agent when the toolkit is first built.
+"""
+
+import logging
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForToolRun
+from langchain_core.tools import BaseTool
+from langchain_community.agent_toolkits.sql.toolkit import SQLDatabaseToolkit
+from langchain_community.tools.sql_database.tool import QuerySQLDatabaseTool
+
+from langchain_agent import execute_select, record_captured_query
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class CapturingQuerySQLTool(QuerySQLDatabaseTool):
+    """
+    Drop-in replacement for the toolkit's `sql_db_query` tool.
+    Executes the statement once, records the SQL and typed rows for the current agent
+    run, and gives the agent the same textual result the stock tool would.
+    """
+
+    def _run(self, query: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> Any:
+        try:
+            captured = execute_select(query)
+        except Exception as e:
+            # Same contract as SQLDatabase.run_no_throw: the agent sees the error and can retry.
+            return f"Error: {e}"
+        record_captured_query(captured)
+        return str([tuple(row.values()) for row in captured.rows])
+
+class CapturingSQLDatabaseToolkit(SQLDatabaseToolkit):
+    """SQLDatabaseToolkit whose query tool captures results via CapturingQuerySQLTool."""
+
+    def get_tools(self) -> List[BaseTool]:
+        tools = super().get_tools()
+        return [
+            CapturingQuerySQLTool(db=self.db, description=tool.description)
+            if isinstance(tool, QuerySQLDatabaseTool) else tool
+            for tool in tools
+        ]
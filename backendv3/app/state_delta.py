@@ -0,0 +1,73 @@
+# app/state_delta.py
+"""
+Per-turn deltas of the session state.
+
+A session state is a dict of sections (filters, exclusions, inferred, raw_entities)
+plus scalars such as confidence. A delta records, per "section.key" path, the values
+that were set, the keys that were removed and the items appended to lists (the
+assumptions list only ever grows, so a turn usually stores just its new assumptions).
+
+Applying a delta never mutates its input: untouched sections are shared with the
+previous state and only changed sections are copied.
+"""
+
+from typing import Any, Dict
+
+def _split(path: str):
+    section, _, key = path.partition(".")
+    return section, key or None
+
+def diff_state(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    """The delta that turns `old` into `new`."""
+    delta: Dict[str, Any] = {}
+    for section in list(old) + [s for s in new if s not in old]:
+        if section not in new:
+            delta.setdefault("del", []).append(section)
+            continue
+        old_value, new_value = old.get(section), new[section]
+        if not (isinstance(old_value, dict) and isinstance(new_value, dict)):
+            if section not in old or old_value != new_value:
+                delta.setdefault("set", {})[section] = new_value
+            continue
+        for key in list(old_value) + [k for k in new_value if k not in old_value]:
+            path = f"{section}.{key}"
+            if key not in new_value:
+                delta.setdefault("del", []).append(path)
+            elif key not in old_value or old_value[key] != new_value[key]:
+                before, after = old_value.get(key), new_value[key]
+                if isinstance(before, list) and isinstance(after, list) \
+                        and len(after) > len(before) and after[:len(before)] == before:
+                    delta.setdefault("append", {})[path] = after[len(before):]
+                else:
+                    delta.setdefault("set", {})[path] = after
+    return delta
+
+def apply_delta(state: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """A new state with the delta applied; sections the delta does not touch are shared."""
+    result = dict(state)
+    copied = set()
+
+    def section_for_write(section: str) -> Dict[str, Any]:
+        if section not in copied:
+            result[section] = dict(result.get(section) or {})
+            copied.add(section)
+        return result[section]
+
+    for path in delta.get("del", []):
+        section, key = _split(path)
+        if key is None:
+            result.pop(section, None)
+        else:
+            section_for_write(section).pop(key, None)
+    for path, value in delta.get("set", {}).items():
+        section, key = _split(path)
+        if key is None:
+            result[section] = value
+            copied.discard(section)
+        else:
+            section_for_write(section)[key] = value
+    for path, items in delta.get("append", {}).items():
+        section, key = _split(path)
+        target = section_for_write(section)
+        target[key] = list(target.get(key) or []) + list(items)
+    return result
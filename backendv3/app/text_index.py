@@ -0,0 +1,142 @@
+# app/text_index.py
+"""
+In-memory inverted index over the marka / seri / model text of every listing.
+
+Text is folded with Turkish rules (I -> ı -> i, ş -> s, ...) and split into tokens that
+keep engine sizes together ("1.6", "d-4d" -> "d", "4d"). Each token maps to the sorted
+inventory positions containing it. A query term such as "Golf 1.6 TDI" matches listings
+that contain every token, where each query token of two or more characters also matches
+as a prefix ("tdi" -> "tdi", "corol" -> "corolla").
+
+The index is derived from an inventory snapshot, so it is rebuilt whenever the listings
+database changes (see inventory.get_inventory).
+"""
+
+import re
+import bisect
+import logging
+from collections import defaultdict
+from typing import Dict, List, Set
+
+import numpy as np
+
+from brand_mapping import FUZZY_BRAND_MAP
+from fallback_parser import turkish_lower
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+_FOLD = str.maketrans("çğıöşüâîû", "cgiosuaiu")
+_TOKEN = re.compile(r"[a-z0-9]+(?:[.,][0-9]+)*")
+
+# Query words that the listings spell differently.
+TOKEN_SYNONYMS = {"hibrit": "hybrid", "hybrit": "hybrid"}
+
+# Series names that are also everyday words, first names or places ("city car", "Kartal
+# tarafında"). They become a model term only next to their brand or before a trim token.
+AMBIGUOUS_SERIES = frozenset({
+    "accent", "accord", "bravo", "city", "coupe", "dogan", "excel", "fusion", "idea", "jazz",
+    "ka", "kartal", "latitude", "marina", "matrix", "murat", "note", "omega", "panda", "prelude",
+    "sahin", "scala", "serce", "spark", "superb", "swift", "symbol", "talisman", "vega", "zoe",
+})
+
+def fold(text: str) -> str:
+    return turkish_lower(text).translate(_FOLD)
+
+def tokenize(text: str) -> List[str]:
+    tokens = [token.replace(",", ".") for token in _TOKEN.findall(fold(text or ""))]
+    return [TOKEN_SYNONYMS.get(token, token) for token in tokens]
+
+class ModelIndex:
+    """Token -> positions index for one inventory snapshot."""
+
+    def __init__(self, inventory):
+        self.size = inventory.size
+        postings: Dict[str, List[int]] = defaultdict(list)
+        series: Set[str] = set()
+        series_brands: Dict[str, Set[str]] = defaultdict(set)
+        for position, (marka, seri, model) in enumerate(zip(
+                inventory.text["marka"], inventory.text["seri"], inventory.text["model"])):
+            for token in set(tokenize(f"{marka} {seri} {model}")):
+                postings[token].append(position)
+            seri_tokens = tokenize(seri)
+            if len(seri_tokens) == 1 and len(seri_tokens[0]) >= 2 and re.search(r"[a-z]", seri_tokens[0]):
+                series.add(seri_tokens[0])
+                series_brands[seri_tokens[0]].add(marka)
+        self.postings = {token: np.array(positions, dtype=np.int64) for token, positions in postings.items()}
+        self.vocabulary = sorted(self.postings)
+        self.series = series
+        # Tokens that name the brand of each ambiguous series, aliases included ("vw polo").
+        brand_tokens: Dict[str, Set[str]] = defaultdict(set)
+        for alias, brand in FUZZY_BRAND_MAP.items():
+            brand_tokens[brand].update(tokenize(alias))
+        self.series_brand_tokens = {
+            name: set().union(*(set(tokenize(brand)) | brand_tokens[brand] for brand in series_brands[name]))
+            for name in series & AMBIGUOUS_SERIES
+        }
+        logger.info(f"Built model index: {len(self.vocabulary)} tokens over {self.size} listings.")
+
+    def _token_mask(self, token: str) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        if len(token) < 2:
+            positions = self.postings.get(token)
+            if positions is not None:
+                mask[positions] = True
+            return mask
+        start = bisect.bisect_left(self.vocabulary, token)
+        for candidate in self.vocabulary[start:]:
+            if not candidate.startswith(token):
+                break
+            mask[self.postings[candidate]] = True
+        return mask
+
+    def mask_for_terms(self, terms: List[str]) -> np.ndarray:
+        """Listings matching any of the terms; a term matches when all of its tokens do."""
+        mask = np.zeros(self.size, dtype=bool)
+        for term in terms:
+            tokens = tokenize(term)
+            if not tokens:
+                continue
+            term_mask = np.ones(self.size, dtype=bool)
+            for token in tokens:
+                term_mask &= self._token_mask(token)
+            mask |= term_mask
+        return mask
+
+    def extract_terms(self, query: str) -> List[str]:
+        """
+        Model terms mentioned in free text: a known single-word series ("golf", "corolla")
+        followed by words that occur verbatim in the listings ("1.6 tdi"). An ambiguous
+        series (AMBIGUOUS_SERIES) counts only after its brand ("tofaş kartal") or before
+        a trim token ("note 1.5 dci").
+        """
+        tokens = tokenize(query)
+        terms, i = [], 0
+        while i < len(tokens):
+            if tokens[i] in self.series:
+                j = i + 1
+                # Bare integers ("2 yaşından") are ages or counts, and another series starts a new term.
+                while j < len(tokens) and tokens[j] in self.postings \
+                        and not tokens[j].isdigit() and tokens[j] not in self.series:
+                    j += 1
+                brands = self.series_brand_tokens.get(tokens[i])
+                if brands is None or j > i + 1 or (i > 0 and tokens[i - 1] in brands):
+                    terms.append(" ".join(tokens[i:j]))
+                i = j
+            else:
+                i += 1
+        return terms
+
+def for_inventory(inventory) -> ModelIndex:
+    """The model index of an inventory snapshot, built once per snapshot."""
+    return inventory.derived("model_index", ModelIndex)
+
+def get_index() -> ModelIndex:
+    import inventory
+    return for_inventory(inventory.get_inventory())
+
+def matching_ids(terms: List[str]) -> List[int]:
+    """Listing ids matching any of the model terms, for the compiled SQL path."""
+    import inventory
+    snapshot = inventory.get_inventory()
+    return snapshot.ids[for_inventory(snapshot).mask_for_terms(terms)].tolist()
@@ -0,0 +1,79 @@
+# app/usage_callbacks.py
+"""
+LangChain callback handler feeding the LLM usage ledger.
+Imported lazily by usage_ledger so the API does not load langchain at import time.
+"""
+
+import time
+import threading
+from typing import Any, Dict, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+import usage_ledger
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """Measures latency, retries and token usage of each chat model call and records it."""
+
+    def __init__(self, stage: str, session_id: Optional[str], turn: Optional[int]):
+        self.stage = stage
+        self.session_id = session_id
+        self.turn = turn
+        self._lock = threading.Lock()
+        self._runs: Dict[UUID, Dict[str, Any]] = {}
+
+    def _start(self, run_id: UUID, serialized: Optional[Dict[str, Any]], **kwargs: Any):
+        params = kwargs.get("invocation_params") or {}
+        metadata = kwargs.get("metadata") or {}
+        model = params.get("model") or params.get("model_name") or metadata.get("ls_model_name")
+        if not model and serialized:
+            model = (serialized.get("kwargs") or {}).get("model")
+        with self._lock:
+            self._runs[run_id] = {"started": time.monotonic(), "model": model, "retries": 0}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs: Any):
+        self._start(run_id, serialized, **kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs: Any):
+        self._start(run_id, serialized, **kwargs)
+
+    def on_retry(self, retry_state: Any, *, run_id: UUID, **kwargs: Any):
+        with self._lock:
+            if run_id in self._runs:
+                self._runs[run_id]["retries"] += 1
+
+    def _finish(self, run_id: UUID, prompt_tokens: int, completion_tokens: int, model: Optional[str], error: bool):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        usage_ledger.record_call(
+            stage=self.stage,
+            session_id=self.session_id,
+            turn=self.turn,
+            model=(model or run["model"] or "").replace("models/", "") or None,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=int((time.monotonic() - run["started"]) * 1000),
+            retries=run["retries"],
+            error=error,
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        prompt_tokens = completion_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+        llm_output = response.llm_output or {}
+        if not prompt_tokens and not completion_tokens:
+            token_usage = llm_output.get("token_usage") or llm_output.get("usage_metadata") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", token_usage.get("input_tokens", 0))
+            completion_tokens = token_usage.get("completion_tokens", token_usage.get("output_tokens", 0))
+        self._finish(run_id, prompt_tokens, completion_tokens, llm_output.get("model_name"), error=False)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._finish(run_id, 0, 0, None, error=True)
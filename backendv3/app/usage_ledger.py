@@ -0,0 +1,71 @@
+# app/usage_ledger.py
+
+import os
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import database
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+LEDGER_ENABLED = os.getenv("LLM_USAGE_LEDGER", "1") != "0"
+
+# List prices in USD per one million tokens: (prompt, completion). Update when Gemini pricing changes.
+MODEL_PRICES_PER_MILLION: Dict[str, Tuple[float, float]] = {
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+
+# (session_id, turn) of the conversation turn currently being processed.
+_turn: ContextVar[Tuple[Optional[str], Optional[int]]] = ContextVar("llm_usage_turn", default=(None, None))
+
+@contextmanager
+def turn_context(session_id: str, turn: int):
+    """Attributes every LLM call made inside the block to this session turn."""
+    token = _turn.set((session_id, turn))
+    try:
+        yield
+    finally:
+        _turn.reset(token)
+
+def run_in_turn(session_id: str, turn: int, fn: Callable[..., Any], /, *args, **kwargs) -> Any:
+    """Calls fn inside turn_context; handy for run_in_threadpool. fn may take its own session_id keyword."""
+    with turn_context(session_id, turn):
+        return fn(*args, **kwargs)
+
+def estimate_cost(model: Optional[str], prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES_PER_MILLION.get(model or "", (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+def record_call(stage: str, session_id: Optional[str], turn: Optional[int], model: Optional[str],
+                prompt_tokens: int, completion_tokens: int, latency_ms: int, retries: int = 0, error: bool = False):
+    """Writes one LLM call to the ledger. Failures are logged, never raised into the request."""
+    try:
+        database.add_llm_usage({
+            "session_id": session_id,
+            "turn": turn,
+            "stage": stage,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency_ms": latency_ms,
+            "retries": retries,
+            "error": int(error),
+            "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
+        })
+    except Exception as e:
+        logger.warning(f"Could not record LLM usage for stage '{stage}': {e}")
+
+def callbacks_for(stage: str) -> List[Any]:
+    """LangChain callbacks that record every LLM call of this stage (including agent sub-steps)."""
+    if not LEDGER_ENABLED:
+        return []
+    from usage_callbacks import UsageCallbackHandler
+    session_id, turn = _turn.get()
+    return [UsageCallbackHandler(stage=stage, session_id=session_id, turn=turn)]
+
+def aggregate(group_by: List[str], since_hours: Optional[int] = None) -> List[Dict[str, Any]]:
+    return database.aggregate_llm_usage(group_by, since_hours)
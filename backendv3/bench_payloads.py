@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Response size and serialisation CPU of the /chat result payload, before and after
+listing_schema (projection + orjson + gzip) and of the summary prompt's result block.
+
+The result sets are the `result_ids` of a replay report (python replay.py replay ...),
+or random pages of five listings when no report is given; rows are read from
+app/araba_verileri.db read-only. For each encoding the benchmark reports the bytes per
+turn, raw and gzipped, and the CPU time per turn over `--repeat` encodings:
+
+  before     pydantic ChatResponse with generic dict rows, then the stdlib JSON encoding
+  all        every Listing field, orjson
+  projected  the fields the frontend's car cards request, orjson
+
+Run from the backendv3 directory:
+  python bench_payloads.py --report run.json --repeat 200
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from contextlib import closing
+from typing import Any, Callable, Dict, List
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+sys.path.insert(0, APP_DIR)
+
+from pydantic import BaseModel  # noqa: E402
+
+import listing_schema  # noqa: E402
+
+DB_PATH = os.path.join(APP_DIR, "araba_verileri.db")
+CARD_FIELDS = ["marka", "seri", "model", "fiyat", "yil", "km", "yakit", "vites", "kasa_tipi", "renk", "link"]
+
+class LegacyChatResponse(BaseModel):
+    """The /chat response model before listing_schema: rows validated as generic dicts."""
+    session_id: str
+    response: str
+    results: List[Dict]
+    active_filters: Dict
+    inferred_assumptions: List[str]
+
+def load_result_sets(report_path: str, samples: int) -> List[List[Dict[str, Any]]]:
+    with closing(sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)) as conn:
+        conn.row_factory = sqlite3.Row
+        if report_path:
+            with open(report_path, encoding="utf-8") as f:
+                id_sets = [turn["result_ids"] for turn in json.load(f)["turns"] if turn.get("result_ids")]
+        else:
+            ids = [row[0] for row in conn.execute("SELECT id FROM araba_ilanlari")]
+            rng = random.Random(0)
+            id_sets = [rng.sample(ids, 5) for _ in range(samples)]
+        sets = []
+        for id_set in id_sets:
+            rows = {row["id"]: dict(row) for row in conn.execute(
+                "SELECT * FROM araba_ilanlari WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(id_set),)
+            )}
+            sets.append([rows[i] for i in id_set if i in rows])
+    return sets
+
+def _envelope(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "session_id": "00000000-0000-0000-0000-000000000000",
+        "response": "Kriterlerinize uyan 5 araç buldum. Fiyatlar 479.000 TL ile 805.000 TL arasında.",
+        "results": results,
+        "active_filters": {"fiyat_max": 1000000, "yakit": ["Dizel"], "vites": "Otomatik", "marka": []},
+        "inferred_assumptions": [],
+    }
+
+def encode_before(rows: List[Dict[str, Any]]) -> bytes:
+    model = LegacyChatResponse(**_envelope(rows))
+    # Starlette's JSONResponse.render
+    return json.dumps(model.model_dump(), ensure_ascii=False, allow_nan=False, indent=None,
+                      separators=(",", ":")).encode("utf-8")
+
+def encoder_after(fields: List[str]) -> Callable[[List[Dict[str, Any]]], bytes]:
+    projection = listing_schema.parse_fields(fields)
+    renderer = listing_schema.CompactJSONResponse(content=None)
+    return lambda rows: renderer.render(_envelope(listing_schema.project(rows, projection)))
+
+def measure(encode: Callable[[List[Dict[str, Any]]], bytes], sets: List[List[Dict[str, Any]]], repeat: int) -> Dict[str, float]:
+    payloads = [encode(rows) for rows in sets]
+    started = time.process_time()
+    for _ in range(repeat):
+        for rows in sets:
+            encode(rows)
+    cpu = (time.process_time() - started) / (repeat * len(sets))
+    return {
+        "bytes": sum(map(len, payloads)) / len(payloads),
+        "gzip_bytes": sum(len(gzip.compress(p)) for p in payloads) / len(payloads),
+        "cpu_us": cpu * 1e6,
+    }
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure /chat payload size and encoding CPU.")
+    arg_parser.add_argument("--report", help="Replay report whose result_ids are used as result sets.")
+    arg_parser.add_argument("--samples", type=int, default=100, help="Random result sets when no report is given.")
+    arg_parser.add_argument("--repeat", type=int, default=200)
+    arg_parser.add_argument("--output", help="Also write the results as JSON.")
+    args = arg_parser.parse_args()
+
+    sets = load_result_sets(args.report, args.samples)
+    if not sets:
+        sys.exit("No result sets to measure.")
+    results = {
+        "before": measure(encode_before, sets, args.repeat),
+        "all": measure(encoder_after(None), sets, args.repeat),
+        "projected": measure(encoder_after(CARD_FIELDS), sets, args.repeat),
+    }
+    print(f"{len(sets)} result sets, {args.repeat} encodings each")
+    print("encoding    bytes/turn  gzip bytes  cpu us/turn")
+    for name, row in results.items():
+        print(f"{name:<10} {row['bytes']:>11.0f} {row['gzip_bytes']:>11.0f} {row['cpu_us']:>12.1f}")
+
+    before_prompt = sum(len(str(rows)) for rows in sets) / len(sets)
+    after_prompt = sum(len(listing_schema.to_table(rows)) for rows in sets) / len(sets)
+    results["prompt_chars"] = {"before": before_prompt, "after": after_prompt}
+    print(f"summary prompt result block: {before_prompt:.0f} -> {after_prompt:.0f} characters per turn "
+          f"({100 * (1 - after_prompt / before_prompt):.0f}% fewer)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"sets": len(sets), "repeat": args.repeat, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
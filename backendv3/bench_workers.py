@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Throughput of the production serving profile (gunicorn.conf.py) by worker count.
+
+For every worker count the app directory is copied to a scratch directory (so the
+databases in app/ are never written), gunicorn is started on it with LLM_OFFLINE=1
+(every LLM stage takes its local path, so the numbers measure the server, not Gemini)
+and, once /ready answers, `--clients` concurrent clients replay corpus sessions against
+/chat for `--duration` seconds, keeping each session id so consecutive turns land on
+different workers. Every fifth request is a /similar lookup.
+
+Run from the backendv3 directory:
+  python bench_workers.py --corpus corpus.jsonl --workers 1 2 4 --clients 16 --duration 20
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BACKEND_DIR, "app")
+
+DEFAULT_SESSIONS = [
+    ["1 milyon altı otomatik dizel araba", "beyaz olmasın", "km 100 binden az olsun"],
+    ["2018 sonrası suv bakıyorum", "benzinli olsun", "en uygun fiyatlıları göster"],
+    ["fiat egea", "boyasız olsun"],
+    ["aile için geniş bir araba, 800 bin bütçe", "manuel de olur", "volkswagen hariç"],
+]
+
+def load_sessions(path: Optional[str]) -> List[List[str]]:
+    if not path:
+        return DEFAULT_SESSIONS
+    with open(path, encoding="utf-8") as f:
+        sessions = [[turn["user_query"] for turn in json.loads(line)["turns"]] for line in f if line.strip()]
+    return [turns for turns in sessions if turns] or DEFAULT_SESSIONS
+
+def _request(url: str, body: Optional[Dict[str, Any]] = None, timeout: float = 60) -> Dict[str, Any]:
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+# --- Server ---
+
+def start_server(scratch: str, workers: int, port: int) -> subprocess.Popen:
+    env = {**os.environ, "WEB_CONCURRENCY": str(workers), "BIND": f"127.0.0.1:{port}",
+           "LLM_OFFLINE": "1", "MAINTENANCE_INTERVAL_MINUTES": "0"}
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app"],
+        cwd=scratch, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+
+def wait_until_ready(base_url: str, timeout: float) -> None:
+    """Waits until warm-up has finished (successfully or not) in a worker."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _request(f"{base_url}/ready", timeout=2)
+            return
+        except urllib.error.HTTPError as e:
+            if json.loads(e.read() or b"{}").get("warmup_seconds") is not None:
+                return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} was not ready within {timeout}s.")
+
+def stop_server(process: subprocess.Popen) -> None:
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+# --- Load ---
+
+def run_load(base_url: str, sessions: List[List[str]], clients: int, duration: float) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(seed: int):
+        nonlocal errors
+        rng = random.Random(seed)
+        while time.time() < deadline:
+            session_id = None
+            for query in rng.choice(sessions):
+                if time.time() >= deadline:
+                    break
+                started = time.perf_counter()
+                try:
+                    reply = _request(f"{base_url}/chat", {"user_query": query, "session_id": session_id})
+                    session_id = reply["session_id"]
+                    results = reply.get("results") or []
+                    if results and rng.random() < 0.25 and results[0].get("id") is not None:
+                        _request(f"{base_url}/similar/{results[0]['id']}?k=5")
+                except (urllib.error.URLError, ConnectionError, OSError, ValueError, KeyError):
+                    with lock:
+                        errors += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "req_per_s": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(_percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+    }
+
+def bench(worker_counts: List[int], sessions: List[List[str]], clients: int, duration: float,
+          port: int, ready_timeout: float) -> List[Dict[str, Any]]:
+    rows = []
+    for workers in worker_counts:
+        scratch = tempfile.mkdtemp(prefix="bench-workers-")
+        try:
+            shutil.copytree(APP_DIR, os.path.join(scratch, "app"),
+                            ignore=shutil.ignore_patterns("__pycache__", "archive", "shared_cache.db*"))
+            shutil.copy(os.path.join(BACKEND_DIR, "gunicorn.conf.py"), scratch)
+            process = start_server(scratch, workers, port)
+            try:
+                base_url = f"http://127.0.0.1:{port}"
+                wait_until_ready(base_url, ready_timeout)
+                result = run_load(base_url, sessions, clients, duration)
+            finally:
+                stop_server(process)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        result["workers"] = workers
+        rows.append(result)
+        print(f"{workers:>7} {result['requests']:>9} {result['errors']:>6} {result['req_per_s']:>8} "
+              f"{result['p50_ms']:>8} {result['p95_ms']:>8}", flush=True)
+    return rows
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Measure throughput by gunicorn worker count.")
+    arg_parser.add_argument("--corpus", help="Replay corpus (python replay.py export); built-in sessions otherwise.")
+    arg_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    arg_parser.add_argument("--clients", type=int, default=16, help="Concurrent clients.")
+    arg_parser.add_argument("--duration", type=float, default=20, help="Seconds of load per worker count.")
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--ready-timeout", type=float, default=180)
+    arg_parser.add_argument("--output", help="Also write the results as JSON.")
+    args = arg_parser.parse_args()
+
+    print(f"CPUs: {os.cpu_count()}, clients: {args.clients}, {args.duration}s per run")
+    print("workers  requests errors    req/s   p50 ms   p95 ms")
+    rows = bench(args.workers, load_sessions(args.corpus), args.clients, args.duration, args.port, args.ready_timeout)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"cpus": os.cpu_count(), "clients": args.clients, "results": rows}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for the API.
+
+Imports `main` in a fresh interpreter several times and fails (exit code 1) when the
+fastest import exceeds the budget, or when a heavy dependency is pulled in eagerly.
+Run from the backendv3 directory: python check_import_budget.py [--budget 1.0]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+
+# Modules that must only be loaded lazily (on first request or during warm-up).
+HEAVY_MODULES = [
+    "langchain_google_genai",
+    "langchain_community",
+    "langchain_core",
+    "sqlalchemy",
+]
+
+PROBE = """
+import sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+loaded = [m for m in {heavy!r} if m in sys.modules]
+print(f"{{elapsed:.4f}}|{{','.join(loaded)}}")
+"""
+
+def measure_once() -> tuple:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    ).stdout.strip().splitlines()[-1]
+    elapsed, loaded = output.split("|")
+    return float(elapsed), [m for m in loaded.split(",") if m]
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument("--budget", type=float, default=1.0, help="Maximum import time in seconds.")
+    arg_parser.add_argument("--runs", type=int, default=3, help="Number of fresh-interpreter imports.")
+    args = arg_parser.parse_args()
+
+    timings = []
+    eager = set()
+    for _ in range(args.runs):
+        elapsed, loaded = measure_once()
+        timings.append(elapsed)
+        eager.update(loaded)
+
+    best = min(timings)
+    print(f"import main: best {best:.3f}s over {args.runs} runs (budget {args.budget:.3f}s)")
+
+    failed = False
+    if best > args.budget:
+        print(f"FAIL: import time {best:.3f}s exceeds the budget of {args.budget:.3f}s")
+        failed = True
+    if eager:
+        print(f"FAIL: heavy modules imported eagerly: {', '.join(sorted(eager))}")
+        failed = True
+    if not failed:
+        print("OK")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
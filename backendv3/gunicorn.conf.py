@@ -0,0 +1,41 @@
+# gunicorn.conf.py
+"""
+Production serving profile: gunicorn managing uvicorn workers.
+
+The app and its read-only structures (inventory snapshot, model index, similarity
+matrix, brand list) are loaded once in the master and shared copy-on-write by the
+forked workers; gc.freeze() keeps the collector from touching (and so copying) those
+pages. Per-request state that has to survive a worker switch lives in SQLite:
+sessions in user_history.db (WAL); plans, parses, candidate sets and request profiles in
+app/shared_cache.db (see app/shared_cache.py).
+
+Still per worker: the LLM admission semaphores (app/admission.py divides the configured
+limits by WEB_CONCURRENCY, so the deployment as a whole stays within them) and the
+circuit breakers (each worker trips on its own calls, which see the same upstream).
+
+  gunicorn -c gunicorn.conf.py app.main:app
+"""
+import gc
+import os
+import sys
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+# Read by the app (admission limits) when it is preloaded below.
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+# Recycles workers now and then so a slow leak cannot grow without bound.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = max_requests // 10
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+def when_ready(server):
+    """Runs in the master after the app is imported and before any worker is forked."""
+    preload = sys.modules["app.main"].preload
+    preload()
+    gc.freeze()
+    server.log.info(f"Preloaded the app; forking {server.num_workers} workers.")
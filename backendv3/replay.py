@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Replay recorded conversations through the chat engine for offline performance regression testing.
+
+  export  Writes an anonymised corpus (one JSON line per session) from user_history.db and,
+          with --archive, from the sessions maintenance.py has archived.
+  replay  Replays the corpus through process_chat_turn and writes a report with the filter
+          state, result ids and per-stage latency of every turn. With --baseline, the report
+          is diffed against an earlier one and the run fails on latency regressions.
+
+LLM modes for replay:
+  stub      No network: every breaker is forced onto its local path (rule-based parser,
+            compiled SQL, template summaries). Deterministic; the default.
+  recorded  Serves parse outputs, agent SQL and summaries from a cassette written by an earlier
+            `--llm live --record` run. Cassette misses take the stub path.
+  live      Calls Gemini; add --record cassette.json to capture the responses.
+
+Run from the backendv3 directory:
+  python replay.py export --output corpus.jsonl
+  python replay.py replay corpus.jsonl --llm stub --concurrency 4 --output run.json --baseline base.json
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from copy import deepcopy
+from typing import Any, Dict, List, Optional
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app")
+HISTORY_DB = os.path.join(APP_DIR, "user_history.db")
+STAGES = ["parse", "merge", "search", "summary", "total"]
+
+# --- Export ---
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+")
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_PHONE = re.compile(r"(?:\+?90|0)?\s*5\d{2}[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}")
+_PLATE = re.compile(r"\b(?:0[1-9]|[1-7]\d|8[01])\s?[A-ZÇĞİÖŞÜ]{1,3}\s?\d{2,4}\b")
+
+def anonymise_text(text: str) -> str:
+    """Masks e-mail addresses, URLs, phone numbers and licence plates in a user query."""
+    for pattern, mask in ((_EMAIL, "<email>"), (_URL, "<url>"), (_PHONE, "<phone>"), (_PLATE, "<plate>")):
+        text = pattern.sub(mask, text)
+    return text
+
+def export_corpus(db_path: str, output: str, archive_dir: Optional[str] = None) -> int:
+    """Writes one line per session with its turns; session ids are replaced by sequential labels."""
+    from state_delta import apply_delta
+    from maintenance import read_archive
+
+    with closing(sqlite3.connect(db_path)) as conn:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(conversation_history)")}
+        state_kind = "state_kind" if "state_kind" in columns else "'snapshot'"
+        rows = conn.execute(
+            f"SELECT session_id, turn, user_query, {state_kind}, filters_json FROM conversation_history ORDER BY id"
+        ).fetchall()
+
+    sessions: Dict[tuple, Dict[str, Any]] = {}
+    # Archived sessions are older than every live one, so they come first. A session id that was
+    # used again after its session expired starts a new session in the live table.
+    for archived in (read_archive(archive_dir) if archive_dir else []):
+        sessions[("archive", archived["session_id"], archived["archived_at"])] = {
+            "session": f"session-{len(sessions) + 1:04d}",
+            "turns": [
+                {"turn": t["turn"], "user_query": anonymise_text(t["user_query"]), "recorded_state": t["state"]}
+                for t in archived["turns"]
+            ],
+        }
+
+    # Turns store either the full state or a delta against the previous turn (see database.add_turn_to_history).
+    states: Dict[str, Dict[str, Any]] = {}
+    for session_id, turn, user_query, kind, filters_json in rows:
+        key = ("live", session_id)
+        if key not in sessions:
+            sessions[key] = {"session": f"session-{len(sessions) + 1:04d}", "turns": []}
+        payload = json.loads(filters_json)
+        states[session_id] = payload if kind == "snapshot" else apply_delta(states.get(session_id, {}), payload)
+        sessions[key]["turns"].append({
+            "turn": turn,
+            "user_query": anonymise_text(user_query),
+            "recorded_state": states[session_id],
+        })
+
+    with open(output, "w", encoding="utf-8") as f:
+        for session in sessions.values():
+            session["turns"].sort(key=lambda t: t["turn"])
+            f.write(json.dumps(session, ensure_ascii=False) + "\n")
+    turns = sum(len(session["turns"]) for session in sessions.values())
+    print(f"Exported {len(sessions)} sessions / {turns} turns to {output}")
+    return len(sessions)
+
+def load_corpus(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# --- LLM modes ---
+
+class Cassette:
+    """Recorded stage outputs keyed by their inputs: parsed queries, agent SQL and summaries."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.data: Dict[str, Dict[str, Any]] = {"parse": {}, "sql": {}, "summary": {}}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.data.update(json.load(f))
+
+    def get(self, stage: str, key: str) -> Any:
+        with self._lock:
+            value = self.data[stage].get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, stage: str, key: str, value: Any):
+        with self._lock:
+            self.data[stage][key] = value
+
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+
+def configure_llm(mode: str, cassette: Cassette, record: bool):
+    """Installs the chosen LLM mode on the engine modules."""
+    import circuit_breaker
+    import engine
+    import langchain_agent
+    import parser
+    import plan_cache
+    import query_builder
+    from singleflight import canonical_key, normalize_query
+
+    if mode == "stub":
+        circuit_breaker.force_open_all()
+        return
+
+    original_parse = engine.parse_user_query
+    original_agent = langchain_agent.run_sql_agent
+    original_summary = engine._invoke_summary_chain
+
+    if mode == "live" and record:
+        def parse_and_record(query):
+            parsed = original_parse(query)
+            cassette.put("parse", normalize_query(query), parsed)
+            return parsed
+
+        def agent_and_record(task, constraints):
+            outcome = original_agent(task, constraints)
+            if outcome.sql:
+                cassette.put("sql", canonical_key(task, constraints), outcome.sql)
+            return outcome
+
+        def summary_and_record(prompt, inputs, fallback):
+            comment = original_summary(prompt, inputs, fallback)
+            cassette.put("summary", canonical_key(inputs), comment)
+            return comment
+
+        engine.parse_user_query = parse_and_record
+        langchain_agent.run_sql_agent = agent_and_record
+        engine._invoke_summary_chain = summary_and_record
+        return
+
+    if mode == "recorded":
+        def parse_from_cassette(query):
+            parsed = cassette.get("parse", normalize_query(query))
+            return deepcopy(parsed) if parsed is not None else parser._parse_locally(query)
+
+        def agent_from_cassette(task, constraints):
+            sql = cassette.get("sql", canonical_key(task, constraints))
+            if sql is None:
+                seek_diversity = constraints.get("inferred", {}).get("seek_diversity", False)
+                return langchain_agent.AgentQueryResult(
+                    None, query_builder.run_compiled_search(constraints, seek_diversity=seek_diversity)
+                )
+            with closing(plan_cache.get_authorized_connection()) as conn:
+                rows = [dict(row) for row in conn.execute(sql).fetchall()]
+            return langchain_agent.AgentQueryResult(sql, rows)
+
+        def summary_from_cassette(prompt, inputs, fallback):
+            comment = cassette.get("summary", canonical_key(inputs))
+            return comment if comment is not None else fallback()
+
+        engine.parse_user_query = parse_from_cassette
+        langchain_agent.run_sql_agent = agent_from_cassette
+        engine._invoke_summary_chain = summary_from_cassette
+
+# --- Replay ---
+
+def _state_view(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {"filters": state.get("filters", {}), "exclusions": state.get("exclusions", {})}
+
+def replay_session(session: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Replays one session turn by turn, carrying state and history the way /chat does."""
+    from engine import process_chat_turn
+
+    state: Dict[str, Any] = {}
+    history: List[Dict[str, Any]] = []
+    outcomes = []
+    for recorded in session["turns"]:
+        outcome = {"session": session["session"], "turn": recorded["turn"], "user_query": recorded["user_query"]}
+        started = time.perf_counter()
+        try:
+            processed = process_chat_turn(recorded["user_query"], state, history, session_id=session["session"])
+        except Exception as e:
+            outcome["error"] = f"{type(e).__name__}: {e}"
+            outcome["timings"] = {"total": time.perf_counter() - started}
+            outcomes.append(outcome)
+            continue
+        timings = dict(processed.get("timings", {}))
+        timings["total"] = time.perf_counter() - started
+
+        # /chat persists the state as JSON and reloads it on the next turn.
+        state = json.loads(json.dumps(processed["updated_session_state"]))
+        history.append({"session_id": session["session"], "turn": recorded["turn"],
+                        "user_query": recorded["user_query"]})
+        outcome.update({
+            "state": _state_view(state),
+            "seek_diversity": state.get("inferred", {}).get("seek_diversity", False),
+            "result_ids": [row.get("id") for row in processed["results"]],
+            "timings": timings,
+            "routing": [(r["stage"], r["tier"]) for r in processed.get("routing", [])],
+            "matches_recorded_state": _state_view(state) == _state_view(recorded.get("recorded_state", {})),
+        })
+        outcomes.append(outcome)
+    return outcomes
+
+def _percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else 0.0
+
+def latency_summary(turns: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    summary = {}
+    for stage in STAGES:
+        values = [t["timings"][stage] for t in turns if stage in t.get("timings", {})]
+        if values:
+            summary[stage] = {
+                "count": len(values),
+                "mean_ms": round(1000 * sum(values) / len(values), 3),
+                "p50_ms": round(1000 * _percentile(values, 0.5), 3),
+                "p95_ms": round(1000 * _percentile(values, 0.95), 3),
+                "max_ms": round(1000 * max(values), 3),
+            }
+    return summary
+
+def run_replay(corpus: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        turns = [turn for session_turns in pool.map(replay_session, corpus) for turn in session_turns]
+    wall = time.perf_counter() - started
+    return {
+        "turns": turns,
+        "wall_seconds": round(wall, 3),
+        "turns_per_second": round(len(turns) / wall, 2) if wall else None,
+        "errors": sum(1 for t in turns if "error" in t),
+        "recorded_state_mismatches": sum(1 for t in turns if t.get("matches_recorded_state") is False),
+        "latency": latency_summary(turns),
+    }
+
+# --- Diff ---
+
+def diff_reports(report: Dict[str, Any], baseline: Dict[str, Any], max_slowdown: float,
+                 min_delta_ms: float, examples: int = 10) -> Dict[str, Any]:
+    """Compares filter states, result ids and per-stage latency with a baseline report."""
+    base_turns = {(t["session"], t["turn"]): t for t in baseline["turns"]}
+    state_changes, result_changes, missing = [], [], 0
+    for turn in report["turns"]:
+        base = base_turns.get((turn["session"], turn["turn"]))
+        if base is None:
+            missing += 1
+            continue
+        key = {"session": turn["session"], "turn": turn["turn"], "user_query": turn["user_query"]}
+        if turn.get("state") != base.get("state") or ("error" in turn) != ("error" in base):
+            state_changes.append({**key, "before": base.get("state", base.get("error")),
+                                  "after": turn.get("state", turn.get("error"))})
+        elif turn.get("seek_diversity"):
+            # Diversity searches sample randomly; only the number of results is comparable.
+            if len(turn.get("result_ids", [])) != len(base.get("result_ids", [])):
+                result_changes.append({**key, "before": len(base["result_ids"]), "after": len(turn["result_ids"])})
+        elif turn.get("result_ids") != base.get("result_ids"):
+            result_changes.append({**key, "before": base.get("result_ids"), "after": turn.get("result_ids")})
+
+    latency, regressions = {}, []
+    for stage, current in report["latency"].items():
+        previous = baseline.get("latency", {}).get(stage)
+        if not previous:
+            continue
+        entry = {}
+        for metric in ("p50_ms", "p95_ms"):
+            ratio = current[metric] / previous[metric] if previous[metric] else None
+            entry[metric] = {"before": previous[metric], "after": current[metric],
+                             "ratio": round(ratio, 3) if ratio is not None else None}
+            if ratio is not None and ratio > max_slowdown and current[metric] - previous[metric] > min_delta_ms:
+                regressions.append(f"{stage} {metric}: {previous[metric]:.1f} -> {current[metric]:.1f} ms (x{ratio:.2f})")
+        latency[stage] = entry
+
+    return {
+        "turns_compared": len(report["turns"]) - missing,
+        "turns_missing_from_baseline": missing,
+        "filter_state_changes": len(state_changes),
+        "result_set_changes": len(result_changes),
+        "filter_state_examples": state_changes[:examples],
+        "result_set_examples": result_changes[:examples],
+        "latency": latency,
+        "latency_regressions": regressions,
+    }
+
+def print_summary(report: Dict[str, Any]):
+    print(f"Replayed {len(report['turns'])} turns in {report['wall_seconds']}s "
+          f"({report['turns_per_second']} turns/s, {report['errors']} errors, "
+          f"{report['recorded_state_mismatches']} differ from the recorded state)")
+    for stage, stats in report["latency"].items():
+        print(f"  {stage:<8} p50 {stats['p50_ms']:>9.2f} ms   p95 {stats['p95_ms']:>9.2f} ms   max {stats['max_ms']:>9.2f} ms")
+    diff = report.get("baseline_diff")
+    if diff:
+        print(f"Against baseline: {diff['filter_state_changes']} filter state changes, "
+              f"{diff['result_set_changes']} result set changes over {diff['turns_compared']} turns")
+        for regression in diff["latency_regressions"]:
+            print(f"  REGRESSION {regression}")
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    export_cmd = commands.add_parser("export", help="Export an anonymised corpus from user_history.db.")
+    export_cmd.add_argument("--db", default=HISTORY_DB)
+    export_cmd.add_argument("--output", default="replay_corpus.jsonl")
+    export_cmd.add_argument("--archive", help="Also export archived sessions from this directory (e.g. app/archive).")
+
+    replay_cmd = commands.add_parser("replay", help="Replay a corpus through the chat engine.")
+    replay_cmd.add_argument("corpus")
+    replay_cmd.add_argument("--llm", choices=["stub", "recorded", "live"], default="stub")
+    replay_cmd.add_argument("--cassette", default="replay_cassette.json", help="Recorded LLM outputs.")
+    replay_cmd.add_argument("--record", action="store_true", help="With --llm live, write outputs to the cassette.")
+    replay_cmd.add_argument("--concurrency", type=int, default=1, help="Sessions replayed in parallel.")
+    replay_cmd.add_argument("--output", default="replay_report.json")
+    replay_cmd.add_argument("--baseline", help="Earlier report to diff against.")
+    replay_cmd.add_argument("--max-slowdown", type=float, default=1.25, help="Allowed p50/p95 ratio per stage.")
+    replay_cmd.add_argument("--min-delta-ms", type=float, default=5.0, help="Ignore slowdowns smaller than this.")
+    replay_cmd.add_argument("--verbose", action="store_true")
+    args = arg_parser.parse_args()
+
+    sys.path.insert(0, APP_DIR)
+    if args.command == "export":
+        export_corpus(args.db, args.output, args.archive)
+        return
+
+    # Replays must not add rows to the production usage ledger.
+    os.environ.setdefault("LLM_USAGE_LEDGER", "0")
+    import engine  # noqa: F401  (registers the breakers before the LLM mode is applied)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    cassette = Cassette(args.cassette if args.llm != "stub" else None)
+    configure_llm(args.llm, cassette, args.record)
+
+    report = run_replay(load_corpus(args.corpus), args.concurrency)
+    report.update({"llm_mode": args.llm, "concurrency": args.concurrency})
+    if args.llm == "recorded":
+        report["cassette"] = {"hits": cassette.hits, "misses": cassette.misses}
+    if args.llm == "live" and args.record:
+        cassette.save()
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            report["baseline_diff"] = diff_reports(report, json.load(f), args.max_slowdown, args.min_delta_ms)
+        failed = bool(report["baseline_diff"]["latency_regressions"])
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1, default=str)
+    print_summary(report)
+    print(f"Report written to {args.output}")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
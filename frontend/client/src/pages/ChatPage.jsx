@@ -2,6 +2,9 @@
 import { useState, useEffect } from "react";
 import axios from "axios";
 
+// Listing fields requested from /chat: the ones SwipeableCarCard renders
+const CAR_CARD_FIELDS = ["marka", "seri", "model", "fiyat", "yil", "km", "yakit", "vites", "kasa_tipi", "renk", "link"];
+
 // Function to process markdown-style bold text
 function processMarkdownText(text) {
   if (!text) return text;
@@ -325,7 +328,9 @@ export default function ChatPage() {
     try {
       const response = await axios.post("http://aracasistani.duckdns.org:8000/chat", {
         user_query: userInput,
-        session_id: sessionId
+        session_id: sessionId,
+        // Only the columns the car cards show
+        fields: CAR_CARD_FIELDS
       });
 
       const botMessage = {